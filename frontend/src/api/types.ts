@@ -170,6 +170,7 @@ export type BlockId5 = string;
 export type Blocks = UserFlowBlockConfig[];
 export type X = number;
 export type Y = number;
+export type MediaWarmUpChatId = string | number | null;
 export type DisplayName = string | null;
 export type Id3 = number;
 export type TgGroupChatType = "group" | "supergroup" | "channel";
@@ -246,6 +247,13 @@ export type ExcTraceback = string | null;
 export type LastErrors = BotError[];
 export type AdminChatIds = (string | number)[];
 export type AlertChatId = string | number | null;
+export type Updates = number;
+export type UnhandledUpdates = number;
+export type Errors = number;
+export type RecentUpdatesPerMinute = number;
+export type AvgProcessingDuration = number | null;
+export type P95ProcessingDuration = number | null;
+export type LastUpdateAt = number | null;
 export type VersionMessage = string | null;
 export type Start = boolean;
 export type DisplayName2 = string | null;
@@ -257,7 +265,7 @@ export type TotalResponses1 = number;
 export type Results = {
   [k: string]: string | number | number;
 }[];
-export type Errors = BotError[];
+export type Errors1 = BotError[];
 export type Versions = BotVersionInfo[];
 export type TotalVersions = number;
 export type AlertChatId1 = number | string;
@@ -295,6 +303,7 @@ export interface UserFlowConfig {
   entrypoints: Entrypoints;
   blocks: Blocks;
   node_display_coords: NodeDisplayCoords;
+  media_warm_up_chat_id?: MediaWarmUpChatId;
   [k: string]: unknown;
 }
 export interface UserFlowEntryPointConfig {
@@ -618,6 +627,7 @@ export interface BotInfo {
   last_errors: LastErrors;
   admin_chat_ids: AdminChatIds;
   alert_chat_id: AlertChatId;
+  update_metrics?: BotUpdateMetricsSummary | null;
   [k: string]: unknown;
 }
 export interface BotVersionInfo {
@@ -672,6 +682,16 @@ export interface BotError {
   exc_traceback?: ExcTraceback;
   [k: string]: unknown;
 }
+export interface BotUpdateMetricsSummary {
+  updates: Updates;
+  unhandled_updates: UnhandledUpdates;
+  errors: Errors;
+  recent_updates_per_minute: RecentUpdatesPerMinute;
+  avg_processing_duration: AvgProcessingDuration;
+  p95_processing_duration: P95ProcessingDuration;
+  last_update_at: LastUpdateAt;
+  [k: string]: unknown;
+}
 export interface SaveBotConfigVersionPayload {
   config: BotConfig;
   version_message: VersionMessage;
@@ -702,7 +722,7 @@ export interface FormResultsPage {
 }
 export interface BotErrorsPage {
   bot_info: BotInfo;
-  errors: Errors;
+  errors: Errors1;
   [k: string]: unknown;
 }
 export interface BotVersionsPage {
@@ -15,20 +15,33 @@ from telebot_components.utils.secrets import RedisSecretStore
 from telebot_constructor.app import TelebotConstructorApp
 from telebot_constructor.auth.auth import Auth, GroupChatAuth, NoAuth
 from telebot_constructor.auth.telegram_auth import TelegramAuth
+from telebot_constructor.runners import (
+    ConstructedBotRunner,
+    PollingConstructedBotRunner,
+    ShardedPollingConstructedBotRunner,
+    WorkerContext,
+)
 from telebot_constructor.store.media import (
     AwsS3Credentials,
     AwsS3MediaStore,
+    AwsS3MediaStoreConfig,
+    CachingMediaStore,
+    ContentAddressedMediaStore,
     FilesystemMediaStore,
     MediaStore,
 )
 from telebot_constructor.telegram_files_downloader import (
     RedisCacheTelegramFilesDownloader,
 )
+from telebot_constructor.update_scheduler import (
+    FairUpdateScheduler,
+    UpdateSchedulerConfig,
+)
 
 logging.basicConfig(level=logging.INFO if os.environ.get("IS_HEROKU") else logging.DEBUG)
 
 
-async def main() -> None:
+async def make_app() -> TelebotConstructorApp:
     try:
         configure_alerts(token=os.environ["ALERTS_BOT_TOKEN"], alerts_channel_id=int(os.environ["ALERTS_CHANNEL_ID"]))
     except Exception:
@@ -88,25 +101,60 @@ async def main() -> None:
 
     try:
         media_store: MediaStore = AwsS3MediaStore(
-            credentials=AwsS3Credentials.model_validate_json(os.environ["MEDIA_STORE_AWS_S3_CREDENTIALS"])
+            credentials=AwsS3Credentials.model_validate_json(os.environ["MEDIA_STORE_AWS_S3_CREDENTIALS"]),
+            config=AwsS3MediaStoreConfig.model_validate_json(os.environ.get("MEDIA_STORE_AWS_S3_CONFIG", "{}")),
         )
         logging.info("AWS S3 media store set up")
     except Exception:
         media_dir = Path(".media").absolute()
         media_dir.mkdir(exist_ok=True)
-        media_store = FilesystemMediaStore(media_dir)
+        media_store = FilesystemMediaStore(media_dir, io_threads=int(os.environ.get("MEDIA_STORE_IO_THREADS", 4)))
         logging.info("Filesystem media store set up")
+    media_store = CachingMediaStore(
+        media_store,
+        max_size_bytes=int(os.environ.get("MEDIA_CACHE_SIZE_MIB", 64)) * 1024 * 1024,
+    )
+    media_store = ContentAddressedMediaStore(media_store, redis=redis)
 
-    app = TelebotConstructorApp(
+    return TelebotConstructorApp(
         redis=redis,
         auth=auth,
         secret_store=secret_store,
         static_files_dir=Path("frontend/dist"),
         telegram_files_downloader=telegram_files_downloader,
         media_store=media_store,
+        metrics_token=os.environ.get("METRICS_TOKEN"),
     )
+
+
+async def sharded_worker_setup() -> WorkerContext:
+    app = await make_app()
+    await app.setup_worker()
+    return app.worker_context()
+
+
+async def main() -> None:
+    app = await make_app()
+    runner: ConstructedBotRunner
+    drain_timeout = float(os.environ.get("POLLING_DRAIN_TIMEOUT_SEC", 10.0))
+    scheduler_config = UpdateSchedulerConfig.model_validate_json(os.environ.get("UPDATE_SCHEDULER_CONFIG", "{}"))
+    logging.info(f"Update scheduler config: {scheduler_config}")
+    workers = int(os.environ.get("POLLING_WORKERS", 0))
+    if workers > 0:
+        logging.info(f"Running bots in {workers} worker processes")
+        runner = ShardedPollingConstructedBotRunner(
+            worker_setup=sharded_worker_setup,
+            workers=workers,
+            drain_timeout=drain_timeout,
+            scheduler_config=scheduler_config,
+        )
+    else:
+        runner = PollingConstructedBotRunner(
+            drain_timeout=drain_timeout,
+            scheduler=FairUpdateScheduler(scheduler_config),
+        )
     logging.info("Running app with polling")
-    await app.run_polling(port=int(os.environ.get("PORT", 8088)))
+    await app.run_polling(port=int(os.environ.get("PORT", 8088)), runner=runner)
 
 
 if __name__ == "__main__":
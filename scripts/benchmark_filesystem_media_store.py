@@ -0,0 +1,88 @@
+"""
+Measure how filesystem media store operations affect event loop latency for bots running in the same process.
+
+Simulated bots handle an "update" every few milliseconds and record how late their handler was woken up,
+while media clients concurrently save and load media. The thread pool-based store is compared to the
+baseline doing the same filesystem calls directly on the event loop.
+
+Usage: python scripts/benchmark_filesystem_media_store.py [--bots 200] [--media-clients 8] [--media-size-kib 1024]
+"""
+
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from telebot_constructor.store.media import FilesystemMediaStore, Media, MediaId
+
+
+class BlockingFilesystemMediaStore(FilesystemMediaStore):
+    """Baseline: the same operations, but run directly on the event loop"""
+
+    async def _run_in_thread(self, func, *args):  # type: ignore
+        return func(*args)
+
+
+def percentiles(values: list[float]) -> str:
+    if len(values) < 2:
+        return "n/a"
+    q = statistics.quantiles(values, n=100)
+    return f"p50={q[49] * 1000:.2f} ms, p99={q[98] * 1000:.2f} ms, max={max(values) * 1000:.2f} ms"
+
+
+async def simulated_bot(update_interval: float, until: float, lags: list[float]) -> None:
+    while time.perf_counter() < until:
+        expected_wakeup = time.perf_counter() + update_interval
+        await asyncio.sleep(update_interval)
+        lags.append(time.perf_counter() - expected_wakeup)
+
+
+async def media_client(store: FilesystemMediaStore, media: Media, until: float, op_latencies: list[float]) -> None:
+    saved: list[MediaId] = []
+    while time.perf_counter() < until:
+        start = time.perf_counter()
+        media_id = await store.save_media("benchmark", media)
+        assert media_id is not None
+        saved.append(media_id)
+        loaded = await store.load_media("benchmark", media_id)
+        assert loaded is not None
+        op_latencies.append(time.perf_counter() - start)
+    for media_id in saved:
+        await store.delete_media("benchmark", media_id)
+
+
+async def run(store: FilesystemMediaStore, args: argparse.Namespace) -> None:
+    media = Media(content=b"x" * (args.media_size_kib * 1024), filename="benchmark.jpg")
+    until = time.perf_counter() + args.duration
+    bot_lags: list[float] = []
+    op_latencies: list[float] = []
+    await asyncio.gather(
+        *[simulated_bot(args.update_interval_ms / 1000, until, bot_lags) for _ in range(args.bots)],
+        *[media_client(store, media, until, op_latencies) for _ in range(args.media_clients)],
+    )
+    await store.cleanup()
+    print(f"  bot update handling lag: {percentiles(bot_lags)}")
+    print(f"  media save+load latency: {percentiles(op_latencies)} ({len(op_latencies)} ops)")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bots", type=int, default=200)
+    parser.add_argument("--update-interval-ms", type=float, default=10.0)
+    parser.add_argument("--media-clients", type=int, default=8)
+    parser.add_argument("--media-size-kib", type=int, default=1024)
+    parser.add_argument("--io-threads", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        print("Blocking filesystem calls on the event loop:")
+        await run(BlockingFilesystemMediaStore(Path(tempdir)), args)
+        print(f"Filesystem calls in thread pool ({args.io_threads} threads):")
+        await run(FilesystemMediaStore(Path(tempdir), io_threads=args.io_threads), args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
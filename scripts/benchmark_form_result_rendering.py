@@ -0,0 +1,121 @@
+"""
+Measure form result rendering with precompiled per-language templates.
+
+A multilanguage form with plain text and single select fields is rendered for both languages, as it's done
+on each form completion (for the user echo and the admin chat). The renderer used by form blocks is compared
+to the baseline of telebot_components' Form.result_to_html.
+
+Usage: python scripts/benchmark_form_result_rendering.py [--fields 20] [--options 10] [--iterations 2000]
+"""
+
+import argparse
+import time
+from typing import Any, Callable
+
+from telebot_constructor.user_flow.blocks.form import (
+    BranchingFormMemberConfig,
+    EnumOption,
+    FormBlock,
+    FormFieldConfig,
+    FormMessages,
+    FormResultRenderer,
+    FormResultsExport,
+    FormResultUserAttribution,
+    PlainTextFormFieldConfig,
+    SingleSelectFormFieldConfig,
+)
+from telebot_constructor.utils.pydantic import Language
+
+EN = Language.lookup("en")
+RU = Language.lookup("ru")
+
+
+def localized(text: str) -> dict[Language, str]:
+    return {EN: text, RU: text + " (ru)"}
+
+
+def make_form_block(fields: int, options: int) -> FormBlock:
+    members: list[BranchingFormMemberConfig] = []
+    for i in range(fields):
+        if i % 2 == 0:
+            field = FormFieldConfig(
+                plain_text=PlainTextFormFieldConfig(
+                    id=f"benchmark_text_{i}",
+                    name=f"Text field #{i}",
+                    prompt=localized(f"text field {i}?"),
+                    is_long_text=i % 4 == 0,
+                    is_required=True,
+                    result_formatting="auto",
+                    empty_text_error_msg=localized("empty"),
+                )
+            )
+        else:
+            field = FormFieldConfig(
+                single_select=SingleSelectFormFieldConfig(
+                    id=f"benchmark_select_{i}",
+                    name=f"Single select field #{i}",
+                    prompt=localized(f"single select field {i}?"),
+                    is_required=True,
+                    result_formatting="auto",
+                    options=[EnumOption(id=f"option_{j}", label=localized(f"Option <{j}>")) for j in range(options)],
+                    invalid_enum_error_msg=localized("use buttons"),
+                )
+            )
+        members.append(BranchingFormMemberConfig(field=field))
+    return FormBlock(
+        block_id="benchmark-form",
+        form_name="benchmark-form",
+        members=members,
+        messages=FormMessages(
+            form_start=localized("start"),
+            cancel_command_is=localized("{} - cancel"),
+            field_is_skippable=localized("skip - {}"),
+            field_is_not_skippable=localized("not skippable"),
+            please_enter_correct_value=localized("correct value please"),
+            unsupported_command=localized("commands: {}"),
+        ),
+        results_export=FormResultsExport(
+            user_attribution=FormResultUserAttribution.NONE,
+            echo_to_user=True,
+            to_chat=None,
+        ),
+        form_completed_next_block_id=None,
+        form_cancelled_next_block_id=None,
+    )
+
+
+def measure(render: Callable[[dict[str, Any], Language], str], result: dict[str, Any], iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        render(result, EN)
+        render(result, RU)
+    return (time.perf_counter() - start) / iterations
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fields", type=int, default=20)
+    parser.add_argument("--options", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    form = make_form_block(args.fields, args.options)._form
+    result: dict[str, Any] = {}
+    for field in form.fields:
+        if field.name.startswith("benchmark_select"):
+            result[field.name] = list(field.EnumClass)[-1]  # type: ignore
+        else:
+            result[field.name] = "Some <answer> & more details\non several lines"
+
+    renderer = FormResultRenderer(form, languages=[EN, RU])
+    assert renderer.result_to_html(result, RU) == form.result_to_html(result, RU)
+
+    baseline = measure(lambda result, lang: form.result_to_html(result, lang), result, args.iterations)
+    precompiled = measure(renderer.result_to_html, result, args.iterations)
+    print(f"Rendering a form result with {args.fields} fields for 2 languages:")
+    print(f"  precompiled templates: {precompiled * 1e6:.1f} us")
+    print(f"  baseline, Form.result_to_html: {baseline * 1e6:.1f} us ({baseline / precompiled:.1f}x slower)")
+
+
+if __name__ == "__main__":
+    main()
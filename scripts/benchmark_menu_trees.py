@@ -0,0 +1,92 @@
+"""
+Measure menu tree construction for flows where many menus lead into the same large submenu hierarchy.
+
+The flow consists of several "root" menus, each leading to the top of a shared binary tree of menus.
+Building the user flow with shared subtrees is compared to the baseline of deep-copying every root's
+tree (as if each menu block owned a separate copy), and the number of distinct menu objects is reported.
+
+Usage: python scripts/benchmark_menu_trees.py [--roots 20] [--tree-size 30]
+"""
+
+import argparse
+import copy
+import time
+
+from telebot_constructor.bot_config import UserFlowBlockConfig, UserFlowConfig
+from telebot_constructor.user_flow.blocks.menu import (
+    Menu,
+    MenuBlock,
+    MenuConfig,
+    MenuItem,
+    MenuMechanism,
+)
+
+
+def menu_block(block_id: str, next_block_ids: list[str]) -> MenuBlock:
+    return MenuBlock(
+        block_id=block_id,
+        menu=Menu(
+            text=block_id,
+            items=[MenuItem(label=next_block_id, next_block_id=next_block_id) for next_block_id in next_block_ids],
+            config=MenuConfig(back_label="<-", lock_after_termination=False, mechanism=MenuMechanism.INLINE_BUTTONS),
+        ),
+    )
+
+
+def make_user_flow_config(roots: int, tree_size: int) -> UserFlowConfig:
+    blocks = [menu_block(f"root-{i}", ["tree-0"]) for i in range(roots)]
+    for i in range(tree_size):
+        children = [f"tree-{child}" for child in (2 * i + 1, 2 * i + 2) if child < tree_size]
+        blocks.append(menu_block(f"tree-{i}", children))
+    return UserFlowConfig(
+        entrypoints=[],
+        blocks=[UserFlowBlockConfig(menu=block) for block in blocks],
+        node_display_coords={},
+    )
+
+
+def menu_nodes(menu: Menu) -> list[Menu]:
+    res = [menu]
+    for item in menu.items:
+        if item.submenu is not None:
+            res.extend(menu_nodes(item.submenu))
+    return res
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--roots", type=int, default=20)
+    parser.add_argument("--tree-size", type=int, default=30)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    config = make_user_flow_config(args.roots, args.tree_size)
+
+    durations: list[float] = []
+    baseline_durations: list[float] = []
+    for _ in range(args.iterations):
+        # user flow construction modifies menu blocks in place
+        config_copy = config.model_copy(deep=True)
+        start = time.perf_counter()
+        user_flow = config_copy.to_user_flow()
+        durations.append(time.perf_counter() - start)
+
+        menus = [block.menu for block in user_flow.blocks if isinstance(block, MenuBlock)]
+        start = time.perf_counter()
+        copied_menus = [copy.deepcopy(menu) for menu in menus]
+        baseline_durations.append(time.perf_counter() - start)
+
+    total_nodes = sum(len(menu_nodes(menu)) for menu in menus)
+    distinct_nodes = len({id(node) for menu in menus for node in menu_nodes(menu)})
+    copied_distinct_nodes = len({id(node) for menu in copied_menus for node in menu_nodes(menu)})
+    print(f"{args.roots} root menus leading to a tree of {args.tree_size} menus:")
+    print(f"  shared subtrees: {min(durations) * 1000:.2f} ms to build the flow, {distinct_nodes} menu objects")
+    print(
+        f"  baseline, tree copy per menu block: +{min(baseline_durations) * 1000:.2f} ms to copy trees, "
+        + f"{copied_distinct_nodes} menu objects"
+    )
+    print(f"  total menu nodes in all trees: {total_nodes}")
+
+
+if __name__ == "__main__":
+    main()
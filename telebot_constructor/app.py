@@ -2,6 +2,7 @@ import asyncio
 import csv
 import datetime
 import fnmatch
+import hmac
 import json
 import logging
 import mimetypes
@@ -41,16 +42,25 @@ from telebot_constructor.auth.auth import Auth
 from telebot_constructor.bot_config import BotConfig
 from telebot_constructor.build_time_config import BASE_PATH, VERSION
 from telebot_constructor.constants import FILENAME_HEADER
-from telebot_constructor.construct import BotFactory, construct_bot, make_bare_bot
+from telebot_constructor.construct import (
+    BotFactory,
+    construct_bot,
+    constructed_bot_prefix,
+    make_bare_bot,
+)
 from telebot_constructor.cors import setup_cors
 from telebot_constructor.debug import setup_debugging
 from telebot_constructor.group_chat_discovery import GroupChatDiscoveryHandler
+from telebot_constructor.outgoing_rate_limiter import OutgoingRateLimiter
 from telebot_constructor.runners import (
+    BotConstructionError,
     ConstructedBotRunner,
     PollingConstructedBotRunner,
     WebhookAppConstructedBotRunner,
+    WorkerContext,
 )
 from telebot_constructor.static import get_prefilled_messages, static_file_content
+from telebot_constructor.store.bot_users import BotUserCache, fetch_bot_user
 from telebot_constructor.store.errors import BotError, BotErrorContext
 from telebot_constructor.store.form_results import (
     TIMESTAMP_KEY,
@@ -74,6 +84,15 @@ from telebot_constructor.telegram_files_downloader import (
     InmemoryCacheTelegramFilesDownloader,
     TelegramFilesDownloader,
 )
+from telebot_constructor.update_metrics import (
+    BotUpdateMetricsSummary,
+    UpdateMetricsCollector,
+    merge_prometheus_texts,
+)
+from telebot_constructor.user_flow.block_metrics import (
+    BlockMetricsSummaries,
+    load_block_metrics,
+)
 from telebot_constructor.utils import (
     log_prefix,
     page_params_to_redis_indices,
@@ -82,6 +101,9 @@ from telebot_constructor.utils import (
 
 logger = logging.getLogger(__name__)
 
+AUTH_BOT_OWNER_ID = "internal"
+AUTH_BOT_ID = "auth-bot"
+
 
 PydanticModelT = TypeVar("PydanticModelT", bound=pydantic.BaseModel)
 
@@ -109,6 +131,7 @@ class TelebotConstructorApp:
         telegram_files_downloader: Optional[TelegramFilesDownloader] = None,
         media_store: MediaStore | None = None,
         add_swagger: bool = False,
+        metrics_token: str | None = None,
     ) -> None:
         self.auth = auth
         self.secret_store = secret_store
@@ -121,6 +144,11 @@ class TelebotConstructorApp:
         self.store = TelebotConstructorStore(redis)
         self.store.errors.error_callback = self.send_alert_on_error
         self.media_store = media_store
+        self.bot_user_cache = BotUserCache(redis)
+        self.update_metrics = UpdateMetricsCollector()
+        self.outgoing_rate_limiter = OutgoingRateLimiter()
+        # metrics include all owners' bots, so the endpoint is disabled unless the token is set
+        self.metrics_token = metrics_token
         self.group_chat_discovery_handler = GroupChatDiscoveryHandler(
             redis=redis, telegram_files_downloader=self.telegram_files_downloader
         )
@@ -310,8 +338,62 @@ class TelebotConstructorApp:
             redis=self.redis,
             group_chat_discovery_handler=self.group_chat_discovery_handler,
             media_store=self.media_store.adapter_for(owner_id) if self.media_store else None,
+            bot_user_cache=self.bot_user_cache,
+            update_metrics_handler=self.update_metrics.handler_for(owner_id, bot_id),
+            collect_block_metrics=True,
+            outgoing_rate_limiter=self.outgoing_rate_limiter,
+            _bot_factory=self._bot_factory,
+        )
+
+    async def _bot_runner_to_start(self, owner_id: str, bot_id: str, bot_config: BotConfig) -> BotRunner:
+        """
+        Bot runner to pass to the constructed bot runner; if it reconstructs bots on its own, only a bare bot is
+        created, checking that the token is valid, to avoid constructing the bot twice; in this case other
+        construction errors are raised by the runner as BotConstructionError
+        """
+        if not self.runner.reconstructs_bots:
+            return await self._construct_bot(owner_id, bot_id, bot_config)
+        bot = await make_bare_bot(
+            owner_id=owner_id,
+            bot_id=bot_id,
+            bot_config=bot_config,
+            secret_store=self.secret_store,
             _bot_factory=self._bot_factory,
         )
+        await self.bot_user_cache.get_me(bot)
+        return BotRunner(bot_prefix=constructed_bot_prefix(owner_id, bot_id), bot=bot)
+
+    async def construct_running_bot(self, owner_id: str, bot_id: str) -> BotRunner:
+        """Construct the bot from its currently running version, e.g. in a worker process of a sharded runner"""
+        if owner_id == AUTH_BOT_OWNER_ID and bot_id == AUTH_BOT_ID:
+            auth_bot_runner = await self.auth.setup_bot()
+            if auth_bot_runner is None:
+                raise RuntimeError("Auth does not provide a bot")
+            return auth_bot_runner
+        version = await self.store.get_bot_running_version(owner_id, bot_id)
+        if version is None:
+            raise RuntimeError("Bot is not marked as running")
+        bot_config = await self.load_bot_config(owner_id, bot_id, version)
+        return await self._construct_bot(owner_id, bot_id, bot_config)
+
+    def worker_context(self) -> WorkerContext:
+        """For a worker process of a sharded runner, see setup_worker"""
+        return WorkerContext(
+            bot_runner_factory=self.construct_running_bot,
+            render_prometheus_metrics=self.render_prometheus_metrics,
+            update_metrics_summary=self.update_metrics.summary,
+        )
+
+    def render_prometheus_metrics(self) -> str:
+        """Metrics of the bots constructed in this process"""
+        return merge_prometheus_texts(
+            [self.update_metrics.render_prometheus(), self.outgoing_rate_limiter.render_prometheus()]
+        )
+
+    async def update_metrics_summary(self, owner_id: str, bot_id: str) -> Optional[BotUpdateMetricsSummary]:
+        return self.update_metrics.summary(owner_id, bot_id) or await self.runner.update_metrics_summary(
+            owner_id, bot_id
+        )
 
     def _log_prefix(
         self,
@@ -342,6 +424,13 @@ class TelebotConstructorApp:
             logger.info(f"{log_prefix} Bot is not running")
             return False
 
+    async def _is_still_running(self, owner_id: str, bot_id: str) -> bool:
+        try:
+            return await self.runner.is_running(owner_id, bot_id)
+        except NotImplementedError:
+            # runners not reporting it are assumed to keep the bot running
+            return True
+
     async def start_bot(
         self,
         a: BotAccessAuthorization,
@@ -351,23 +440,49 @@ class TelebotConstructorApp:
         bot_config = await self.load_bot_config(a.owner_id, a.bot_id, version)
         log_prefix = self._log_prefix(a.owner_id, a.bot_id, version=version, actor_id=a.actor_id)
         logger.info(f"{log_prefix} (Re)starting bot")
-        await self.stop_bot(a)
+        # the new bot is fully constructed while the running one (if any) keeps serving users
         try:
-            bot_runner = await self._construct_bot(
+            bot_runner = await self._bot_runner_to_start(
                 owner_id=a.owner_id,
                 bot_id=a.bot_id,
                 bot_config=bot_config,
             )
         except Exception as e:
             logger.exception(f"{log_prefix} Error constructing bot")
-            await self.store.set_bot_not_running(a.owner_id, a.bot_id)
             raise web.HTTPBadRequest(reason=str(e))
-        if not await self.runner.start(owner_id=a.owner_id, bot_id=a.bot_id, bot_runner=bot_runner):
-            await self.store.set_bot_not_running(a.owner_id, a.bot_id)
+        previous_version = await self.store.get_bot_running_version(a.owner_id, a.bot_id)
+        # running version is saved before starting the bot for runners that reconstruct it (see construct_running_bot)
+        await self.store.set_bot_running_version(a.owner_id, a.bot_id, version=version)
+        construction_error: BotConstructionError | None = None
+        try:
+            started = await self.runner.swap(owner_id=a.owner_id, bot_id=a.bot_id, bot_runner=bot_runner)
+        except BotConstructionError as e:
+            # the runner constructs the bot on its own, see _bot_runner_to_start
+            construction_error = e
+            started = False
+        if not started:
+            # depending on the runner and the failure, the previous version may have been stopped or keep running
+            if previous_version is not None and await self._is_still_running(a.owner_id, a.bot_id):
+                await self.store.set_bot_running_version(a.owner_id, a.bot_id, version=previous_version)
+            else:
+                await self.store.set_bot_not_running(a.owner_id, a.bot_id)
+                if previous_version is not None:
+                    await self.store.save_event(
+                        a.owner_id,
+                        a.bot_id,
+                        event=BotStoppedEvent(username=a.actor_id, event="stopped"),
+                    )
             logger.error(f"{log_prefix} Bot failed to start")
+            if construction_error is not None:
+                raise web.HTTPBadRequest(reason=str(construction_error))
             raise web.HTTPInternalServerError(reason="Failed to start bot")
         logger.info(f"{log_prefix} Bot started OK!")
-        await self.store.set_bot_running_version(a.owner_id, a.bot_id, version=version)
+        if previous_version is not None:
+            await self.store.save_event(
+                a.owner_id,
+                a.bot_id,
+                event=BotStoppedEvent(username=a.actor_id, event="stopped"),
+            )
         await self.store.save_event(
             a.owner_id,
             a.bot_id,
@@ -541,6 +656,8 @@ class TelebotConstructorApp:
             await self.stop_bot(a)
             await self.store.remove_bot_config(a.owner_id, a.bot_id)
             await self.secret_store.remove_secret(config.token_secret_name, owner_id=a.owner_id)
+            self.update_metrics.drop(a.owner_id, a.bot_id)
+            self.outgoing_rate_limiter.drop(a.owner_id, a.bot_id)
             await self.store.save_event(
                 a.owner_id,
                 a.bot_id,
@@ -637,6 +754,7 @@ class TelebotConstructorApp:
             if info is None:
                 raise web.HTTPInternalServerError(reason="Failed to load bot config")
             else:
+                info.update_metrics = await self.update_metrics_summary(a.owner_id, a.bot_id)
                 return web.json_response(text=info.model_dump_json())
 
         @routes.get("/api/info")
@@ -669,6 +787,8 @@ class TelebotConstructorApp:
                     "Failed to construct bot infos for some of the user's bots, will ignore them: "
                     + f"{missing_info_bot_ids}"
                 )
+            for bot_info in bot_infos:
+                bot_info.update_metrics = await self.update_metrics_summary(owner_id, bot_info.bot_id)
             return web.json_response(body=BotInfoList.dump_json(bot_infos))
 
         @routes.get("/api/info/{bot_id}/versions")
@@ -827,29 +947,69 @@ class TelebotConstructorApp:
                 return web.Response(text=media_id)
 
         @routes.get("/api/media/{media_id}")
-        async def serve_media(request: web.Request) -> web.Response:
+        async def serve_media(request: web.Request) -> web.StreamResponse:
             """
             ---
-            description: Load media from media store by its id
+            description: Load media from media store by its id; supports Range and If-None-Match headers
             produces:
             - */*
             responses:
                 "200":
                     description: Media body
+                "206":
+                    description: Requested range of media body
+                "304":
+                    description: Media not modified
+                "416":
+                    description: Requested range is not satisfiable
             """
             media_store = self.ensure_media_store()
             media_owner = await self.authorize_media_owner(request)
             media_id = self.parse_path_part(request, part_name="media_id")
-            media = await media_store.load_media(owner_id=media_owner, media_id=media_id)
-            if media is None:
+            media_stream = await media_store.load_media_stream(owner_id=media_owner, media_id=media_id)
+            if media_stream is None:
                 raise web.HTTPNotFound(reason=f"Media not found: {media_id}")
-            else:
-                headers = {
-                    hdrs.CACHE_CONTROL: "private, max-age=31536000",  # a year, as we use unique media ids
-                }
-                if media.filename is not None:
-                    headers[FILENAME_HEADER] = media.filename
-                return web.Response(body=media.content, content_type=media.mimetype, headers=headers)
+
+            headers = {
+                hdrs.CACHE_CONTROL: "private, max-age=31536000",  # a year, as we use unique media ids
+            }
+            if media_stream.filename is not None:
+                headers[FILENAME_HEADER] = media_stream.filename
+            content_type = media_stream.mimetype or "application/octet-stream"
+
+            if media_stream.path is not None:
+                # file response handles ranges and conditional requests on its own and uses sendfile if possible
+                headers[hdrs.CONTENT_TYPE] = content_type
+                return web.FileResponse(media_stream.path, headers=headers)
+
+            if media_stream.etag is not None:
+                if request.if_none_match is not None and any(
+                    etag.value in {media_stream.etag, "*"} for etag in request.if_none_match
+                ):
+                    return web.Response(status=304, headers={**headers, hdrs.ETAG: f'"{media_stream.etag}"'})
+
+            is_partial = hdrs.RANGE in request.headers
+            try:
+                start, end, _ = request.http_range.indices(media_stream.size)
+            except ValueError:
+                is_partial = False
+                start, end = 0, media_stream.size
+            if is_partial and start >= end:
+                raise web.HTTPRequestRangeNotSatisfiable(headers={hdrs.CONTENT_RANGE: f"bytes */{media_stream.size}"})
+
+            response = web.StreamResponse(status=206 if is_partial else 200, headers=headers)
+            response.content_type = content_type
+            response.content_length = end - start
+            response.headers[hdrs.ACCEPT_RANGES] = "bytes"
+            if media_stream.etag is not None:
+                response.headers[hdrs.ETAG] = f'"{media_stream.etag}"'
+            if is_partial:
+                response.headers[hdrs.CONTENT_RANGE] = f"bytes {start}-{end - 1}/{media_stream.size}"
+            await response.prepare(request)
+            async for chunk in media_stream.read(start, end):
+                await response.write(chunk)
+            await response.write_eof()
+            return response
 
         @routes.delete("/api/media/{media_id}")
         async def delete_media(request: web.Request) -> web.Response:
@@ -891,6 +1051,24 @@ class TelebotConstructorApp:
             errors = await self.store.errors.load_errors(a.owner_id, a.bot_id, offset, count)
             return web.json_response(text=BotErrorsPage(errors=errors, bot_info=bot_info).model_dump_json())
 
+        @routes.get("/api/block-metrics/{bot_id}")
+        async def get_block_metrics(request: web.Request) -> web.Response:
+            """
+            ---
+            description: Get entering counts and durations for the bot's user flow blocks, by block id
+            produces:
+            - application/json
+            responses:
+                "200":
+                    description: OK
+            """
+            a = await self.authorize(request)
+            block_metrics = await load_block_metrics(
+                bot_prefix=constructed_bot_prefix(a.owner_id, a.bot_id),
+                redis=self.redis,
+            )
+            return web.json_response(body=BlockMetricsSummaries.dump_json(block_metrics))
+
         @routes.post("/api/alert-chat-id/{bot_id}")
         async def set_new_alert_chat_id(request: web.Request) -> web.Response:
             """
@@ -968,7 +1146,8 @@ class TelebotConstructorApp:
             _ = await self.authenticate(request)
             token_payload = await self.parse_body_as_model(request, BotTokenPayload)
             try:
-                await AsyncTeleBot(token=token_payload.token).get_me()
+                # not cached: the token might have been revoked since the last getMe
+                await fetch_bot_user(AsyncTeleBot(token=token_payload.token))
             except Exception as e:
                 raise web.HTTPBadRequest(reason=f"Bot token validation failed ({e})")
             return web.Response(text="Token is valid")
@@ -992,7 +1171,11 @@ class TelebotConstructorApp:
             a = await self.authorize(request)
             bot = await self._make_bare_bot(a.owner_id, a.bot_id)
             try:
-                tg_bot_user = await TgBotUser.fetch(bot, telegram_files_downloader=self.telegram_files_downloader)
+                tg_bot_user = await TgBotUser.fetch(
+                    bot,
+                    telegram_files_downloader=self.telegram_files_downloader,
+                    bot_user_cache=self.bot_user_cache,
+                )
                 return web.json_response(tg_bot_user.model_dump())
             except Exception:
                 logger.exception("Unexpected error retrieving tg bot user info")
@@ -1020,6 +1203,9 @@ class TelebotConstructorApp:
             except Exception:
                 logger.exception("Error updating bot user info")
                 raise web.HTTPInternalServerError(reason="Error updating detailed bot information")
+            finally:
+                # bot name is a part of getMe response, which might be changed even if the update failed midway
+                await self.bot_user_cache.invalidate(bot)
 
         @routes.post("/api/start-group-chat-discovery/{bot_id}")
         async def start_discovering_group_chats(request: web.Request) -> web.Response:
@@ -1187,6 +1373,34 @@ class TelebotConstructorApp:
                 content_type="text/html",
             )
 
+        @routes.get("/api/metrics")
+        async def get_metrics(request: web.Request) -> web.Response:
+            """
+            ---
+            description: Update processing and outgoing messages metrics for all bots in Prometheus text format
+            produces:
+            - text/plain
+            responses:
+                "200":
+                    description: OK
+                "401":
+                    description: Invalid or missing metrics token
+                "404":
+                    description: Metrics token is not configured
+            """
+            if self.metrics_token is None:
+                raise web.HTTPNotFound(reason="Metrics are disabled")
+            # comparing bytes, since compare_digest doesn't accept non-ASCII strings
+            authorization = request.headers.get(hdrs.AUTHORIZATION, "").encode("utf-8", "surrogateescape")
+            if not hmac.compare_digest(authorization, f"Bearer {self.metrics_token}".encode("utf-8")):
+                raise web.HTTPUnauthorized(reason="Metrics token required")
+            return web.Response(
+                text=merge_prometheus_texts(
+                    [self.render_prometheus_metrics(), await self.runner.render_prometheus_metrics()]
+                ),
+                content_type="text/plain",
+            )
+
         @routes.get("/api/version")
         async def api_version(request: web.Request) -> web.Response:
             return web.Response(text=VERSION or "<unset>")
@@ -1252,7 +1466,7 @@ class TelebotConstructorApp:
                     bot_config = await self.store.load_bot_config(owner_id, bot_id, version)
                     if bot_config is None:
                         raise RuntimeError("Bot is marked as running bot no config found")
-                    bot_runner = await self._construct_bot(owner_id, bot_id, bot_config)
+                    bot_runner = await self._bot_runner_to_start(owner_id, bot_id, bot_config)
                     if not await self.runner.start(owner_id=owner_id, bot_id=bot_id, bot_runner=bot_runner):
                         raise RuntimeError(f"Runner {self.runner} refused to start the bot, maybe see error above")
                     started_bots += 1
@@ -1271,12 +1485,23 @@ class TelebotConstructorApp:
         auth_bot_runner = await self.auth.setup_bot()
         if auth_bot_runner is not None:
             logger.info("Starting auth bot")
-            await self.runner.start(owner_id="internal", bot_id="auth-bot", bot_runner=auth_bot_runner)
+            await self.runner.start(owner_id=AUTH_BOT_OWNER_ID, bot_id=AUTH_BOT_ID, bot_runner=auth_bot_runner)
         await self.telegram_files_downloader.setup()
         if self.media_store is not None:
             await self.media_store.setup()
         logger.info("Setup completed")
 
+    async def setup_worker(self) -> None:
+        """Setup for a worker process of a sharded runner, running bots but not the app itself"""
+        await self.telegram_files_downloader.setup()
+        if self.media_store is not None:
+            await self.media_store.setup()
+        self._sync_discovery_modes_task = create_error_logging_task(
+            self.group_chat_discovery_handler.sync_discovery_modes_periodically(),
+            name="Sync group chat discovery modes",
+        )
+        logger.info("Worker setup completed")
+
     async def cleanup(self) -> None:
         logger.info("Cleanup started")
         await self.telegram_files_downloader.cleanup()
@@ -1288,10 +1513,13 @@ class TelebotConstructorApp:
 
     # public methods to run constructor in different scenarios
 
-    async def run_polling(self, port: int) -> None:
-        """Standalone run, polling is used to get updates from Telegram API"""
+    async def run_polling(self, port: int, runner: ConstructedBotRunner | None = None) -> None:
+        """
+        Standalone run, polling is used to get updates from Telegram API; by default all bots are run
+        in the same process, see ShardedPollingConstructedBotRunner for an alternative
+        """
         logger.info("Running telebot constructor with polling")
-        self._runner = PollingConstructedBotRunner()
+        self._runner = runner or PollingConstructedBotRunner()
         await self.setup()
         constructor_web_app = await self.create_constructor_web_app()
         if BASE_PATH:
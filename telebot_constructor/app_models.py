@@ -8,10 +8,12 @@ from telebot import AsyncTeleBot
 from telebot import types as tg
 
 from telebot_constructor.bot_config import BotConfig
+from telebot_constructor.store.bot_users import BotUserCache, fetch_bot_user
 from telebot_constructor.store.errors import BotError
 from telebot_constructor.store.form_results import FormInfo, FormInfoBasic, FormResult
 from telebot_constructor.store.types import BotConfigVersionMetadata, BotEvent
 from telebot_constructor.telegram_files_downloader import TelegramFilesDownloader
+from telebot_constructor.update_metrics import BotUpdateMetricsSummary
 from telebot_constructor.utils.rate_limit_retry import rate_limit_retry
 
 
@@ -63,11 +65,14 @@ class TgBotUser(BaseModel):
     userpic: Optional[str]  # base64-encoded bot's avatar photo preview
 
     @classmethod
-    async def fetch(cls, bot: AsyncTeleBot, telegram_files_downloader: TelegramFilesDownloader) -> "TgBotUser":
+    async def fetch(
+        cls,
+        bot: AsyncTeleBot,
+        telegram_files_downloader: TelegramFilesDownloader,
+        bot_user_cache: BotUserCache | None = None,
+    ) -> "TgBotUser":
         """Fetch data from Telegram Bot API and compose TgBotUser object"""
-        async for attempt in rate_limit_retry():
-            with attempt:
-                bot_user = await bot.get_me()
+        bot_user = await (bot_user_cache.get_me(bot) if bot_user_cache is not None else fetch_bot_user(bot))
         async for attempt in rate_limit_retry():
             with attempt:
                 bot_description = await bot.get_my_description()
@@ -161,6 +166,7 @@ class BotInfo(BaseModel):
     last_errors: list[BotError]
     admin_chat_ids: list[str | int]
     alert_chat_id: str | int | None
+    update_metrics: Optional[BotUpdateMetricsSummary] = None  # None = bot was not run since the constructor start
 
 
 BotInfoList = TypeAdapter(list[BotInfo])
@@ -15,6 +15,7 @@ from telebot_constructor.user_flow.entrypoints.base import UserFlowEntryPoint
 from telebot_constructor.user_flow.entrypoints.catch_all import CatchAllEntryPoint
 from telebot_constructor.user_flow.entrypoints.command import CommandEntryPoint
 from telebot_constructor.user_flow.entrypoints.regex_match import RegexMatchEntryPoint
+from telebot_constructor.utils import AnyChatId
 from telebot_constructor.utils.pydantic import ExactlyOneNonNullFieldModel
 
 
@@ -60,6 +61,9 @@ class UserFlowConfig(BaseModel):
     # not used for bot logic, but still stored
     node_display_coords: dict[str, UserFlowNodePosition]
 
+    # if set, content blocks' media is uploaded to Telegram on bot start by sending (and deleting) it in this chat
+    media_warm_up_chat_id: Optional[AnyChatId] = None
+
     @model_validator(mode="after")
     def config_convertible_to_user_flow(self) -> "UserFlowConfig":
         self.to_user_flow()
@@ -69,6 +73,7 @@ class UserFlowConfig(BaseModel):
         return UserFlow(
             entrypoints=[entrypoint_config.to_user_flow_entrypoint() for entrypoint_config in self.entrypoints],
             blocks=[block_config.to_user_flow_block() for block_config in self.blocks],
+            media_warm_up_chat_id=self.media_warm_up_chat_id,
         )
 
 
@@ -1,20 +1,28 @@
+import datetime
+import hashlib
 import itertools
+import json
 import logging
 from typing import Callable, Coroutine, Optional, Type
 
 from telebot import AsyncTeleBot
+from telebot import types as tg
 from telebot.metrics import TelegramUpdateMetricsHandler
 from telebot.runner import AuxBotEndpoint, BotRunner
 from telebot_components.redis_utils.interface import RedisInterface
 from telebot_components.stores.banned_users import BannedUsersStore
+from telebot_components.stores.generic import KeyDictStore
 from telebot_components.utils.secrets import SecretStore
 
 from telebot_constructor.bot_config import BotConfig
 from telebot_constructor.constants import CONSTRUCTOR_PREFIX
 from telebot_constructor.group_chat_discovery import GroupChatDiscoveryHandler
+from telebot_constructor.outgoing_rate_limiter import OutgoingRateLimiter
+from telebot_constructor.store.bot_users import BotUserCache, fetch_bot_user
 from telebot_constructor.store.errors import BotSpecificErrorsStore
 from telebot_constructor.store.form_results import BotSpecificFormResultsStore
 from telebot_constructor.store.media import UserSpecificMediaStore
+from telebot_constructor.user_flow.block_metrics import BlockMetricsCollector
 from telebot_constructor.user_flow.types import BotCommandInfo
 from telebot_constructor.utils import log_prefix
 from telebot_constructor.utils.rate_limit_retry import rate_limit_retry
@@ -24,6 +32,10 @@ BotFactory = (
 )  # callable must have the same args as AsyncTeleBot constructor but I can't find the proper typing
 
 
+def constructed_bot_prefix(owner_id: str, bot_id: str) -> str:
+    return f"{CONSTRUCTOR_PREFIX}/{owner_id}/{bot_id}"
+
+
 async def make_bare_bot(
     owner_id: str,
     bot_id: str,
@@ -53,10 +65,14 @@ async def construct_bot(
     redis: RedisInterface,
     media_store: UserSpecificMediaStore | None = None,
     group_chat_discovery_handler: GroupChatDiscoveryHandler | None = None,
+    bot_user_cache: BotUserCache | None = None,
+    update_metrics_handler: Optional[TelegramUpdateMetricsHandler] = None,
+    collect_block_metrics: bool = False,
+    outgoing_rate_limiter: Optional[OutgoingRateLimiter] = None,
     _bot_factory: BotFactory = AsyncTeleBot,  # used for testing
 ) -> BotRunner:
     """Core bot construction function responsible for turning a config into a functional bot"""
-    bot_prefix = f"{CONSTRUCTOR_PREFIX}/{owner_id}/{bot_id}"
+    bot_prefix = constructed_bot_prefix(owner_id, bot_id)
     logger = logging.getLogger(__name__ + log_prefix(owner_id, bot_id))
     errors_store.instrument(logger)
     logger.info("Constructing bot")
@@ -66,19 +82,20 @@ async def construct_bot(
         bot_id=bot_id,
         bot_config=bot_config,
         secret_store=secret_store,
+        update_metrics_handler=update_metrics_handler,
         _bot_factory=_bot_factory,
     )
     # FIXME: now it's a global logger!!!
     errors_store.instrument(bot.logger)
+    if outgoing_rate_limiter is not None:
+        outgoing_rate_limiter.instrument(bot, owner_id=owner_id, bot_id=bot_id)
 
     background_jobs: list[Coroutine[None, None, None]] = []
     aux_endpoints: list[AuxBotEndpoint] = []
     bot_commands: list[BotCommandInfo] = []
 
     try:
-        async for attempt in rate_limit_retry():
-            with attempt:
-                bot_user = await bot.get_me()
+        bot_user = await (bot_user_cache.get_me(bot) if bot_user_cache is not None else fetch_bot_user(bot))
         logger.info(f"Bot user loaded: {bot_user.to_json()}")
     except Exception:
         logger.exception("Error getting bot user, probably an invalid token")
@@ -90,6 +107,12 @@ async def construct_bot(
         logger.info("Parsing user flow config")
         user_flow = bot_config.user_flow_config.to_user_flow()
 
+        block_metrics_collector = (
+            BlockMetricsCollector(bot_prefix=bot_prefix, redis=redis) if collect_block_metrics else None
+        )
+        if block_metrics_collector is not None:
+            background_jobs.append(block_metrics_collector.flush_periodically())
+
         logger.info("Setting up user flow")
         user_flow_setup_result = await user_flow.setup(
             bot_prefix=bot_prefix,
@@ -99,6 +122,7 @@ async def construct_bot(
             form_results_store=form_results_store,
             errors_store=errors_store,
             media_store=media_store,
+            block_instrumentation=block_metrics_collector,
         )
 
         logger.info(f"Got result: {user_flow_setup_result}")
@@ -106,16 +130,66 @@ async def construct_bot(
         aux_endpoints.extend(user_flow_setup_result.aux_endpoints)
         bot_commands.extend(user_flow_setup_result.bot_commands)
 
-    # TODO: cleanup for possible stale bot commands (maybe on an explicit user action?)
+    await apply_bot_commands(
+        bot=bot,
+        bot_user_id=bot_user.id,
+        bot_commands=bot_commands,
+        applied_bot_commands_store=applied_bot_commands_store(bot_prefix=bot_prefix, redis=redis),
+        logger=logger,
+    )
+
+    if group_chat_discovery_handler is not None:
+        await group_chat_discovery_handler.setup_handlers(owner_id=owner_id, bot_id=bot_id, bot=bot)
+
+    return BotRunner(
+        bot_prefix=bot_prefix,
+        bot=bot,
+        background_jobs=background_jobs,
+        aux_endpoints=aux_endpoints,
+    )
+
+
+def applied_bot_commands_store(bot_prefix: str, redis: RedisInterface) -> KeyDictStore[str]:
+    # bot user id -> command scope key -> hash of the last command list set for this scope
+    return KeyDictStore[str](
+        name="applied-bot-commands",
+        prefix=bot_prefix,
+        redis=redis,
+        # commands might be changed outside of constructor, so we periodically re-apply them anyway
+        expiration_time=datetime.timedelta(days=7),
+        dumper=str,
+        loader=str,
+    )
+
+
+def bot_commands_hash(command_infos: list[BotCommandInfo]) -> str:
+    commands_json = json.dumps([ci.command.to_json() for ci in command_infos])
+    return hashlib.sha256(commands_json.encode("utf-8")).hexdigest()
+
+
+async def apply_bot_commands(
+    bot: AsyncTeleBot,
+    bot_user_id: int,
+    bot_commands: list[BotCommandInfo],
+    applied_bot_commands_store: KeyDictStore[str],
+    logger: logging.Logger,
+) -> None:
+    """Set bot commands for each scope and delete them from scopes not used anymore, skipping unchanged scopes"""
     logger.info(f"Setting bot commands: {'; '.join(str(bc) for bc in bot_commands)}")
-    for _, scoped_commands_it in itertools.groupby(
-        sorted(
-            bot_commands,
+    applied_hashes = await applied_bot_commands_store.load(bot_user_id)
+    commands_by_scope_key = {
+        scope_key: list(scoped_commands_it)
+        for scope_key, scoped_commands_it in itertools.groupby(
+            sorted(bot_commands, key=BotCommandInfo.scope_key),
             key=BotCommandInfo.scope_key,
-        ),
-        key=BotCommandInfo.scope_key,
-    ):
-        command_info_batch = list(scoped_commands_it)
+        )
+    }
+
+    for scope_key, command_info_batch in commands_by_scope_key.items():
+        commands_hash = bot_commands_hash(command_info_batch)
+        if applied_hashes.get(scope_key) == commands_hash:
+            logger.info(f"Bot commands for scope {scope_key or 'default'} are unchanged, not setting them")
+            continue
         logger.info(f"Bot command batch: {'; '.join(str(bc) for bc in command_info_batch)}")
         async for attempt in rate_limit_retry():
             with attempt:
@@ -123,13 +197,12 @@ async def construct_bot(
                     commands=[cmd.command for cmd in command_info_batch],
                     scope=command_info_batch[0].scope,
                 )
+        await applied_bot_commands_store.set_subkey(bot_user_id, scope_key, commands_hash)
 
-    if group_chat_discovery_handler is not None:
-        group_chat_discovery_handler.setup_handlers(owner_id=owner_id, bot_id=bot_id, bot=bot)
-
-    return BotRunner(
-        bot_prefix=bot_prefix,
-        bot=bot,
-        background_jobs=background_jobs,
-        aux_endpoints=aux_endpoints,
-    )
+    for stale_scope_key in set(applied_hashes).difference(commands_by_scope_key):
+        logger.info(f"Deleting bot commands for stale scope {stale_scope_key or 'default'}")
+        scope = tg.BotCommandScope(**json.loads(stale_scope_key)) if stale_scope_key else None
+        async for attempt in rate_limit_retry():
+            with attempt:
+                await bot.delete_my_commands(scope=scope)
+        await applied_bot_commands_store.remove_subkey(bot_user_id, stale_scope_key)
@@ -1,5 +1,7 @@
+import asyncio
 import datetime
 import logging
+import time
 from typing import Optional
 
 from telebot import AsyncTeleBot
@@ -7,7 +9,11 @@ from telebot import api as tg_api
 from telebot import types as tg
 from telebot.types import constants as tg_const
 from telebot_components.redis_utils.interface import RedisInterface
-from telebot_components.stores.generic import KeyFlagStore, KeySetStore
+from telebot_components.stores.generic import (
+    KeyIntegerStore,
+    KeySetStore,
+    KeyValueStore,
+)
 
 from telebot_constructor.app_models import TgGroupChat, TgGroupChatType
 from telebot_constructor.constants import CONSTRUCTOR_PREFIX
@@ -29,15 +35,30 @@ class GroupChatDiscoveryHandler:
     """
 
     STORE_PREFIX = f"{CONSTRUCTOR_PREFIX}/group-chat-discovery"
+    DISCOVERY_MODE_DURATION = datetime.timedelta(days=10)
+    DISCOVERY_MODE_CHANGES_KEY = "all"
 
     def __init__(self, redis: RedisInterface, telegram_files_downloader: TelegramFilesDownloader) -> None:
-        # "{username}-{bot name}" -> flag for group chat discovery mode
-        self._bots_in_discovery_mode_store = KeyFlagStore(
-            name="bot-in-discovery-mode",
+        # "{username}-{bot name}" -> group chat discovery mode deadline timestamp, expiring with it
+        self._discovery_mode_deadlines_store = KeyValueStore[float](
+            name="discovery-mode-deadline",
+            prefix=self.STORE_PREFIX,
+            redis=redis,
+            expiration_time=self.DISCOVERY_MODE_DURATION,
+            dumper=str,
+            loader=float,
+        )
+        # in-process mirror of the store above: "{username}-{bot name}" -> discovery mode deadline timestamp;
+        # handlers run on every matching update for every bot, so they check this instead of doing Redis I/O
+        self._discovery_mode_deadlines: dict[str, float] = dict()
+        # counter of discovery mode changes, for processes other than the one changing it to sync their mirrors
+        self._discovery_mode_changes_store = KeyIntegerStore(
+            name="discovery-mode-changes",
             prefix=self.STORE_PREFIX,
             redis=redis,
-            expiration_time=datetime.timedelta(days=10),
+            expiration_time=None,
         )
+        self._synced_discovery_mode_changes: int | None = None
         # "{username}-{bot name}" -> set of discovered group chat ids
         self._available_group_chat_ids = KeySetStore[AnyChatId](
             name="available-group-chat-ids",
@@ -52,14 +73,67 @@ class GroupChatDiscoveryHandler:
     def _full_key(self, username: str, bot_id: str) -> str:
         return f"{username}-{bot_id}"
 
+    async def _load_discovery_mode_deadline(self, key: str) -> Optional[float]:
+        deadline = await self._discovery_mode_deadlines_store.load(key)
+        if deadline is None or time.time() > deadline:
+            return None
+        return deadline
+
     async def start_discovery(self, username: str, bot_id: str) -> None:
-        await self._bots_in_discovery_mode_store.set_flag(self._full_key(username, bot_id))
+        key = self._full_key(username, bot_id)
+        deadline = time.time() + self.DISCOVERY_MODE_DURATION.total_seconds()
+        await self._discovery_mode_deadlines_store.save(key, deadline)
+        self._discovery_mode_deadlines[key] = deadline
+        await self._discovery_mode_changes_store.increment(self.DISCOVERY_MODE_CHANGES_KEY)
 
     async def stop_discovery(self, username: str, bot_id: str) -> None:
-        await self._bots_in_discovery_mode_store.unset_flag(self._full_key(username, bot_id))
-
-    async def is_discovering(self, username: str, bot_id: str) -> bool:
-        return await self._bots_in_discovery_mode_store.is_flag_set(self._full_key(username, bot_id))
+        key = self._full_key(username, bot_id)
+        self._discovery_mode_deadlines.pop(key, None)
+        await self._discovery_mode_deadlines_store.drop(key)
+        await self._discovery_mode_changes_store.increment(self.DISCOVERY_MODE_CHANGES_KEY)
+
+    def is_discovering(self, username: str, bot_id: str) -> bool:
+        key = self._full_key(username, bot_id)
+        deadline = self._discovery_mode_deadlines.get(key)
+        if deadline is None:
+            return False
+        if time.time() > deadline:
+            # mirroring flag expiration in the store
+            self._discovery_mode_deadlines.pop(key, None)
+            return False
+        return True
+
+    async def load_discovery_mode(self, username: str, bot_id: str) -> None:
+        """Sync in-process discovery mode state with the store, e.g. after the constructor restart"""
+        key = self._full_key(username, bot_id)
+        if key in self._discovery_mode_deadlines:
+            return
+        deadline = await self._load_discovery_mode_deadline(key)
+        if deadline is not None:
+            self._discovery_mode_deadlines[key] = deadline
+
+    async def sync_discovery_modes(self) -> None:
+        """Reload discovery mode state from the store if it was changed by another process"""
+        changes = await self._discovery_mode_changes_store.load(self.DISCOVERY_MODE_CHANGES_KEY)
+        if changes == self._synced_discovery_mode_changes:
+            return
+        self._synced_discovery_mode_changes = changes
+        deadlines: dict[str, float] = dict()
+        for key in await self._discovery_mode_deadlines_store.list_keys():
+            deadline = await self._load_discovery_mode_deadline(key)
+            if deadline is not None:
+                deadlines[key] = deadline
+        self._discovery_mode_deadlines = deadlines
+
+    async def sync_discovery_modes_periodically(
+        self, interval: datetime.timedelta = datetime.timedelta(seconds=5)
+    ) -> None:
+        while True:
+            try:
+                await self.sync_discovery_modes()
+            except Exception:
+                logger.exception("Error syncing discovery modes")
+            await asyncio.sleep(interval.total_seconds())
 
     async def save_discovered_chat(self, username: str, bot_id: str, chat_id: AnyChatId) -> None:
         await self._available_group_chat_ids.add(self._full_key(username, bot_id), chat_id)
@@ -108,14 +182,16 @@ class GroupChatDiscoveryHandler:
                 chats.append(chat)
         return chats
 
-    def setup_handlers(self, owner_id: str, bot_id: str, bot: AsyncTeleBot) -> None:
+    async def setup_handlers(self, owner_id: str, bot_id: str, bot: AsyncTeleBot) -> None:
+        await self.load_discovery_mode(owner_id, bot_id)
+
         @bot.my_chat_member_handler()
         @non_capturing_handler
         async def discover_group_chats_on_add(cmu: tg.ChatMemberUpdated) -> None:
             if (
                 tg_const.ChatType(cmu.chat.type) is not tg_const.ChatType.private
                 and cmu.new_chat_member.status in {"creator", "administrator", "member", "restricted"}
-                and await self.is_discovering(owner_id, bot_id)
+                and self.is_discovering(owner_id, bot_id)
             ):
                 logger.info(f"Discovered chat from being added: {cmu.chat.id}")
                 await self.save_discovered_chat(owner_id, bot_id, chat_id=cmu.chat.id)
@@ -126,7 +202,7 @@ class GroupChatDiscoveryHandler:
         @bot.message_handler(commands=["discover_chat"])
         @non_capturing_handler
         async def discover_group_chat_on_explicit_cmd(message: tg.Message) -> None:
-            if tg_const.ChatType(message.chat.type) is not tg_const.ChatType.private and await self.is_discovering(
+            if tg_const.ChatType(message.chat.type) is not tg_const.ChatType.private and self.is_discovering(
                 owner_id, bot_id
             ):
                 logger.info(f"Discovered chat from explicit command: {message.chat.id}")
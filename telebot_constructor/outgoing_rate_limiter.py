@@ -0,0 +1,210 @@
+import asyncio
+import functools
+import time
+from typing import Any, Awaitable, Callable, Optional, Union
+
+from telebot import AsyncTeleBot
+
+from telebot_constructor.update_metrics import (
+    DurationHistogram,
+    prometheus_histogram_lines,
+    prometheus_labels,
+)
+
+# methods sending a message (or a group of them) to the chat passed as the first argument
+PACED_METHOD_NAMES = (
+    "send_message",
+    "forward_message",
+    "copy_message",
+    "send_photo",
+    "send_audio",
+    "send_document",
+    "send_sticker",
+    "send_video",
+    "send_animation",
+    "send_video_note",
+    "send_voice",
+    "send_media_group",
+    "send_location",
+    "send_venue",
+    "send_contact",
+    "send_poll",
+    "send_dice",
+)
+
+# idle (i.e. full) chat buckets are dropped when there are more than this many of them for a bot
+MAX_TRACKED_CHATS = 10_000
+
+
+class TokenBucket:
+    """
+    Token bucket allowing bursts of up to capacity requests and rate requests per second on average.
+    Tokens are reserved in advance, so the callers wait for their turn in the order of reservation.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity  # negative when reserved by waiting callers
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, tokens: float = 1) -> float:
+        """Take tokens, returns the delay in seconds before the reserved tokens become available"""
+        self._refill(time.monotonic())
+        self.tokens -= tokens
+        return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, tokens: float = 1) -> None:
+        self.tokens += tokens
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+async def _take(bucket: TokenBucket, tokens: float) -> float:
+    delay = bucket.reserve(tokens)
+    if delay > 0:
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            bucket.refund(tokens)
+            raise
+    return delay
+
+
+class BotOutgoingRateLimits:
+    """Buckets and throttling metrics for a single bot; kept across bot restarts so that limits are not reset"""
+
+    def __init__(self, limiter: "OutgoingRateLimiter") -> None:
+        self.limiter = limiter
+        self.bot_bucket = TokenBucket(rate=limiter.bot_rate, capacity=limiter.bot_rate)
+        self.chat_buckets: dict[Union[int, str], TokenBucket] = dict()
+        self.requests = 0
+        self.throttled_duration = DurationHistogram()  # only for requests that had to wait
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is not None:
+            return bucket
+        if len(self.chat_buckets) >= MAX_TRACKED_CHATS:
+            self.chat_buckets = {
+                chat_id: bucket for chat_id, bucket in self.chat_buckets.items() if not bucket.is_full()
+            }
+        # private chats have positive ids, groups and channels have negative ids or @usernames
+        if isinstance(chat_id, int) and chat_id > 0:
+            bucket = TokenBucket(rate=self.limiter.private_chat_rate, capacity=self.limiter.private_chat_burst)
+        else:
+            bucket = TokenBucket(rate=self.limiter.group_chat_rate, capacity=self.limiter.group_chat_burst)
+        self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def pace(self, chat_id: Optional[Union[int, str]], messages: int = 1) -> None:
+        """Wait until the request sending a number of messages to the chat fits into both chat's and bot's limits"""
+        self.requests += 1
+        delay = 0.0
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        if chat_bucket is not None:
+            delay += await _take(chat_bucket, messages)
+        # bot-wide tokens are taken only after waiting for the chat ones, not to hold back requests to other chats
+        try:
+            delay += await _take(self.bot_bucket, messages)
+        except asyncio.CancelledError:
+            if chat_bucket is not None:
+                chat_bucket.refund(messages)
+            raise
+        if delay > 0:
+            self.throttled_duration.observe(delay)
+
+
+class OutgoingRateLimiter:
+    """
+    Proactively paces messages sent by constructed bots to stay within Telegram's limits, instead of hitting
+    "Too Many Requests" errors and waiting for retry_after (which is still done by rate_limit_retry where used).
+    Requests over the limit are delayed, not rejected.
+
+    Defaults follow Telegram's FAQ: about 30 messages per second for a bot, one message per second for a
+    private chat (with short bursts allowed), and 20 messages per minute for a group.
+
+    NOTE: limits are local to the process, so bots running in worker processes of the sharded runner
+    are paced by their worker's limiter, and their metrics are requested from the worker by the runner.
+    """
+
+    METRIC_PREFIX = "telebot_constructor"
+
+    def __init__(
+        self,
+        bot_rate: float = 30,
+        private_chat_rate: float = 1,
+        private_chat_burst: float = 3,
+        group_chat_rate: float = 20 / 60,
+        group_chat_burst: float = 20,
+    ) -> None:
+        if min(bot_rate, private_chat_rate, private_chat_burst, group_chat_rate, group_chat_burst) <= 0:
+            raise ValueError("Rates and bursts must be positive")
+        self.bot_rate = bot_rate
+        self.private_chat_rate = private_chat_rate
+        self.private_chat_burst = private_chat_burst
+        self.group_chat_rate = group_chat_rate
+        self.group_chat_burst = group_chat_burst
+        self._limits: dict[tuple[str, str], BotOutgoingRateLimits] = dict()
+
+    def limits_for(self, owner_id: str, bot_id: str) -> BotOutgoingRateLimits:
+        limits = self._limits.get((owner_id, bot_id))
+        if limits is None:
+            limits = BotOutgoingRateLimits(self)
+            self._limits[(owner_id, bot_id)] = limits
+        return limits
+
+    def instrument(self, bot: AsyncTeleBot, owner_id: str, bot_id: str) -> None:
+        """Wrap bot's message sending methods so that they wait for their turn before the request"""
+        limits = self.limits_for(owner_id, bot_id)
+        for method_name in PACED_METHOD_NAMES:
+            method = getattr(bot, method_name, None)
+            if method is not None:
+                setattr(bot, method_name, self._paced(limits, method_name, method))
+
+    @staticmethod
+    def _paced(
+        limits: BotOutgoingRateLimits, method_name: str, method: Callable[..., Awaitable[Any]]
+    ) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(method)
+        async def paced(*args: Any, **kwargs: Any) -> Any:
+            chat_id = kwargs.get("chat_id", args[0] if args else None)
+            messages = 1
+            if method_name == "send_media_group":
+                # each item of a media group is a separate message for Telegram's limits
+                media = kwargs.get("media", args[1] if len(args) > 1 else None)
+                messages = max(1, len(media or []))
+            await limits.pace(chat_id, messages)
+            return await method(*args, **kwargs)
+
+        return paced
+
+    def drop(self, owner_id: str, bot_id: str) -> None:
+        self._limits.pop((owner_id, bot_id), None)
+
+    def render_prometheus(self) -> str:
+        """Metrics in Prometheus text exposition format"""
+        p = self.METRIC_PREFIX
+        lines: list[str] = []
+
+        lines.append(f"# HELP {p}_outgoing_messages_total Message sending requests made by the bot")
+        lines.append(f"# TYPE {p}_outgoing_messages_total counter")
+        for (owner_id, bot_id), limits in self._limits.items():
+            labels = prometheus_labels(owner_id=owner_id, bot_id=bot_id)
+            lines.append(f"{p}_outgoing_messages_total{{{labels}}} {limits.requests}")
+
+        lines.append(f"# HELP {p}_outgoing_throttled_seconds Time message sending requests waited for rate limits")
+        lines.append(f"# TYPE {p}_outgoing_throttled_seconds histogram")
+        for (owner_id, bot_id), limits in self._limits.items():
+            labels = prometheus_labels(owner_id=owner_id, bot_id=bot_id)
+            lines.extend(
+                prometheus_histogram_lines(f"{p}_outgoing_throttled_seconds", labels, limits.throttled_duration)
+            )
+
+        return "\n".join(lines) + "\n"
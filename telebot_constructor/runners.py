@@ -1,59 +1,382 @@
 import abc
 import asyncio
+import bisect
 import collections
+import contextlib
+import hashlib
+import itertools
 import logging
+import multiprocessing
+import multiprocessing.process
+import time
+from dataclasses import dataclass, field
+from multiprocessing.connection import Connection
+from typing import Any, Awaitable, Callable, Literal, Optional
 
+from telebot import types as tg
 from telebot.runner import BotRunner
+from telebot.util import create_error_logging_task
 from telebot.webhook import WebhookApp
 
+from telebot_constructor.update_metrics import (
+    BotUpdateMetricsSummary,
+    merge_prometheus_texts,
+)
+from telebot_constructor.update_scheduler import (
+    BotKey,
+    FairUpdateScheduler,
+    UpdateSchedulerConfig,
+)
 from telebot_constructor.utils import log_prefix
 
 
+class BotConstructionError(Exception):
+    """Raised by the runners reconstructing bots on their own (see reconstructs_bots) if the bot can't be constructed"""
+
+
 class ConstructedBotRunner(abc.ABC):
+    """
+    Runs bots constructed by the app. Subclasses must implement start, stop and cleanup; the other methods
+    have defaults and were added later, so that existing subclasses keep working:
+    - swap: stops the bot and starts it again by default
+    - is_running: raises NotImplementedError by default, in which case the app assumes that the bot keeps running
+      after a failed restart
+    - render_prometheus_metrics and update_metrics_summary: no metrics by default
+    - reconstructs_bots: False by default, see below
+    """
+
+    # if set, the runner constructs bots on its own and only uses the passed bot runners' background jobs,
+    # so the app passes a bare bot instead of fully constructing it
+    reconstructs_bots: bool = False
+
     @abc.abstractmethod
     async def start(self, owner_id: str, bot_id: str, bot_runner: BotRunner) -> bool: ...
 
     @abc.abstractmethod
     async def stop(self, owner_id: str, bot_id: str) -> bool: ...
 
+    async def is_running(self, owner_id: str, bot_id: str) -> bool:
+        raise NotImplementedError(f"{self.__class__.__name__} does not report running bots")
+
     @abc.abstractmethod
     async def cleanup(self) -> None: ...
 
+    async def swap(self, owner_id: str, bot_id: str, bot_runner: BotRunner) -> bool:
+        """
+        Replace the running bot with a new runner (e.g. for a new config version) or just start it if it's not
+        running. Subclasses should override it to avoid downtime between stopping the old bot and starting the new one.
+        """
+        await self.stop(owner_id, bot_id)
+        return await self.start(owner_id, bot_id, bot_runner)
+
+    async def render_prometheus_metrics(self) -> str:
+        """
+        Runner-specific metrics in Prometheus text exposition format, if any, incl. metrics of bots running
+        outside of the app process
+        """
+        return ""
+
+    async def update_metrics_summary(self, owner_id: str, bot_id: str) -> Optional[BotUpdateMetricsSummary]:
+        """Update metrics of the bot if it's running outside of the app process, so that the app doesn't have them"""
+        return None
+
+
+@dataclass
+class DrainReport:
+    duration: float  # seconds from the stop request to the polling end
+    processed_batches: int  # update batches that were in progress and finished within the deadline
+    cancelled_batches: int  # update batches that were in progress and cancelled on the deadline
+    unstarted_updates: int = 0  # updates queued in the scheduler and left unconfirmed (or handed over) on drain
+
+
+class DrainablePolling:
+    """
+    Polling loop for a single bot, equivalent to BotRunner.run_polling, but able to stop gracefully: on drain,
+    it stops getting new updates, waits for in-progress updates to be processed, and only cancels them on deadline.
+
+    If a scheduler is passed, each update is processed in a slot acquired from it under the bot key, and new
+    updates are not requested while the bot's queue in the scheduler is full. Telegram considers all updates before
+    the requested offset confirmed, so polling continues from the earliest update not yet started (see next_offset)
+    and skips the updates it has already received. Updates still queued when drain is requested are not processed
+    and stay unconfirmed, so they are received again by the next polling.
+    """
+
+    INTERVAL_SEC = 3
+    TIMEOUT_SEC = 60
+    REQUEST_TIMEOUT_SEC = 120
+    MAX_ERROR_RETRY_COUNT = 10
+
+    def __init__(
+        self,
+        bot_runner: BotRunner,
+        drain_timeout: float,
+        scheduler: Optional[FairUpdateScheduler] = None,
+        bot_key: Optional[BotKey] = None,
+    ) -> None:
+        self.bot_runner = bot_runner
+        self.bot = bot_runner.bot
+        self.drain_timeout = drain_timeout
+        self.scheduler = scheduler
+        self.bot_key: BotKey = bot_key or ("", bot_runner.bot_prefix)
+        self.drain_report: DrainReport | None = None
+        self.logger = logging.getLogger(f"{__name__}.{self.__class__.__qualname__}[{bot_runner.bot_prefix}]")
+        self.polling_stopped = asyncio.Event()
+        self._drain_requested = asyncio.Event()
+        self._drain_requested_at: float | None = None
+        self._confirm_updates = True
+        self._processing_tasks: set[asyncio.Task[None]] = set()
+        self._unstarted_update_ids: set[int] = set()
+        self._unstarted_update_tasks: dict[int, asyncio.Task[None]] = dict()
+
+    @property
+    def next_offset(self) -> Optional[int]:
+        """
+        Offset to confirm updates up to and to continue polling from: updates are started in order, so all updates
+        before the earliest unstarted one have been processed (or are being processed)
+        """
+        if self._unstarted_update_ids:
+            return min(self._unstarted_update_ids)
+        return self.bot.offset
+
+    def request_drain(self, confirm_updates: bool = True) -> None:
+        """
+        Processed updates are confirmed to Telegram when the polling ends; this must be disabled if another instance
+        of the bot continues polling from the same offset
+        """
+        self._confirm_updates = confirm_updates
+        if not self._drain_requested.is_set():
+            self._drain_requested_at = time.monotonic()
+            self._drain_requested.set()
+
+    async def run(self) -> None:
+        background_job_tasks = [
+            create_error_logging_task(job, name=f"{self.bot_runner.bot_prefix}-{idx + 1}")
+            for idx, job in enumerate(self.bot_runner.background_jobs)
+        ]
+        try:
+            try:
+                await self._poll()
+            finally:
+                self.polling_stopped.set()
+            await self._drain()
+        finally:
+            for task in self._processing_tasks:
+                task.cancel()
+            for task in background_job_tasks:
+                if task.cancel():
+                    await task
+
+    async def _poll(self) -> None:
+        error_retry_count = 0
+        while not self._drain_requested.is_set():
+            if self.scheduler is not None and not await self._wait_for_queue_space(self.scheduler):
+                return
+            get_updates = asyncio.create_task(
+                self.bot.get_updates(
+                    offset=self.next_offset,
+                    timeout=self.TIMEOUT_SEC,
+                    request_timeout=self.REQUEST_TIMEOUT_SEC,
+                    bot_prefix=self.bot_runner.bot_prefix,
+                )
+            )
+            drain_requested = asyncio.create_task(self._drain_requested.wait())
+            try:
+                await asyncio.wait([get_updates, drain_requested], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                drain_requested.cancel()
+                if not get_updates.done():
+                    # updates are confirmed by the next request, so the ones being received now are not lost
+                    get_updates.cancel()
+            if get_updates.cancelled():
+                return
+            try:
+                updates = get_updates.result()
+                if self.bot.offset is not None:
+                    # unstarted updates are received again until they are started
+                    updates = [update for update in updates if update.update_id >= self.bot.offset]
+                if updates:
+                    self.bot.offset = updates[-1].update_id + 1
+                    if self.scheduler is not None:
+                        self._unstarted_update_ids.update(update.update_id for update in updates)
+                    task = asyncio.create_task(self._process_batch(updates))
+                    self._processing_tasks.add(task)
+                    task.add_done_callback(self._processing_tasks.discard)
+                error_retry_count = 0
+            except TimeoutError:
+                self.logger.debug("Long polling timed out, sending new request")
+            except Exception:
+                self.logger.exception("Unexpected exception while processing updates")
+                if error_retry_count >= self.MAX_ERROR_RETRY_COUNT:
+                    self.logger.info("Max retry count exceeded, exiting")
+                    return
+                error_retry_count += 1
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self._drain_requested.wait(), timeout=self.INTERVAL_SEC)
+
+    async def _wait_for_queue_space(self, scheduler: FairUpdateScheduler) -> bool:
+        """Returns False if drain was requested before the queue had space"""
+        queue_space = asyncio.create_task(scheduler.wait_for_queue_space(self.bot_key))
+        drain_requested = asyncio.create_task(self._drain_requested.wait())
+        try:
+            await asyncio.wait([queue_space, drain_requested], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            queue_space.cancel()
+            drain_requested.cancel()
+        return not self._drain_requested.is_set()
+
+    async def _process_batch(self, updates: list[tg.Update]) -> None:
+        scheduler = self.scheduler
+        if scheduler is None:
+            await self.bot.process_new_updates(updates)
+            return
+
+        async def process_update(update: tg.Update) -> None:
+            if self._drain_requested.is_set():
+                return
+            async with scheduler.slot(self.bot_key):
+                if self._drain_requested.is_set():
+                    return
+                self._unstarted_update_ids.discard(update.update_id)
+                self._unstarted_update_tasks.pop(update.update_id, None)
+                await self.bot.process_new_updates([update])
+
+        tasks: list[asyncio.Task[None]] = []
+        for update in updates:
+            task = asyncio.create_task(process_update(update))
+            self._unstarted_update_tasks[update.update_id] = task
+            tasks.append(task)
+        try:
+            # unstarted updates are cancelled on drain, this must not cancel the ones already in progress
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _drain(self) -> None:
+        for task in self._unstarted_update_tasks.values():
+            task.cancel()
+        self._unstarted_update_tasks.clear()
+        in_progress = set(self._processing_tasks)
+        pending: set[asyncio.Task[None]] = set()
+        if in_progress:
+            self.logger.info(f"Waiting for {len(in_progress)} update batch(es) to be processed")
+            _, pending = await asyncio.wait(in_progress, timeout=self.drain_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.logger.warning(f"Cancelled {len(pending)} update batch(es) still processing after the deadline")
+                await asyncio.gather(*pending, return_exceptions=True)
+        offset = self.next_offset
+        if self._confirm_updates and offset is not None:
+            try:
+                # confirming processed updates to Telegram, otherwise they are received again on the next start;
+                # the update received with this request (if any) is not confirmed and will be received again
+                await self.bot.get_updates(offset=offset, limit=1, timeout=0)
+            except Exception:
+                self.logger.info("Failed to confirm processed updates", exc_info=True)
+        self.drain_report = DrainReport(
+            duration=time.monotonic() - (self._drain_requested_at or time.monotonic()),
+            processed_batches=len(in_progress) - len(pending),
+            cancelled_batches=len(pending),
+            unstarted_updates=len(self._unstarted_update_ids),
+        )
+
 
 class PollingConstructedBotRunner(ConstructedBotRunner):
-    """Runner for standalone deployment without wrapping into WebhookApp"""
+    """
+    Runner for standalone deployment without wrapping into WebhookApp. Stopping the bot drains it,
+    giving updates being processed up to drain_timeout seconds to finish. Updates of all bots are processed
+    through a shared fair scheduler, so that a bot flooded with updates doesn't slow down the others.
+    """
 
-    def __init__(self) -> None:
-        self.running_bot_tasks: dict[str, dict[str, asyncio.Task[None]]] = collections.defaultdict(dict)
+    def __init__(self, drain_timeout: float = 10.0, scheduler: Optional[FairUpdateScheduler] = None) -> None:
+        self.drain_timeout = drain_timeout
+        self.scheduler = scheduler or FairUpdateScheduler()
+        self.running_bots: dict[str, dict[str, tuple[DrainablePolling, asyncio.Task[None]]]] = collections.defaultdict(
+            dict
+        )
         self.logger = logging.getLogger(f"{__name__}.{self.__class__.__qualname__}")
 
+    async def is_running(self, owner_id: str, bot_id: str) -> bool:
+        return bot_id in self.running_bots.get(owner_id, {})
+
     async def start(self, owner_id: str, bot_id: str, bot_runner: BotRunner) -> bool:
-        if bot_id in self.running_bot_tasks.get(owner_id, {}):
+        if await self.is_running(owner_id, bot_id):
             return False
 
-        bot_running_task = asyncio.create_task(bot_runner.run_polling(), name=f"{log_prefix(owner_id, bot_id)} polling")
-        self.running_bot_tasks[owner_id][bot_id] = bot_running_task
-        bot_running_task.add_done_callback(lambda _task: self.running_bot_tasks[owner_id].pop(bot_id, None))
+        polling = DrainablePolling(
+            bot_runner,
+            drain_timeout=self.drain_timeout,
+            scheduler=self.scheduler,
+            bot_key=(owner_id, bot_id),
+        )
+        bot_running_task = asyncio.create_task(polling.run(), name=f"{log_prefix(owner_id, bot_id)} polling")
+        self.running_bots[owner_id][bot_id] = (polling, bot_running_task)
+
+        def on_done(_task: asyncio.Task[None]) -> None:
+            if self.running_bots[owner_id].get(bot_id, (None, None))[1] is bot_running_task:
+                self.running_bots[owner_id].pop(bot_id)
+
+        bot_running_task.add_done_callback(on_done)
         return True
 
     async def stop(self, owner_id: str, bot_id: str) -> bool:
-        bot_running_task = self.running_bot_tasks.get(owner_id, {}).pop(bot_id, None)
-        if bot_running_task is None:
+        polling_and_task = self.running_bots.get(owner_id, {}).pop(bot_id, None)
+        if polling_and_task is None:
             return False
-        else:
-            is_cancelled = bot_running_task.cancel()
-            if not is_cancelled:
-                return False
-            try:
-                await bot_running_task
-            except asyncio.CancelledError:
-                pass
-            return True
+        polling, bot_running_task = polling_and_task
+        if bot_running_task.done():
+            return False
+        polling.request_drain()
+        await self._wait_drained(owner_id, bot_id, polling, bot_running_task)
+        if not await self.is_running(owner_id, bot_id):
+            self.scheduler.drop((owner_id, bot_id))
+        return True
+
+    async def swap(self, owner_id: str, bot_id: str, bot_runner: BotRunner) -> bool:
+        polling_and_task = self.running_bots.get(owner_id, {}).pop(bot_id, None)
+        if polling_and_task is None:
+            return await self.start(owner_id, bot_id, bot_runner)
+        old_polling, old_bot_running_task = polling_and_task
+        # the same bot can't have concurrent long polling requests, so the old one stops polling first and the new
+        # one continues from its offset (including updates queued but not started by the old one), while the old one
+        # finishes processing in-progress updates in parallel
+        old_polling.request_drain(confirm_updates=False)
+        polling_stopped = asyncio.create_task(old_polling.polling_stopped.wait())
+        try:
+            await asyncio.wait([polling_stopped, old_bot_running_task], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            polling_stopped.cancel()
+        bot_runner.bot.offset = old_polling.next_offset
+        started = await self.start(owner_id, bot_id, bot_runner)
+        await self._wait_drained(owner_id, bot_id, old_polling, old_bot_running_task)
+        return started
+
+    async def _wait_drained(
+        self, owner_id: str, bot_id: str, polling: DrainablePolling, bot_running_task: asyncio.Task[None]
+    ) -> None:
+        try:
+            await bot_running_task
+        except asyncio.CancelledError:
+            current_task = asyncio.current_task()
+            if current_task is not None and current_task.cancelling():
+                raise
+        except Exception:
+            self.logger.exception(f"{log_prefix(owner_id, bot_id)} Error stopping bot")
+        if polling.drain_report is not None:
+            self.logger.info(f"{log_prefix(owner_id, bot_id)} Bot drained: {polling.drain_report}")
 
     async def cleanup(self) -> None:
-        for bot_tasks in list(self.running_bot_tasks.values()):
-            for task in list(bot_tasks.values()):
-                task.cancel()
+        await asyncio.gather(
+            *[
+                self.stop(owner_id, bot_id)
+                for owner_id, bots in list(self.running_bots.items())
+                for bot_id in list(bots.keys())
+            ]
+        )
+
+    async def render_prometheus_metrics(self) -> str:
+        return self.scheduler.render_prometheus()
 
 
 class WebhookAppConstructedBotRunner(ConstructedBotRunner):
@@ -77,6 +400,316 @@ class WebhookAppConstructedBotRunner(ConstructedBotRunner):
         else:
             return await self.webhook_app.remove_bot_runner(bot_runner)
 
+    async def is_running(self, owner_id: str, bot_id: str) -> bool:
+        bot_runner = self.added_runners.get(owner_id, {}).get(bot_id)
+        if bot_runner is None:
+            return False
+        return self.webhook_app.bot_runner_by_subroute.get(bot_runner.webhook_subroute()) is bot_runner
+
+    async def swap(self, owner_id: str, bot_id: str, bot_runner: BotRunner) -> bool:
+        old_bot_runner = self.added_runners.get(owner_id, {}).get(bot_id)
+        subroute = bot_runner.webhook_subroute()
+        if old_bot_runner is None or old_bot_runner.webhook_subroute() != subroute:
+            # webhook URL is changed (e.g. the bot has a new token), so it has to be set up from scratch
+            return await super().swap(owner_id, bot_id, bot_runner)
+        # webhook stays the same, only the runner processing updates received on it is replaced
+        old_background_tasks = self.webhook_app.background_task_by_bot_subroute.pop(subroute, set())
+        self.webhook_app.bot_runner_by_subroute[subroute] = bot_runner
+        self.added_runners[owner_id][bot_id] = bot_runner
+        for idx, job in enumerate(bot_runner.background_jobs):
+            task = create_error_logging_task(job, name=f"{bot_runner.bot_prefix}-{idx + 1}")
+            self.webhook_app.background_task_by_bot_subroute[subroute].add(task)
+        for task in old_background_tasks:
+            if task.cancel():
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+        return True
+
     async def cleanup(self) -> None:
         """All bots are cleaned up by the webhook app itself, no need to do anything"""
         pass
+
+
+# constructs a bot in a worker process (e.g. from the stored config), without reusing any state from the main one
+BotRunnerFactory = Callable[[str, str], Awaitable[BotRunner]]
+
+
+@dataclass
+class WorkerContext:
+    """Constructs bots in a worker process and provides their metrics, normally backed by the app set up there"""
+
+    bot_runner_factory: BotRunnerFactory
+    # metrics of the bots in Prometheus text exposition format, merged with other workers' ones by the main process
+    render_prometheus_metrics: Callable[[], str] = lambda: ""
+    update_metrics_summary: Callable[[str, str], Optional[BotUpdateMetricsSummary]] = lambda owner_id, bot_id: None
+
+
+# called once in each worker process; must be picklable, i.e. a module-level function
+WorkerSetup = Callable[[], Awaitable[WorkerContext]]
+
+
+class ConsistentHashRing:
+    """Maps keys to a fixed number of shards, so that changing the number of shards moves as few keys as possible"""
+
+    def __init__(self, shards: int, virtual_nodes: int = 64) -> None:
+        if shards < 1:
+            raise ValueError("At least one shard is required")
+        points = sorted(
+            (self._hash(f"{shard}-{node}"), shard) for shard in range(shards) for node in range(virtual_nodes)
+        )
+        self._point_hashes = [h for h, _ in points]
+        self._point_shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.sha1(key.encode("utf-8"), usedforsecurity=False).digest()[:8], "big")
+
+    def shard_for(self, key: str) -> int:
+        idx = bisect.bisect(self._point_hashes, self._hash(key)) % len(self._point_hashes)
+        return self._point_shards[idx]
+
+
+_WorkerCommand = Literal["start", "stop", "swap", "is_running", "metrics", "update_metrics_summary"]
+# commands not changing the bot's state, so they are not queued behind e.g. a slow stop
+_READ_ONLY_WORKER_COMMANDS: set[_WorkerCommand] = {"metrics", "update_metrics_summary"}
+_WorkerRequest = tuple[int, _WorkerCommand, str, str]  # request id, command, owner id, bot id
+_WorkerResponse = tuple[int, Any]  # request id, result (None on errors)
+
+
+async def _recv(conn: Connection) -> Any:
+    """Receive an object from the pipe, waiting for it on the event loop instead of blocking an executor thread"""
+    loop = asyncio.get_running_loop()
+    fd = conn.fileno()
+    while not conn.poll():  # also true on EOF, so that recv raises EOFError
+        readable: asyncio.Future[None] = loop.create_future()
+
+        def on_readable(readable: asyncio.Future[None] = readable) -> None:
+            if not readable.done():
+                readable.set_result(None)
+
+        loop.add_reader(fd, on_readable)
+        try:
+            await readable
+        finally:
+            loop.remove_reader(fd)
+    return conn.recv()
+
+
+@dataclass
+class _Worker:
+    process: multiprocessing.process.BaseProcess
+    conn: Connection
+    pending_requests: dict[int, asyncio.Future[Any]] = field(default_factory=dict)
+    reader_task: asyncio.Task[None] | None = None
+
+
+class ShardedPollingConstructedBotRunner(ConstructedBotRunner):
+    """
+    Runner for standalone deployment with many bots, distributing them across several worker processes with
+    their own event loops. Each bot is assigned to a worker by consistent hashing of its owner and bot ids;
+    start and stop commands are sent to the worker over a pipe.
+
+    Bot runners can't be passed between processes, so the worker constructs the bot with the factory from the
+    context returned by worker_setup, and the app only checks that the bot can be created (see reconstructs_bots).
+
+    Each worker runs bots with its own PollingConstructedBotRunner, configured with drain_timeout and scheduler_config.
+    Metrics are collected by each worker for its bots and requested over the pipe when the app needs them.
+    """
+
+    reconstructs_bots = True
+
+    def __init__(
+        self,
+        worker_setup: WorkerSetup,
+        workers: int,
+        drain_timeout: float = 10.0,
+        scheduler_config: UpdateSchedulerConfig | None = None,
+    ) -> None:
+        self.worker_setup = worker_setup
+        self.workers_count = workers
+        self.drain_timeout = drain_timeout
+        self.scheduler_config = scheduler_config or UpdateSchedulerConfig()
+        self.ring = ConsistentHashRing(shards=workers)
+        self.logger = logging.getLogger(f"{__name__}.{self.__class__.__qualname__}")
+        self._workers: list[_Worker] = []
+        self._request_ids = itertools.count()
+
+    def _ensure_workers_started(self) -> None:
+        if self._workers:
+            return
+        mp_context = multiprocessing.get_context("spawn")
+        for idx in range(self.workers_count):
+            conn, worker_conn = mp_context.Pipe(duplex=True)
+            process = mp_context.Process(
+                target=_run_worker,
+                args=(worker_conn, self.worker_setup, self.drain_timeout, self.scheduler_config),
+                name=f"bot-runner-worker-{idx}",
+                daemon=True,
+            )
+            process.start()
+            worker_conn.close()
+            worker = _Worker(process=process, conn=conn)
+            worker.reader_task = asyncio.create_task(self._read_responses(idx, worker), name=f"{process.name} reader")
+            self._workers.append(worker)
+        self.logger.info(f"Started {self.workers_count} worker processes")
+
+    async def _read_responses(self, idx: int, worker: _Worker) -> None:
+        try:
+            while True:
+                response: _WorkerResponse = await _recv(worker.conn)
+                request_id, result = response
+                future = worker.pending_requests.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(result)
+        except (EOFError, OSError):
+            self.logger.error(f"Worker #{idx} is gone, bots assigned to it will not run")
+        finally:
+            for future in worker.pending_requests.values():
+                if not future.done():
+                    future.set_result(None)
+            worker.pending_requests.clear()
+
+    async def _request_worker(self, idx: int, command: _WorkerCommand, owner_id: str, bot_id: str) -> Any:
+        worker = self._workers[idx]
+        if worker.reader_task is None or worker.reader_task.done():
+            return None
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        worker.pending_requests[request_id] = future
+        request: _WorkerRequest = (request_id, command, owner_id, bot_id)
+        self.logger.debug(f"{log_prefix(owner_id, bot_id)} Sending {command!r} to worker #{idx}")
+        worker.conn.send(request)
+        return await future
+
+    async def _request(self, command: _WorkerCommand, owner_id: str, bot_id: str) -> Any:
+        self._ensure_workers_started()
+        return await self._request_worker(self.ring.shard_for(f"{owner_id}/{bot_id}"), command, owner_id, bot_id)
+
+    async def _request_bot_command(self, command: _WorkerCommand, owner_id: str, bot_id: str) -> bool:
+        result = await self._request(command, owner_id, bot_id)
+        if isinstance(result, BotConstructionError):
+            raise result
+        return bool(result)
+
+    async def start(self, owner_id: str, bot_id: str, bot_runner: BotRunner) -> bool:
+        for job in bot_runner.background_jobs:
+            job.close()
+        return await self._request_bot_command("start", owner_id, bot_id)
+
+    async def stop(self, owner_id: str, bot_id: str) -> bool:
+        return bool(await self._request("stop", owner_id, bot_id))
+
+    async def swap(self, owner_id: str, bot_id: str, bot_runner: BotRunner) -> bool:
+        for job in bot_runner.background_jobs:
+            job.close()
+        return await self._request_bot_command("swap", owner_id, bot_id)
+
+    async def is_running(self, owner_id: str, bot_id: str) -> bool:
+        return bool(await self._request("is_running", owner_id, bot_id))
+
+    async def render_prometheus_metrics(self) -> str:
+        if not self._workers:
+            return ""
+        texts = await asyncio.gather(
+            *[self._request_worker(idx, "metrics", "", "") for idx in range(len(self._workers))]
+        )
+        return merge_prometheus_texts(text for text in texts if text is not None)
+
+    async def update_metrics_summary(self, owner_id: str, bot_id: str) -> Optional[BotUpdateMetricsSummary]:
+        if not self._workers:
+            return None
+        return await self._request("update_metrics_summary", owner_id, bot_id)
+
+    async def cleanup(self) -> None:
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self._workers:
+            await asyncio.to_thread(worker.process.join, 10)
+            if worker.process.is_alive():
+                self.logger.warning(f"Worker {worker.process.name} did not exit in time, terminating it")
+                worker.process.terminate()
+            worker.conn.close()
+            if worker.reader_task is not None:
+                await worker.reader_task
+        self._workers.clear()
+
+
+def _run_worker(
+    conn: Connection, worker_setup: WorkerSetup, drain_timeout: float, scheduler_config: UpdateSchedulerConfig
+) -> None:
+    asyncio.run(_worker_loop(conn, worker_setup, drain_timeout, scheduler_config))
+
+
+async def _worker_loop(
+    conn: Connection, worker_setup: WorkerSetup, drain_timeout: float, scheduler_config: UpdateSchedulerConfig
+) -> None:
+    logger = logging.getLogger(f"{__name__}.worker[{multiprocessing.current_process().name}]")
+    worker_context = await worker_setup()
+    runner = PollingConstructedBotRunner(drain_timeout=drain_timeout, scheduler=FairUpdateScheduler(scheduler_config))
+    # commands for the same bot are handled one at a time, in the order they were received
+    bot_locks: dict[tuple[str, str], asyncio.Lock] = collections.defaultdict(asyncio.Lock)
+
+    async def handle(request: _WorkerRequest) -> None:
+        request_id, command, owner_id, bot_id = request
+        result: Any
+        try:
+            if command in _READ_ONLY_WORKER_COMMANDS:
+                result = await handle_command(command, owner_id, bot_id)
+            else:
+                async with bot_locks[(owner_id, bot_id)]:
+                    result = await handle_command(command, owner_id, bot_id)
+        except BotConstructionError as e:
+            logger.exception(f"{log_prefix(owner_id, bot_id)} Error constructing bot for {command!r} command")
+            result = e
+        except Exception:
+            logger.exception(f"{log_prefix(owner_id, bot_id)} Error handling {command!r} command")
+            result = None
+        response: _WorkerResponse = (request_id, result)
+        conn.send(response)
+
+    async def construct_bot(owner_id: str, bot_id: str) -> BotRunner:
+        try:
+            return await worker_context.bot_runner_factory(owner_id, bot_id)
+        except Exception as e:
+            # sent back to the main process to be shown to the user as is
+            raise BotConstructionError(str(e)) from e
+
+    async def handle_command(command: _WorkerCommand, owner_id: str, bot_id: str) -> Any:
+        if command == "start":
+            if await runner.is_running(owner_id, bot_id):
+                return False
+            return await runner.start(owner_id, bot_id, await construct_bot(owner_id, bot_id))
+        elif command == "swap":
+            return await runner.swap(owner_id, bot_id, await construct_bot(owner_id, bot_id))
+        elif command == "is_running":
+            return await runner.is_running(owner_id, bot_id)
+        elif command == "metrics":
+            return merge_prometheus_texts(
+                [worker_context.render_prometheus_metrics(), await runner.render_prometheus_metrics()]
+            )
+        elif command == "update_metrics_summary":
+            return worker_context.update_metrics_summary(owner_id, bot_id)
+        else:
+            return await runner.stop(owner_id, bot_id)
+
+    handler_tasks: set[asyncio.Task[None]] = set()
+    try:
+        while True:
+            try:
+                request: _WorkerRequest | None = await _recv(conn)
+            except EOFError:
+                logger.error("Main process is gone, exiting")
+                break
+            if request is None:
+                logger.info("Shutting down")
+                break
+            task = asyncio.create_task(handle(request))
+            handler_tasks.add(task)
+            task.add_done_callback(handler_tasks.discard)
+    finally:
+        for task in handler_tasks:
+            task.cancel()
+        await runner.cleanup()
@@ -0,0 +1,54 @@
+import datetime
+import hashlib
+import json
+
+from telebot import AsyncTeleBot
+from telebot import types as tg
+from telebot_components.redis_utils.interface import RedisInterface
+from telebot_components.stores.generic import KeyValueStore
+
+from telebot_constructor.constants import CONSTRUCTOR_PREFIX
+from telebot_constructor.utils.rate_limit_retry import rate_limit_retry
+
+
+def token_fingerprint(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+async def fetch_bot_user(bot: AsyncTeleBot) -> tg.User:
+    async for attempt in rate_limit_retry():
+        with attempt:
+            bot_user = await bot.get_me()
+    return bot_user
+
+
+class BotUserCache:
+    """
+    Cache for getMe results, keyed by bot token fingerprint. Only successful results are cached, so an invalid
+    token is detected on the first use; a token revoked after caching is detected no later than TTL expiration.
+    """
+
+    STORE_PREFIX = f"{CONSTRUCTOR_PREFIX}/bot-users"
+
+    def __init__(self, redis: RedisInterface, ttl: datetime.timedelta = datetime.timedelta(hours=1)) -> None:
+        # token fingerprint -> getMe response
+        self._bot_user_store = KeyValueStore[tg.User](
+            name="bot-user",
+            prefix=self.STORE_PREFIX,
+            redis=redis,
+            expiration_time=ttl,
+            dumper=lambda user: json.dumps(user.to_dict()),
+            loader=tg.User.de_json,
+        )
+
+    async def get_me(self, bot: AsyncTeleBot) -> tg.User:
+        key = token_fingerprint(bot.token)
+        cached = await self._bot_user_store.load(key)
+        if cached is not None:
+            return cached
+        bot_user = await fetch_bot_user(bot)
+        await self._bot_user_store.save(key, bot_user)
+        return bot_user
+
+    async def invalidate(self, bot: AsyncTeleBot) -> None:
+        await self._bot_user_store.drop(token_fingerprint(bot.token))
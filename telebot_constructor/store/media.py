@@ -1,19 +1,35 @@
 import abc
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import datetime
+import hashlib
 import logging
 import mimetypes
+import os
+import re
+import tempfile
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any
+from typing import Any, AsyncIterator, BinaryIO, Callable, TypeVar
 
 import aiobotocore.client  # type: ignore
+import aiobotocore.config  # type: ignore
 import aiobotocore.session  # type: ignore
 import pydantic
 from telebot_components.redis_utils.interface import RedisInterface
+from telebot_components.stores.generic import KeyDictStore, KeyValueStore
 
 from telebot_constructor.constants import CONSTRUCTOR_PREFIX
+from telebot_constructor.utils.redis_lock import redis_lock
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 class Media(pydantic.BaseModel):
     content: bytes
@@ -36,6 +52,42 @@ class Media(pydantic.BaseModel):
 
 MediaId = str
 
+MEDIA_STREAM_CHUNK_SIZE = 64 * 1024
+
+# start and end (exclusive) byte offsets -> chunks of media content
+MediaChunksReader = Callable[[int, int], AsyncIterator[bytes]]
+
+
+@dataclass
+class MediaStream:
+    """Media metadata with a way to read its content in chunks, without loading it into memory at once"""
+
+    filename: str | None
+    size: int
+    etag: str | None
+    read: MediaChunksReader
+    # if set, media content can be served directly from the file (e.g. with sendfile)
+    path: Path | None = None
+
+    def __str__(self) -> str:
+        return f"MediaStream <{self.size} bytes> filename={self.filename!r} etag={self.etag!r} path={self.path}"
+
+    @property
+    def mimetype(self) -> str | None:
+        if self.filename is not None:
+            mimetype, _ = mimetypes.guess_type(self.filename)
+            return mimetype
+        else:
+            return None
+
+
+def in_memory_chunks_reader(content: bytes) -> MediaChunksReader:
+    async def read(start: int, end: int) -> AsyncIterator[bytes]:
+        for chunk_start in range(start, end, MEDIA_STREAM_CHUNK_SIZE):
+            yield content[chunk_start : min(chunk_start + MEDIA_STREAM_CHUNK_SIZE, end)]
+
+    return read
+
 
 class MediaStore(abc.ABC):
     @abc.abstractmethod
@@ -47,6 +99,21 @@ class MediaStore(abc.ABC):
     @abc.abstractmethod
     async def delete_media(self, owner_id: str, media_id: MediaId) -> bool: ...
 
+    async def load_media_stream(self, owner_id: str, media_id: MediaId) -> MediaStream | None:
+        """
+        Default implementation loads the whole media into memory; stores capable of streaming
+        should override it
+        """
+        media = await self.load_media(owner_id=owner_id, media_id=media_id)
+        if media is None:
+            return None
+        return MediaStream(
+            filename=media.filename,
+            size=len(media.content),
+            etag=media_id,  # media content is never changed after saving, so its id is a valid etag
+            read=in_memory_chunks_reader(media.content),
+        )
+
     async def setup(self) -> None: ...
 
     async def cleanup(self) -> None: ...
@@ -105,12 +172,29 @@ class AwsS3Credentials(pydantic.BaseModel):
     secret_access_key: str
     region: str
     bucket: str
+    endpoint_url: str | None = None  # for S3-compatible services and local stand-ins like MinIO or moto
+
+
+class AwsS3MediaStoreConfig(pydantic.BaseModel):
+    # should fit both concurrent requests and streams, otherwise they wait for a free connection in the pool
+    max_pool_connections: int = 48
+    max_concurrent_requests: int = 32  # requests waiting for a slot are queued, not failed
+    # streamed media occupies the connection as long as the client reads it, so it's limited separately
+    max_concurrent_streams: int = 16
+    connect_timeout_sec: float = 5.0
+    read_timeout_sec: float = 30.0
+    # media larger than threshold is uploaded in parts concurrently; S3 requires parts to be at least 5 MiB
+    multipart_upload_threshold: int = 16 * 1024**2
+    multipart_upload_part_size: int = 8 * 1024**2
 
 
 class AwsS3MediaStore(MediaStore):
-    def __init__(self, credentials: AwsS3Credentials) -> None:
+    def __init__(self, credentials: AwsS3Credentials, config: AwsS3MediaStoreConfig | None = None) -> None:
         self.credentials = credentials
+        self.config = config or AwsS3MediaStoreConfig()
         self._client: aiobotocore.client.AioBaseClient | None = None
+        self._semaphore = asyncio.Semaphore(self.config.max_concurrent_requests)
+        self._stream_semaphore = asyncio.Semaphore(self.config.max_concurrent_streams)
 
     @property
     def client(self) -> aiobotocore.client.AioBaseClient:
@@ -125,18 +209,66 @@ class AwsS3MediaStore(MediaStore):
         # HACK: (aio)botocore forces the use of client as a context manager, but it will not fly with us
         self._client = await session._create_client(
             "s3",
-            region_name="us-west-2",
+            region_name=self.credentials.region,
+            endpoint_url=self.credentials.endpoint_url,
             aws_secret_access_key=self.credentials.secret_access_key,
             aws_access_key_id=self.credentials.access_key_id,
+            config=aiobotocore.config.AioConfig(
+                max_pool_connections=self.config.max_pool_connections,
+                connect_timeout=self.config.connect_timeout_sec,
+                read_timeout=self.config.read_timeout_sec,
+            ),
         )
         await self._client.__aenter__()
 
-    async def cleanup(self):
+    async def cleanup(self) -> None:
+        if self._client is None:
+            return
         await self._client.__aexit__(None, None, None)
         self._client = None
 
+    async def _upload_multipart(self, key: str, content: bytes, create_kwargs: dict[str, Any]) -> None:
+        # https://docs.aws.amazon.com/AmazonS3/latest/userguide/mpuoverview.html
+        async with self._semaphore:
+            resp = await self.client.create_multipart_upload(Bucket=self.credentials.bucket, Key=key, **create_kwargs)
+        upload_id = resp["UploadId"]
+        content_view = memoryview(content)
+        part_size = self.config.multipart_upload_part_size
+
+        async def upload_part(part_number: int, offset: int) -> dict[str, Any]:
+            async with self._semaphore:
+                resp = await self.client.upload_part(
+                    Bucket=self.credentials.bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=bytes(content_view[offset : offset + part_size]),
+                )
+            return {"PartNumber": part_number, "ETag": resp["ETag"]}
+
+        try:
+            parts = await asyncio.gather(
+                *[
+                    upload_part(part_number, offset)
+                    for part_number, offset in enumerate(range(0, len(content), part_size), start=1)
+                ]
+            )
+            async with self._semaphore:
+                await self.client.complete_multipart_upload(
+                    Bucket=self.credentials.bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+        except BaseException:
+            # otherwise uploaded parts are stored (and billed) indefinitely
+            async with self._semaphore:
+                await self.client.abort_multipart_upload(Bucket=self.credentials.bucket, Key=key, UploadId=upload_id)
+            raise
+
     async def save_media(self, owner_id: str, media: Media) -> MediaId | None:
         media_id = str(uuid.uuid4())
+        key = f"{owner_id}/{media_id}"
 
         # see docs at
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/put_object.html
@@ -148,39 +280,83 @@ class AwsS3MediaStore(MediaStore):
             put_object_kwargs["Metadata"] = {"filename": media.filename}
 
         try:
-            resp = await self.client.put_object(
-                Bucket=self.credentials.bucket,
-                Key=f"{owner_id}/{media_id}",
-                Body=media.content,
-                **put_object_kwargs,
-            )
-            logging.debug("Response from S3: %s", resp)
+            if len(media.content) > self.config.multipart_upload_threshold:
+                await self._upload_multipart(key, media.content, create_kwargs=put_object_kwargs)
+            else:
+                async with self._semaphore:
+                    resp = await self.client.put_object(
+                        Bucket=self.credentials.bucket,
+                        Key=key,
+                        Body=media.content,
+                        **put_object_kwargs,
+                    )
+                logger.debug("Response from S3: %s", resp)
             return media_id
         except Exception:
-            logging.exception("Error putting object in S3 bucket")
+            logger.exception("Error putting object in S3 bucket")
             return None
 
     async def load_media(self, owner_id: str, media_id: MediaId) -> Media | None:
         try:
             # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/get_object.html
-            resp = await self.client.get_object(
-                Bucket=self.credentials.bucket,
-                Key=f"{owner_id}/{media_id}",
-            )
-            body = resp["Body"]
-            return Media(content=await body.read(), filename=resp.get("Metadata", {}).get("filename"))
+            async with self._semaphore:
+                resp = await self.client.get_object(
+                    Bucket=self.credentials.bucket,
+                    Key=f"{owner_id}/{media_id}",
+                )
+                body = resp["Body"]
+                async with body:  # releasing the connection back to the pool when done
+                    chunks = [chunk async for chunk in body.iter_chunks(MEDIA_STREAM_CHUNK_SIZE)]
+            return Media(content=b"".join(chunks), filename=resp.get("Metadata", {}).get("filename"))
         except Exception as exc:
             if exc.__class__.__name__ != "NoSuchKey":
                 logger.exception("Unexpected error getting an object from S3")
             return None
 
+    async def load_media_stream(self, owner_id: str, media_id: MediaId) -> MediaStream | None:
+        key = f"{owner_id}/{media_id}"
+        try:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/head_object.html
+            async with self._semaphore:
+                resp = await self.client.head_object(Bucket=self.credentials.bucket, Key=key)
+        except Exception as exc:
+            # HEAD responses have no body, so missing keys are reported with a bare 404 code
+            error_code = getattr(exc, "response", {}).get("Error", {}).get("Code")
+            if error_code not in {"404", "NoSuchKey"}:
+                logger.exception("Unexpected error getting object metadata from S3")
+            return None
+
+        async def read(start: int, end: int) -> AsyncIterator[bytes]:
+            if start >= end:
+                return
+            # the connection is occupied until the body is read by the client, which may take long, so
+            # streams don't take slots from regular requests
+            async with self._stream_semaphore:
+                resp = await self.client.get_object(
+                    Bucket=self.credentials.bucket,
+                    Key=key,
+                    Range=f"bytes={start}-{end - 1}",  # HTTP ranges are inclusive
+                )
+                body = resp["Body"]
+                async with body:
+                    async for chunk in body.iter_chunks(MEDIA_STREAM_CHUNK_SIZE):
+                        yield chunk
+
+        return MediaStream(
+            filename=resp.get("Metadata", {}).get("filename"),
+            size=resp["ContentLength"],
+            etag=resp.get("ETag", "").strip('"') or media_id,
+            read=read,
+        )
+
     async def delete_media(self, owner_id: str, media_id: MediaId) -> bool:
         try:
             # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/delete_object.html
-            await self.client.delete_object(
-                Bucket=self.credentials.bucket,
-                Key=f"{owner_id}/{media_id}",
-            )
+            async with self._semaphore:
+                await self.client.delete_object(
+                    Bucket=self.credentials.bucket,
+                    Key=f"{owner_id}/{media_id}",
+                )
             return True
         except Exception as exc:
             if exc.__class__.__name__ != "NoSuchKey":
@@ -200,34 +376,398 @@ class UserSpecificMediaStore:
 
 
 class FilesystemMediaStore(MediaStore):
-    def __init__(self, dir: Path) -> None:
+    """
+    Stores media as files in a directory, one subdirectory per owner. Filesystem calls are blocking,
+    so they are run in a dedicated thread pool to keep the event loop (shared with all the bots) free.
+    """
+
+    FILENAME_SIDECAR_SUFFIX = ".filename"
+
+    def __init__(self, dir: Path, io_threads: int = 4) -> None:
         self._dir = dir
         assert self._dir.exists(), f"{self._dir} does not exist"
         assert self._dir.is_dir(), f"{self._dir} is not a directory"
+        self._executor = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix="filesystem-media-store")
+
+    async def cleanup(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    async def _run_in_thread(self, func: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
 
     def _filename(self, owner_id: str, media_id: MediaId) -> Path:
-        owner_dir = self._dir / owner_id
-        owner_dir.mkdir(exist_ok=True)
-        return owner_dir / media_id
+        return self._dir / owner_id / media_id
+
+    def _filename_sidecar(self, owner_id: str, media_id: MediaId) -> Path:
+        return self._dir / owner_id / (media_id + self.FILENAME_SIDECAR_SUFFIX)
+
+    @staticmethod
+    def _write_atomically(path: Path, content: bytes) -> None:
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f".{path.name}.", delete=False) as f:
+            try:
+                f.write(content)
+                f.close()
+                os.replace(f.name, path)
+            except Exception:
+                os.unlink(f.name)
+                raise
+
+    def _save_media_sync(self, owner_id: str, media_id: MediaId, media: Media) -> None:
+        (self._dir / owner_id).mkdir(exist_ok=True)
+        # sidecar goes first so that the media is never visible without its filename
+        if media.filename is not None:
+            self._write_atomically(self._filename_sidecar(owner_id, media_id), media.filename.encode("utf-8"))
+        self._write_atomically(self._filename(owner_id, media_id), media.content)
+
+    def _load_filename_sync(self, owner_id: str, media_id: MediaId) -> str | None:
+        try:
+            return self._filename_sidecar(owner_id, media_id).read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    def _load_media_sync(self, owner_id: str, media_id: MediaId) -> Media | None:
+        try:
+            content = self._filename(owner_id, media_id).read_bytes()
+        except FileNotFoundError:
+            return None
+        return Media(content=content, filename=self._load_filename_sync(owner_id, media_id))
+
+    def _load_media_stream_metadata_sync(self, owner_id: str, media_id: MediaId) -> tuple[os.stat_result, str | None]:
+        return self._filename(owner_id, media_id).stat(), self._load_filename_sync(owner_id, media_id)
+
+    def _delete_media_sync(self, owner_id: str, media_id: MediaId) -> bool:
+        self._filename_sidecar(owner_id, media_id).unlink(missing_ok=True)
+        try:
+            self._filename(owner_id, media_id).unlink()
+            return True
+        except FileNotFoundError:
+            return False
 
     async def save_media(self, owner_id: str, media: Media) -> MediaId | None:
         media_id = str(uuid.uuid4())
-        self._filename(owner_id, media_id).write_bytes(media.content)
-        return media_id
+        try:
+            await self._run_in_thread(self._save_media_sync, owner_id, media_id, media)
+            return media_id
+        except Exception:
+            logger.exception("Error saving media to the filesystem")
+            return None
 
     async def load_media(self, owner_id: str, media_id: MediaId) -> Media | None:
-        filename = self._filename(owner_id, media_id)
-        if not filename.exists():
+        return await self._run_in_thread(self._load_media_sync, owner_id, media_id)
+
+    async def load_media_stream(self, owner_id: str, media_id: MediaId) -> MediaStream | None:
+        try:
+            stat, filename = await self._run_in_thread(self._load_media_stream_metadata_sync, owner_id, media_id)
+        except FileNotFoundError:
             return None
+        path = self._filename(owner_id, media_id)
+
+        def open_at(start: int) -> BinaryIO:
+            f = path.open("rb")
+            f.seek(start)
+            return f
+
+        async def read(start: int, end: int) -> AsyncIterator[bytes]:
+            with await self._run_in_thread(open_at, start) as f:
+                remaining = end - start
+                while remaining > 0:
+                    chunk = await self._run_in_thread(f.read, min(MEDIA_STREAM_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+
+        return MediaStream(
+            filename=filename,
+            size=stat.st_size,
+            etag=f"{stat.st_mtime_ns:x}-{stat.st_size:x}",
+            read=read,
+            path=path,
+        )
+
+    async def delete_media(self, owner_id: str, media_id: MediaId) -> bool:
+        return await self._run_in_thread(self._delete_media_sync, owner_id, media_id)
+
+
+class ContentAddressedMediaStore(MediaStore):
+    """
+    Wrapper around another media store, deduplicating media by its content. Each distinct content is stored
+    once as a shared blob in the underlying store, and owners hold counted references to it. Media id is the
+    content hash (followed by the filename hash if the filename is given), so the same media saved to different
+    bots is also cached as one Telegram file id within each bot. The blob is deleted when the last reference
+    to it is deleted.
+
+    Blob modifications are serialized with a lock in Redis, so several processes can share the store.
+
+    Media ids not looking like content hashes are considered to be saved before deduplication was enabled
+    and are passed directly to the underlying store.
+    """
+
+    STORE_PREFIX = f"{CONSTRUCTOR_PREFIX}/content-addressed-media"
+    BLOBS_OWNER_ID = "content-addressed-blobs"
+
+    MEDIA_ID_RE = re.compile(r"^(?P<content_hash>[0-9a-f]{64})(-[0-9a-f]{16})?$")
+
+    # the lock is held while the blob is uploaded to the underlying store, expiration only guards against
+    # locks left by crashed processes
+    BLOB_LOCK_EXPIRATION = datetime.timedelta(minutes=5)
+
+    def __init__(self, store: MediaStore, redis: RedisInterface) -> None:
+        self.store = store
+        self.redis = redis
+        # content hash -> blob media id in the underlying store
+        self._blob_media_id_store = KeyValueStore[str](
+            name="blob-media-id",
+            prefix=self.STORE_PREFIX,
+            redis=redis,
+            expiration_time=None,
+            dumper=str,
+            loader=str,
+        )
+        # content hash -> "{owner id}/{media id}" -> number of times the owner saved the media
+        self._blob_references_store = KeyDictStore[int](
+            name="blob-references",
+            prefix=self.STORE_PREFIX,
+            redis=redis,
+            expiration_time=None,
+            dumper=str,
+            loader=int,
+        )
+        # "{owner id}/{media id}" -> filename given by the owner (empty string if not given)
+        self._reference_filename_store = KeyValueStore[str](
+            name="reference-filename",
+            prefix=self.STORE_PREFIX,
+            redis=redis,
+            expiration_time=None,
+            dumper=str,
+            loader=str,
+        )
+        # waiting for the blob lock in Redis is done by one coroutine per content in the process
+        self._blob_locks: dict[str, asyncio.Lock] = dict()
+        self._blob_lock_users: collections.Counter[str] = collections.Counter()
+
+    async def setup(self) -> None:
+        await self.store.setup()
+
+    async def cleanup(self) -> None:
+        await self.store.cleanup()
+
+    def _reference_key(self, owner_id: str, media_id: MediaId) -> str:
+        return f"{owner_id}/{media_id}"
+
+    @contextlib.asynccontextmanager
+    async def _blob_lock(self, content_hash: str) -> AsyncIterator[None]:
+        """
+        Blob modifications for the same content are serialized to prevent duplicate uploads and
+        deletion of a blob that is being referenced concurrently
+        """
+        lock = self._blob_locks.setdefault(content_hash, asyncio.Lock())
+        self._blob_lock_users[content_hash] += 1
+        try:
+            async with lock:
+                async with redis_lock(
+                    self.redis,
+                    key=f"{self.STORE_PREFIX}/blob-lock/{content_hash}",
+                    expiration=self.BLOB_LOCK_EXPIRATION,
+                ):
+                    yield
+        finally:
+            self._blob_lock_users[content_hash] -= 1
+            if self._blob_lock_users[content_hash] <= 0:
+                self._blob_lock_users.pop(content_hash, None)
+                self._blob_locks.pop(content_hash, None)
+
+    @staticmethod
+    def _content_hash(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    @staticmethod
+    def _media_id(content_hash: str, filename: str | None) -> MediaId:
+        # the same content saved with different filenames is sent to Telegram as different files
+        if not filename:
+            return content_hash
+        return f"{content_hash}-{hashlib.sha256(filename.encode('utf-8')).hexdigest()[:16]}"
+
+    async def _resolve_reference(
+        self, owner_id: str, content_hash: str, media_id: MediaId
+    ) -> tuple[MediaId, str | None] | None:
+        """Returns blob media id and filename for the owner's reference, if it exists"""
+        if not await self._blob_references_store.get_subkey(content_hash, self._reference_key(owner_id, media_id)):
+            return None
+        blob_media_id = await self._blob_media_id_store.load(content_hash)
+        if blob_media_id is None:
+            return None
+        filename = await self._reference_filename_store.load(self._reference_key(owner_id, media_id))
+        return blob_media_id, filename or None
+
+    async def save_media(self, owner_id: str, media: Media) -> MediaId | None:
+        # hashlib releases GIL for large inputs, so hashing in a thread doesn't block the event loop
+        content_hash = await asyncio.to_thread(self._content_hash, media.content)
+        media_id = self._media_id(content_hash, media.filename)
+        reference_key = self._reference_key(owner_id, media_id)
+        async with self._blob_lock(content_hash):
+            if await self._blob_media_id_store.load(content_hash) is None:
+                blob_media_id = await self.store.save_media(
+                    owner_id=self.BLOBS_OWNER_ID,
+                    media=Media(content=media.content, filename=None),
+                )
+                if blob_media_id is None:
+                    return None
+                if not await self._blob_media_id_store.save(content_hash, blob_media_id):
+                    return None
+            else:
+                logger.debug(f"Media content is already stored, adding reference for {owner_id!r}")
+            await self._reference_filename_store.save(reference_key, media.filename or "")
+            references = await self._blob_references_store.get_subkey(content_hash, reference_key) or 0
+            await self._blob_references_store.set_subkey(content_hash, reference_key, references + 1)
+            return media_id
+
+    async def load_media(self, owner_id: str, media_id: MediaId) -> Media | None:
+        match = self.MEDIA_ID_RE.match(media_id)
+        if match is None:
+            return await self.store.load_media(owner_id=owner_id, media_id=media_id)
+        reference = await self._resolve_reference(owner_id, match.group("content_hash"), media_id)
+        if reference is None:
+            return None
+        blob_media_id, filename = reference
+        blob = await self.store.load_media(owner_id=self.BLOBS_OWNER_ID, media_id=blob_media_id)
+        if blob is None:
+            return None
+        return Media(content=blob.content, filename=filename)
+
+    async def load_media_stream(self, owner_id: str, media_id: MediaId) -> MediaStream | None:
+        match = self.MEDIA_ID_RE.match(media_id)
+        if match is None:
+            return await self.store.load_media_stream(owner_id=owner_id, media_id=media_id)
+        reference = await self._resolve_reference(owner_id, match.group("content_hash"), media_id)
+        if reference is None:
+            return None
+        blob_media_id, filename = reference
+        blob_stream = await self.store.load_media_stream(owner_id=self.BLOBS_OWNER_ID, media_id=blob_media_id)
+        if blob_stream is None:
+            return None
+        return dataclasses.replace(blob_stream, filename=filename)
+
+    async def delete_media(self, owner_id: str, media_id: MediaId) -> bool:
+        match = self.MEDIA_ID_RE.match(media_id)
+        if match is None:
+            return await self.store.delete_media(owner_id=owner_id, media_id=media_id)
+        content_hash = match.group("content_hash")
+        reference_key = self._reference_key(owner_id, media_id)
+        async with self._blob_lock(content_hash):
+            references = await self._blob_references_store.get_subkey(content_hash, reference_key)
+            if not references:
+                return False
+            if references > 1:
+                await self._blob_references_store.set_subkey(content_hash, reference_key, references - 1)
+                return True
+            await self._blob_references_store.remove_subkey(content_hash, reference_key)
+            await self._reference_filename_store.drop(reference_key)
+            if await self._blob_references_store.count_values(content_hash):
+                return True
+            logger.debug("Last reference to media content deleted, deleting the blob")
+            blob_media_id = await self._blob_media_id_store.load(content_hash)
+            await self._blob_media_id_store.drop(content_hash)
+            if blob_media_id is not None:
+                await self.store.delete_media(owner_id=self.BLOBS_OWNER_ID, media_id=blob_media_id)
+            return True
+
+
+@dataclass
+class MediaCacheMetrics:
+    hits: int = 0
+    misses: int = 0
+    # loads served by an already running load of the same media
+    coalesced: int = 0
+    evictions: int = 0
+    cached_items: int = 0
+    cached_bytes: int = 0
+
+
+class CachingMediaStore(MediaStore):
+    """
+    Wrapper around another media store, keeping recently loaded media in memory. The cache is an LRU bounded
+    by total content size; concurrent loads of the same media are coalesced into a single load from the
+    underlying store. Media larger than the item size limit is never cached.
+
+    Media streams are not cached and always come from the underlying store, so that it can serve them
+    in the most efficient way (e.g. directly from the file).
+    """
+
+    def __init__(self, store: MediaStore, max_size_bytes: int, max_item_size_bytes: int | None = None) -> None:
+        self.store = store
+        self.max_size_bytes = max_size_bytes
+        self.max_item_size_bytes = max_item_size_bytes if max_item_size_bytes is not None else max_size_bytes // 4
+        self.metrics = MediaCacheMetrics()
+        self._cache: collections.OrderedDict[tuple[str, MediaId], Media] = collections.OrderedDict()
+        self._loads: dict[tuple[str, MediaId], asyncio.Task[Media | None]] = dict()
+
+    async def setup(self) -> None:
+        await self.store.setup()
+
+    async def cleanup(self) -> None:
+        await self.store.cleanup()
+
+    def _put(self, key: tuple[str, MediaId], media: Media) -> None:
+        size = len(media.content)
+        if size > self.max_item_size_bytes:
+            return
+        self._evict(key)
+        self._cache[key] = media
+        self.metrics.cached_bytes += size
+        while self.metrics.cached_bytes > self.max_size_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self.metrics.cached_bytes -= len(evicted.content)
+            self.metrics.evictions += 1
+        self.metrics.cached_items = len(self._cache)
+
+    def _evict(self, key: tuple[str, MediaId]) -> None:
+        evicted = self._cache.pop(key, None)
+        if evicted is not None:
+            self.metrics.cached_bytes -= len(evicted.content)
+            self.metrics.cached_items = len(self._cache)
+
+    async def _load_and_cache(self, key: tuple[str, MediaId]) -> Media | None:
+        owner_id, media_id = key
+        try:
+            media = await self.store.load_media(owner_id=owner_id, media_id=media_id)
+            # if the media was deleted while loading, the load is detached and its result must not be cached
+            if media is not None and self._loads.get(key) is asyncio.current_task():
+                self._put(key, media)
+            return media
+        finally:
+            if self._loads.get(key) is asyncio.current_task():
+                self._loads.pop(key)
+
+    async def save_media(self, owner_id: str, media: Media) -> MediaId | None:
+        return await self.store.save_media(owner_id=owner_id, media=media)
+
+    async def load_media(self, owner_id: str, media_id: MediaId) -> Media | None:
+        key = (owner_id, media_id)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.metrics.hits += 1
+            return cached
+        load = self._loads.get(key)
+        if load is not None:
+            self.metrics.coalesced += 1
         else:
-            return Media(
-                content=filename.read_bytes(),
-                filename=None,
-            )
+            self.metrics.misses += 1
+            load = asyncio.create_task(self._load_and_cache(key))
+            self._loads[key] = load
+        # one of the waiters being cancelled must not cancel the load for others
+        return await asyncio.shield(load)
+
+    async def load_media_stream(self, owner_id: str, media_id: MediaId) -> MediaStream | None:
+        return await self.store.load_media_stream(owner_id=owner_id, media_id=media_id)
 
     async def delete_media(self, owner_id: str, media_id: MediaId) -> bool:
-        filename = self._filename(owner_id, media_id)
-        if not filename.exists():
-            return False
-        filename.unlink()
-        return True
+        key = (owner_id, media_id)
+        self._evict(key)
+        self._loads.pop(key, None)
+        deleted = await self.store.delete_media(owner_id=owner_id, media_id=media_id)
+        # media might have been loaded and cached again while deleting
+        self._evict(key)
+        self._loads.pop(key, None)
+        return deleted
@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable, Generic, TypeVar
+
+import pydantic
+from telebot_components.redis_utils.interface import RedisInterface
+from telebot_components.stores.generic import KeyDictStore
+
+JobT = TypeVar("JobT")
+
+PENDING_JOBS_KEY = "pending"
+IN_PROGRESS_JOBS_KEY = "in-progress"
+
+
+class OutboxEntry(pydantic.BaseModel):
+    job_dump: str
+    enqueued_at: float
+    attempts: int = 0
+    next_attempt_at: float = 0.0
+    leased_until: float = 0.0  # for in-progress jobs
+
+
+class Outbox(Generic[JobT]):
+    """
+    Durable queue of jobs processed by a background worker with retries. Jobs are kept in Redis
+    until they are successfully processed or run out of attempts, so they survive bot restarts.
+
+    The worker is usually the only consumer for the outbox, e.g. it's one of the bot's background jobs, but
+    jobs are claimed atomically, so concurrent workers don't process the same job twice. A claimed job is moved
+    to the in-progress ones with a lease; if the worker dies while processing it, the job is returned to the pending
+    ones after the lease expires. So, jobs are processed at least once, but may be processed twice in case of a crash.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        prefix: str,
+        redis: RedisInterface,
+        dumper: Callable[[JobT], str],
+        loader: Callable[[str], JobT],
+        logger: logging.Logger,
+        max_attempts: int = 8,
+        retry_backoff: datetime.timedelta = datetime.timedelta(seconds=5),
+        poll_period: datetime.timedelta = datetime.timedelta(seconds=10),
+        lease_duration: datetime.timedelta = datetime.timedelta(minutes=5),
+    ) -> None:
+        self.name = name
+        self.dumper = dumper
+        self.loader = loader
+        self.logger = logger
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.poll_period = poll_period
+        self.lease_duration = lease_duration
+        # pending: job id -> entry; in-progress: claim id (job id + claim token) -> entry
+        self._store = KeyDictStore[OutboxEntry](
+            name=f"{name}-outbox",
+            prefix=prefix,
+            redis=redis,
+            expiration_time=datetime.timedelta(days=7),
+            dumper=OutboxEntry.model_dump_json,
+            loader=OutboxEntry.model_validate_json,
+        )
+        self._job_enqueued = asyncio.Event()
+
+    async def enqueue(self, job: JobT) -> None:
+        now = time.time()
+        # job ids are sorted in enqueueing order
+        job_id = f"{now:017.6f}-{uuid.uuid4().hex[:8]}"
+        await self._store.set_subkey(PENDING_JOBS_KEY, job_id, OutboxEntry(job_dump=self.dumper(job), enqueued_at=now))
+        self._job_enqueued.set()
+
+    async def pending_count(self) -> int:
+        return await self._store.count_values(PENDING_JOBS_KEY)
+
+    async def _requeue_expired_leases(self) -> None:
+        """Return jobs of workers that died while processing them to the pending ones"""
+        now = time.time()
+        for claim_id, entry in (await self._store.load(IN_PROGRESS_JOBS_KEY)).items():
+            if entry.leased_until > now:
+                continue
+            job_id, _, _ = claim_id.partition("/")
+            # the interrupted attempt counts, so that a job crashing the worker is eventually given up
+            entry.attempts += 1
+            if entry.attempts >= self.max_attempts:
+                self.logger.error(f"{self.name} job lease expired, giving up after {entry.attempts} attempts")
+            else:
+                self.logger.info(f"{self.name} job lease expired (attempt {entry.attempts}), returning it to pending")
+                entry.leased_until = 0.0
+                # adding to pending before removing from in-progress, so that the job is not lost in between;
+                # concurrent requeuing of the same job just overwrites the same pending entry
+                await self._store.set_subkey(PENDING_JOBS_KEY, job_id, entry)
+            await self._store.remove_subkey(IN_PROGRESS_JOBS_KEY, claim_id)
+
+    async def _claim(self, job_id: str, entry: OutboxEntry) -> str | None:
+        """Move the job from pending to in-progress, returns claim id or None if it's claimed by another worker"""
+        claim_id = f"{job_id}/{uuid.uuid4().hex[:8]}"
+        entry.leased_until = time.time() + self.lease_duration.total_seconds()
+        # the in-progress entry is added first, so that the job is not lost if the worker dies in between
+        await self._store.set_subkey(IN_PROGRESS_JOBS_KEY, claim_id, entry)
+        # removing from pending is atomic, so only one of concurrent workers (e.g. the old version of the bot
+        # during a restart) claims the job
+        if not await self._store.remove_subkey(PENDING_JOBS_KEY, job_id):
+            await self._store.remove_subkey(IN_PROGRESS_JOBS_KEY, claim_id)
+            return None
+        return claim_id
+
+    async def _release(self, job_id: str, claim_id: str, retry_entry: OutboxEntry | None) -> None:
+        """Remove the job from in-progress, returning it to pending if it's to be retried"""
+        if retry_entry is not None and await self._store.get_subkey(IN_PROGRESS_JOBS_KEY, claim_id) is not None:
+            # the lease might have expired and the job requeued by another worker already, then it's not returned
+            retry_entry.leased_until = 0.0
+            await self._store.set_subkey(PENDING_JOBS_KEY, job_id, retry_entry)
+        await self._store.remove_subkey(IN_PROGRESS_JOBS_KEY, claim_id)
+
+    async def process_pending(self, process_job: Callable[[JobT], Awaitable[None]]) -> int:
+        """Process all jobs due for an attempt, returns the number of successfully processed ones"""
+        await self._requeue_expired_leases()
+        entries = await self._store.load(PENDING_JOBS_KEY)
+        processed_count = 0
+        for job_id in sorted(entries.keys()):
+            entry = entries[job_id]
+            now = time.time()
+            if entry.next_attempt_at > now:
+                continue
+            claim_id = await self._claim(job_id, entry)
+            if claim_id is None:
+                continue
+            try:
+                await process_job(self.loader(entry.job_dump))
+            except asyncio.CancelledError:
+                await self._release(job_id, claim_id, retry_entry=entry)
+                raise
+            except Exception as e:
+                entry.attempts += 1
+                if entry.attempts >= self.max_attempts:
+                    self.logger.exception(
+                        f"Error processing {self.name} job, giving up after {entry.attempts} attempts"
+                    )
+                    await self._release(job_id, claim_id, retry_entry=None)
+                else:
+                    self.logger.info(f"Error processing {self.name} job (attempt {entry.attempts}), will retry: {e!r}")
+                    backoff = self.retry_backoff.total_seconds() * 2 ** (entry.attempts - 1)
+                    entry.next_attempt_at = now + backoff
+                    await self._release(job_id, claim_id, retry_entry=entry)
+            else:
+                processed_count += 1
+                await self._release(job_id, claim_id, retry_entry=None)
+        return processed_count
+
+    async def run_worker(self, process_job: Callable[[JobT], Awaitable[None]]) -> None:
+        while True:
+            self._job_enqueued.clear()
+            try:
+                await self.process_pending(process_job)
+            except Exception:
+                self.logger.exception(f"Unexpected error processing {self.name} outbox")
+            try:
+                await asyncio.wait_for(self._job_enqueued.wait(), timeout=self.poll_period.total_seconds())
+            except asyncio.TimeoutError:
+                pass
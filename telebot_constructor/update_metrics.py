@@ -0,0 +1,239 @@
+import bisect
+import collections
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+from pydantic import BaseModel
+from telebot.metrics import TelegramUpdateMetrics, TelegramUpdateMetricsHandler
+
+# seconds, upper bounds of histogram buckets (+Inf bucket is implied)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+RECENT_RATE_WINDOW_MINUTES = 5
+
+
+class BotUpdateMetricsSummary(BaseModel):
+    updates: int  # total processed updates since the constructor start
+    unhandled_updates: int  # updates not matched by any handler
+    errors: int  # updates with handler raising an exception
+    recent_updates_per_minute: float  # averaged over the last few minutes
+    avg_processing_duration: Optional[float]  # seconds; None = no updates were handled
+    p95_processing_duration: Optional[float]  # seconds, histogram bucket upper bound
+    last_update_at: Optional[float]  # UNIX timestamp
+
+
+class DurationHistogram:
+    """Prometheus-style histogram with fixed buckets"""
+
+    def __init__(self, buckets: tuple[float, ...] = DURATION_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> list[tuple[float, int]]:
+        res: list[tuple[float, int]] = []
+        total = 0
+        for upper_bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            res.append((upper_bound, total))
+        return res
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket containing the quantile; the largest finite bound if it's in +Inf bucket"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        for upper_bound, cumulative_count in self.cumulative_counts():
+            if cumulative_count >= rank:
+                return upper_bound if math.isfinite(upper_bound) else self.buckets[-1]
+        return self.buckets[-1]
+
+
+class RecentRate:
+    """Event counts in per-minute buckets over a short sliding window"""
+
+    def __init__(self, window_minutes: int = RECENT_RATE_WINDOW_MINUTES) -> None:
+        self.window_minutes = window_minutes
+        self._count_by_minute: collections.deque[tuple[int, int]] = collections.deque()
+
+    def _evict(self, current_minute: int) -> None:
+        while self._count_by_minute and self._count_by_minute[0][0] <= current_minute - self.window_minutes:
+            self._count_by_minute.popleft()
+
+    def add(self, timestamp: float) -> None:
+        minute = int(timestamp // 60)
+        self._evict(minute)
+        if self._count_by_minute and self._count_by_minute[-1][0] == minute:
+            self._count_by_minute[-1] = (minute, self._count_by_minute[-1][1] + 1)
+        else:
+            self._count_by_minute.append((minute, 1))
+
+    def per_minute(self, now: float) -> float:
+        self._evict(int(now // 60))
+        return sum(count for _, count in self._count_by_minute) / self.window_minutes
+
+
+@dataclass
+class BotUpdateMetrics:
+    updates_by_type: collections.Counter[str] = field(default_factory=collections.Counter)
+    unhandled_updates: int = 0
+    errors: int = 0
+    processing_duration: DurationHistogram = field(default_factory=DurationHistogram)
+    handler_test_duration: DurationHistogram = field(default_factory=DurationHistogram)
+    recent_updates: RecentRate = field(default_factory=RecentRate)
+    last_update_at: Optional[float] = None
+
+    def observe(self, metrics: TelegramUpdateMetrics) -> None:
+        self.updates_by_type[metrics.get("update_type") or "unknown"] += 1
+        self.recent_updates.add(metrics["received_at"])
+        self.last_update_at = metrics["received_at"]
+        if metrics.get("handler_name") is None:
+            self.unhandled_updates += 1
+        if "exception_info" in metrics:
+            self.errors += 1
+        processing_duration = metrics.get("processing_duration")
+        if processing_duration is not None:
+            self.processing_duration.observe(processing_duration)
+        handler_test_durations = metrics.get("handler_test_durations")
+        if handler_test_durations:
+            self.handler_test_duration.observe(sum(handler_test_durations))
+
+    def summary(self) -> BotUpdateMetricsSummary:
+        return BotUpdateMetricsSummary(
+            updates=sum(self.updates_by_type.values()),
+            unhandled_updates=self.unhandled_updates,
+            errors=self.errors,
+            recent_updates_per_minute=self.recent_updates.per_minute(now=time.time()),
+            avg_processing_duration=(
+                self.processing_duration.sum / self.processing_duration.count
+                if self.processing_duration.count
+                else None
+            ),
+            p95_processing_duration=self.processing_duration.quantile(0.95),
+            last_update_at=self.last_update_at,
+        )
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_labels(**labels: str) -> str:
+    return ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in labels.items())
+
+
+def prometheus_histogram_lines(name: str, labels: str, histogram: DurationHistogram) -> list[str]:
+    lines: list[str] = []
+    for upper_bound, cumulative_count in histogram.cumulative_counts():
+        le = "+Inf" if math.isinf(upper_bound) else repr(upper_bound)
+        lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative_count}')
+    lines.append(f"{name}_sum{{{labels}}} {histogram.sum!r}")
+    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+    return lines
+
+
+def merge_prometheus_texts(texts: Iterable[str]) -> str:
+    """
+    Merge texts in Prometheus text exposition format, rendered for different bots (e.g. in different processes),
+    into one, so that each metric family is declared once and followed by all of its samples
+    """
+    headers: dict[str, list[str]] = dict()  # metric family name -> HELP and TYPE lines, in order of appearance
+    samples: dict[str, list[str]] = collections.defaultdict(list)
+    family = ""
+    for text in texts:
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("# "):
+                family = line.split(" ", 3)[2]
+                family_headers = headers.setdefault(family, [])
+                if line not in family_headers:
+                    family_headers.append(line)
+            else:
+                samples[family].append(line)
+    lines: list[str] = []
+    for family in [*headers, *(f for f in samples if f not in headers)]:
+        lines.extend(headers.get(family, []))
+        lines.extend(samples[family])
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+class UpdateMetricsCollector:
+    """
+    Aggregates Telegram update metrics per bot in memory. Metrics handlers are called on the event loop
+    and update plain counters without awaiting anything, so no locking is needed.
+
+    NOTE: aggregates are local to the process, so bots running in worker processes of the sharded runner
+    are collected by their workers' collectors and are requested from them by the runner.
+    """
+
+    METRIC_PREFIX = "telebot_constructor"
+
+    def __init__(self) -> None:
+        self._metrics: dict[tuple[str, str], BotUpdateMetrics] = dict()
+
+    def handler_for(self, owner_id: str, bot_id: str) -> TelegramUpdateMetricsHandler:
+        # aggregates are kept across bot restarts, so counters are monotonic
+        bot_metrics = self._metrics.setdefault((owner_id, bot_id), BotUpdateMetrics())
+
+        async def handler(metrics: TelegramUpdateMetrics) -> None:
+            bot_metrics.observe(metrics)
+
+        return handler
+
+    def drop(self, owner_id: str, bot_id: str) -> None:
+        self._metrics.pop((owner_id, bot_id), None)
+
+    def summary(self, owner_id: str, bot_id: str) -> Optional[BotUpdateMetricsSummary]:
+        bot_metrics = self._metrics.get((owner_id, bot_id))
+        return bot_metrics.summary() if bot_metrics is not None else None
+
+    def render_prometheus(self) -> str:
+        """Metrics in Prometheus text exposition format"""
+        p = self.METRIC_PREFIX
+        lines: list[str] = []
+
+        lines.append(f"# HELP {p}_updates_total Telegram updates received by the bot")
+        lines.append(f"# TYPE {p}_updates_total counter")
+        for (owner_id, bot_id), bot_metrics in self._metrics.items():
+            for update_type, count in sorted(bot_metrics.updates_by_type.items()):
+                labels = prometheus_labels(owner_id=owner_id, bot_id=bot_id, update_type=update_type)
+                lines.append(f"{p}_updates_total{{{labels}}} {count}")
+
+        lines.append(f"# HELP {p}_unhandled_updates_total Telegram updates not matched by any handler")
+        lines.append(f"# TYPE {p}_unhandled_updates_total counter")
+        for (owner_id, bot_id), bot_metrics in self._metrics.items():
+            labels = prometheus_labels(owner_id=owner_id, bot_id=bot_id)
+            lines.append(f"{p}_unhandled_updates_total{{{labels}}} {bot_metrics.unhandled_updates}")
+
+        lines.append(f"# HELP {p}_update_errors_total Telegram updates with handler raising an exception")
+        lines.append(f"# TYPE {p}_update_errors_total counter")
+        for (owner_id, bot_id), bot_metrics in self._metrics.items():
+            labels = prometheus_labels(owner_id=owner_id, bot_id=bot_id)
+            lines.append(f"{p}_update_errors_total{{{labels}}} {bot_metrics.errors}")
+
+        lines.append(f"# HELP {p}_update_processing_seconds Duration of the matched handler execution")
+        lines.append(f"# TYPE {p}_update_processing_seconds histogram")
+        for (owner_id, bot_id), bot_metrics in self._metrics.items():
+            labels = prometheus_labels(owner_id=owner_id, bot_id=bot_id)
+            lines.extend(
+                prometheus_histogram_lines(f"{p}_update_processing_seconds", labels, bot_metrics.processing_duration)
+            )
+
+        lines.append(f"# HELP {p}_handler_matching_seconds Total duration of testing handlers for the update")
+        lines.append(f"# TYPE {p}_handler_matching_seconds histogram")
+        for (owner_id, bot_id), bot_metrics in self._metrics.items():
+            labels = prometheus_labels(owner_id=owner_id, bot_id=bot_id)
+            lines.extend(
+                prometheus_histogram_lines(f"{p}_handler_matching_seconds", labels, bot_metrics.handler_test_duration)
+            )
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,179 @@
+import asyncio
+import collections
+import contextlib
+import time
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, Optional
+
+from pydantic import BaseModel, Field
+
+from telebot_constructor.update_metrics import (
+    DurationHistogram,
+    prometheus_histogram_lines,
+    prometheus_labels,
+)
+
+# owner id, bot id
+BotKey = tuple[str, str]
+
+
+class UpdateSchedulerConfig(BaseModel):
+    max_concurrency: int = Field(default=256, ge=1)  # updates processed concurrently across all bots
+    max_concurrency_per_bot: int = Field(default=16, ge=1)
+    max_queue_size_per_bot: int = Field(default=1024, ge=1)  # new updates are not received while the queue is full
+
+
+class BotQueueMetricsSummary(BaseModel):
+    queued: int  # updates waiting to be processed
+    running: int  # updates being processed
+    processed: int  # total updates that started processing
+    avg_wait_duration: Optional[float]  # seconds from queueing to processing start
+    p95_wait_duration: Optional[float]  # seconds, histogram bucket upper bound
+
+
+@dataclass
+class _BotQueue:
+    waiters: collections.deque[asyncio.Future[None]] = field(default_factory=collections.deque)
+    running: int = 0
+    processed: int = 0
+    # unweighted fair queuing: bot's virtual time advances by 1 for every started update, equally for all bots
+    virtual_time: float = 0.0
+    wait_duration: DurationHistogram = field(default_factory=DurationHistogram)
+    has_space: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def summary(self) -> BotQueueMetricsSummary:
+        return BotQueueMetricsSummary(
+            queued=len(self.waiters),
+            running=self.running,
+            processed=self.processed,
+            avg_wait_duration=(self.wait_duration.sum / self.wait_duration.count if self.wait_duration.count else None),
+            p95_wait_duration=self.wait_duration.quantile(0.95),
+        )
+
+
+class FairUpdateScheduler:
+    """
+    Shares update processing concurrency between bots running on the same event loop. Each bot has
+    a bounded queue of updates and a limit on concurrently processed ones; free processing slots go to
+    the queued bot with the smallest virtual time. Fair queuing is unweighted: all bots get equal
+    shares, so a bot flooded with updates doesn't increase the latency for other bots.
+    """
+
+    METRIC_PREFIX = "telebot_constructor"
+
+    def __init__(self, config: UpdateSchedulerConfig | None = None) -> None:
+        self.config = config or UpdateSchedulerConfig()
+        self.max_concurrency = self.config.max_concurrency
+        self.max_concurrency_per_bot = self.config.max_concurrency_per_bot
+        self.max_queue_size_per_bot = self.config.max_queue_size_per_bot
+        self._queues: dict[BotKey, _BotQueue] = dict()
+        self._running = 0
+        self._virtual_time = 0.0  # virtual time of the last started update
+
+    def _queue(self, bot_key: BotKey) -> _BotQueue:
+        queue = self._queues.get(bot_key)
+        if queue is None:
+            queue = _BotQueue()
+            queue.has_space.set()
+            self._queues[bot_key] = queue
+        return queue
+
+    def _update_has_space(self, queue: _BotQueue) -> None:
+        if len(queue.waiters) < self.max_queue_size_per_bot:
+            queue.has_space.set()
+        else:
+            queue.has_space.clear()
+
+    def drop(self, bot_key: BotKey) -> None:
+        """Forget the stopped bot's queue and metrics; a queue still in use is kept"""
+        queue = self._queues.get(bot_key)
+        if queue is not None and not queue.waiters and queue.running == 0:
+            self._queues.pop(bot_key)
+
+    async def wait_for_queue_space(self, bot_key: BotKey) -> None:
+        """To be awaited before receiving new updates for the bot, so that its queue stays bounded"""
+        await self._queue(bot_key).has_space.wait()
+
+    def _dispatch(self) -> None:
+        while self._running < self.max_concurrency:
+            next_queue: Optional[_BotQueue] = None
+            for queue in self._queues.values():
+                if not queue.waiters or queue.running >= self.max_concurrency_per_bot:
+                    continue
+                if next_queue is None or queue.virtual_time < next_queue.virtual_time:
+                    next_queue = queue
+            if next_queue is None:
+                return
+            waiter = next_queue.waiters.popleft()
+            self._update_has_space(next_queue)
+            if waiter.done():  # cancelled while waiting
+                continue
+            next_queue.running += 1
+            next_queue.processed += 1
+            next_queue.virtual_time += 1
+            self._virtual_time = max(self._virtual_time, next_queue.virtual_time)
+            self._running += 1
+            waiter.set_result(None)
+
+    def _release(self, queue: _BotQueue) -> None:
+        queue.running -= 1
+        self._running -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, bot_key: BotKey) -> AsyncGenerator[None, None]:
+        """Wait for the bot's turn to process an update and hold the processing slot until the context exits"""
+        queue = self._queue(bot_key)
+        if not queue.waiters and queue.running == 0:
+            # a bot becoming active doesn't get credit for the time it was idle
+            queue.virtual_time = max(queue.virtual_time, self._virtual_time)
+        waiter = asyncio.get_running_loop().create_future()
+        queue.waiters.append(waiter)
+        self._update_has_space(queue)
+        queued_at = time.perf_counter()
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was granted, but the update was cancelled before it started processing
+                self._release(queue)
+            else:
+                with contextlib.suppress(ValueError):
+                    queue.waiters.remove(waiter)
+                self._update_has_space(queue)
+            raise
+        queue.wait_duration.observe(time.perf_counter() - queued_at)
+        try:
+            yield
+        finally:
+            self._release(queue)
+
+    def summary(self, bot_key: BotKey) -> Optional[BotQueueMetricsSummary]:
+        queue = self._queues.get(bot_key)
+        return queue.summary() if queue is not None else None
+
+    def render_prometheus(self) -> str:
+        """Metrics in Prometheus text exposition format"""
+        p = self.METRIC_PREFIX
+        lines: list[str] = []
+
+        lines.append(f"# HELP {p}_queued_updates Updates waiting to be processed")
+        lines.append(f"# TYPE {p}_queued_updates gauge")
+        for (owner_id, bot_id), queue in self._queues.items():
+            labels = prometheus_labels(owner_id=owner_id, bot_id=bot_id)
+            lines.append(f"{p}_queued_updates{{{labels}}} {len(queue.waiters)}")
+
+        lines.append(f"# HELP {p}_running_updates Updates being processed")
+        lines.append(f"# TYPE {p}_running_updates gauge")
+        for (owner_id, bot_id), queue in self._queues.items():
+            labels = prometheus_labels(owner_id=owner_id, bot_id=bot_id)
+            lines.append(f"{p}_running_updates{{{labels}}} {queue.running}")
+
+        lines.append(f"# HELP {p}_update_queue_wait_seconds Time updates spent in the queue before processing")
+        lines.append(f"# TYPE {p}_update_queue_wait_seconds histogram")
+        for (owner_id, bot_id), queue in self._queues.items():
+            labels = prometheus_labels(owner_id=owner_id, bot_id=bot_id)
+            lines.extend(prometheus_histogram_lines(f"{p}_update_queue_wait_seconds", labels, queue.wait_duration))
+
+        return "\n".join(lines) + "\n"
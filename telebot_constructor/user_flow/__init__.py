@@ -1,5 +1,4 @@
 import collections
-import copy
 import dataclasses
 import datetime
 import logging
@@ -14,20 +13,27 @@ from telebot_components.stores.generic import KeyValueStore
 from telebot_constructor.store.errors import BotSpecificErrorsStore
 from telebot_constructor.store.form_results import BotSpecificFormResultsStore
 from telebot_constructor.store.media import UserSpecificMediaStore
+from telebot_constructor.user_flow.block_metrics import (
+    BlockInstrumentation,
+    measure_block_enter,
+)
 from telebot_constructor.user_flow.blocks.base import UserFlowBlock
+from telebot_constructor.user_flow.blocks.content import ContentBlock
 from telebot_constructor.user_flow.blocks.form import FormBlock
 from telebot_constructor.user_flow.blocks.human_operator import HumanOperatorBlock
 from telebot_constructor.user_flow.blocks.language_select import LanguageSelectBlock
 from telebot_constructor.user_flow.blocks.menu import Menu, MenuBlock
 from telebot_constructor.user_flow.entrypoints.base import UserFlowEntryPoint
 from telebot_constructor.user_flow.entrypoints.command import CommandEntryPoint
+from telebot_constructor.user_flow.entrypoints.router import EntryPointRouter
+from telebot_constructor.user_flow.media_uploads import TelegramFileIdCache
 from telebot_constructor.user_flow.types import (
     SetupResult,
     UserFlowBlockId,
     UserFlowContext,
     UserFlowSetupContext,
 )
-from telebot_constructor.utils import validate_unique
+from telebot_constructor.utils import AnyChatId, validate_unique
 
 logger = logging.getLogger(__name__)
 
@@ -36,9 +42,11 @@ logger = logging.getLogger(__name__)
 class UserFlow:
     entrypoints: List[UserFlowEntryPoint]
     blocks: List[UserFlowBlock]
+    media_warm_up_chat_id: Optional[AnyChatId] = None
 
     def __post_init__(self) -> None:
         self._active_block_id_store: Optional[KeyValueStore[str]] = None
+        self._block_instrumentation: Optional[BlockInstrumentation] = None
 
         validate_unique([b.block_id for b in self.blocks], items_name="block ids")
         validate_unique([e.entrypoint_id for e in self.entrypoints], items_name="entrypoint ids")
@@ -85,6 +93,7 @@ class UserFlow:
 
         validate_unique([b.form_name for b in self.blocks if isinstance(b, FormBlock)], items_name="form names")
         self._construct_menu_trees()
+        self._coalesce_content_chains()
 
     def _construct_menu_trees(self) -> None:
         """
@@ -100,9 +109,19 @@ class UserFlow:
 
         The process of building a menu tree consists of two phases:
         - BFS-traversal of the free-form block graph to create a tree subgraph
-        - DFS-traversal of this tree to convert it to a menu tree
-        This is done for every menu block independently.
+        - post-order traversal of this tree to convert it to a menu tree
+        This is done for every menu block independently, but the resulting menu trees share identical
+        subtrees: a subtree is identified by its block id and the ids of its children's subtrees, and
+        is only built once. So, e.g. many menus leading to the same submenu hierarchy reference a single
+        copy of it. Menu objects in the trees must not be mutated after this point.
         """
+        # menus as configured, before replacing them with trees
+        menu_by_block_id = {block.block_id: block.menu for block in self.blocks if isinstance(block, MenuBlock)}
+
+        # (block id, subtree ids of its children) -> subtree id
+        subtree_ids: dict[tuple[str, tuple[int, ...]], int] = dict()
+        subtrees: list[Menu] = []
+
         for block in self.blocks:
             if not isinstance(block, MenuBlock):
                 continue
@@ -115,38 +134,86 @@ class UserFlow:
                 seen_block_ids.update(to_visit)  # we mark all next step's field as visited to not go to them again
                 to_visit_next = set[str]()
                 for current_block_id in sorted(to_visit):  # sorting blocks lexicographically to ensure consistency
-                    current_block = self.block_by_id[current_block_id]
-                    if not isinstance(current_block, MenuBlock):
+                    current_menu = menu_by_block_id.get(current_block_id)
+                    if current_menu is None:
                         continue
-                    for menu_item in current_block.menu.items:
+                    for menu_item in current_menu.items:
                         next_block_id = menu_item.next_block_id
                         if next_block_id is not None and next_block_id not in seen_block_ids:
                             menu_block_tree[current_block_id].add(next_block_id)
                             to_visit_next.add(next_block_id)
                 to_visit = to_visit_next
 
-            # phase 2: building a Menu object with submenus taken from other blocks according to a tree
-            # basically a DFS traversal with recursive function
-            def menu_tree_starting_with(block_id: str) -> Menu | None:
-                block = self.block_by_id[block_id]
-                if not isinstance(block, MenuBlock):
-                    return None
-                menu_with_submenus = copy.deepcopy(block.menu)
-                for child_id in menu_block_tree.get(block_id, set()):
-                    child_menu_tree = menu_tree_starting_with(child_id)
-                    if child_menu_tree is None:
-                        continue
-                    for menu_item in menu_with_submenus.items:
-                        if menu_item.next_block_id == child_id:
-                            menu_item.next_block_id = None
-                            menu_item.submenu = child_menu_tree
-                return menu_with_submenus
-
-            menu_tree = menu_tree_starting_with(block.block_id)
-            if menu_tree is not None:
-                block.menu = menu_tree
-            else:
-                logger.error("Something went wrong, failed to assemble menu tree!")
+            # phase 2: building a Menu object with submenus taken from other blocks according to a tree,
+            # reusing already built subtrees
+            def subtree_starting_with(block_id: str) -> int:
+                child_subtree_id_by_block_id = {
+                    child_id: subtree_starting_with(child_id)
+                    for child_id in sorted(menu_block_tree.get(block_id, set()))
+                    if child_id in menu_by_block_id
+                }
+                key = (block_id, tuple(child_subtree_id_by_block_id.values()))
+                subtree_id = subtree_ids.get(key)
+                if subtree_id is not None:
+                    return subtree_id
+                menu = menu_by_block_id[block_id]
+                menu_with_submenus = menu.model_copy(
+                    update={
+                        "items": [
+                            (
+                                menu_item.model_copy(
+                                    update={
+                                        "next_block_id": None,
+                                        "submenu": subtrees[child_subtree_id_by_block_id[menu_item.next_block_id]],
+                                    }
+                                )
+                                if menu_item.next_block_id in child_subtree_id_by_block_id
+                                else menu_item
+                            )
+                            for menu_item in menu.items
+                        ]
+                    }
+                )
+                subtree_id = len(subtrees)
+                subtrees.append(menu_with_submenus)
+                subtree_ids[key] = subtree_id
+                return subtree_id
+
+            block.menu = subtrees[subtree_starting_with(block.block_id)]
+
+    def _coalesce_content_chains(self) -> None:
+        """
+        A chain of content blocks, each entered only from the previous one, is sent by its first block: texts
+        at the block boundaries are merged into a single message where possible, and the rest of the messages
+        are sent in one go. The rest of the chain's blocks are still entered as usual (so they have block
+        metrics and become active blocks), but don't send anything themselves.
+        """
+        chain_member_ids = {
+            block.block_id
+            for block in self.blocks
+            if isinstance(block, ContentBlock)
+            and len(leading_to := self.nodes_leading_to[block.block_id]) == 1
+            and isinstance(self.block_by_id.get(leading_to[0]), ContentBlock)
+        }
+        for block in self.blocks:
+            if not isinstance(block, ContentBlock) or block.block_id in chain_member_ids:
+                continue
+            chain: list[ContentBlock] = []
+            chain_block_ids = {block.block_id}
+            current = block
+            while current.next_block_id is not None:
+                next_block = self.block_by_id[current.next_block_id]
+                if (
+                    not isinstance(next_block, ContentBlock)
+                    or next_block.block_id in chain_block_ids
+                    or self.nodes_leading_to[next_block.block_id] != [current.block_id]
+                ):
+                    break
+                chain.append(next_block)
+                chain_block_ids.add(next_block.block_id)
+                current = next_block
+            if chain:
+                block.coalesce(chain)
 
     @property
     def active_block_id_store(self) -> KeyValueStore[str]:
@@ -166,7 +233,11 @@ class UserFlow:
         if block is None:
             raise ValueError(f"Attempt to enter non-existent block with id {id}")
         await self.active_block_id_store.save(context.user.id, block.block_id)
-        await block.enter(context)
+        if self._block_instrumentation is None:
+            await block.enter(context)
+        else:
+            with measure_block_enter(self._block_instrumentation, block):
+                await block.enter(context)
 
     async def _get_active_block_id(self, user_id: int) -> Optional[UserFlowBlockId]:
         return await self.active_block_id_store.load(user_id)
@@ -180,7 +251,9 @@ class UserFlow:
         form_results_store: BotSpecificFormResultsStore,
         errors_store: BotSpecificErrorsStore,
         media_store: UserSpecificMediaStore | None,
+        block_instrumentation: BlockInstrumentation | None = None,
     ) -> SetupResult:
+        self._block_instrumentation = block_instrumentation
         self._active_block_id_store = KeyValueStore[str](
             name="user-flow-active-block",
             prefix=bot_prefix,
@@ -190,6 +263,8 @@ class UserFlow:
             loader=str,
         )
 
+        tg_file_id_cache = TelegramFileIdCache(bot_prefix=bot_prefix, redis=redis, errors_store=errors_store)
+
         # setting up flow elements
         setup_result = SetupResult.empty()
         setup_context = UserFlowSetupContext(
@@ -200,6 +275,7 @@ class UserFlow:
             errors_store=errors_store,
             banned_users_store=banned_users_store,
             media_store=media_store,
+            tg_file_id_cache=tg_file_id_cache,
             feedback_handlers=dict(),
             language_store=None,
             enter_block=self._enter_block,
@@ -230,6 +306,8 @@ class UserFlow:
             except Exception as e:
                 raise ValueError(f"Error setting up {entrypoint}: {e}") from e
             setup_result.merge(entrypoint_setup_result)
+        # a single handler dispatching messages to command and regex entrypoints
+        EntryPointRouter(self.entrypoints).setup(setup_context)
 
         for idx, block in enumerate(self.blocks):
             if block.block_id in setup_block_ids:
@@ -241,4 +319,27 @@ class UserFlow:
                 raise ValueError(f"Error setting up {block}: {e}") from e
             setup_result.merge(block_setup_result)
 
+        media_ids = self._media_ids_to_warm_up()
+        if media_ids and media_store is not None and self.media_warm_up_chat_id is not None:
+            # uploading media in the background, concurrent first-time sends will wait for it
+            logger.info(f"[{bot_prefix}] Warming up {len(media_ids)} media in chat {self.media_warm_up_chat_id}")
+            setup_result.background_jobs.append(
+                tg_file_id_cache.warm_up(
+                    bot=bot,
+                    media_store=media_store,
+                    media_ids=media_ids,
+                    chat_id=self.media_warm_up_chat_id,
+                )
+            )
+
         return setup_result
+
+    def _media_ids_to_warm_up(self) -> list[str]:
+        media_ids: dict[str, None] = dict()  # dict to preserve order
+        for block in self.blocks:
+            if not isinstance(block, ContentBlock):
+                continue
+            for content in block.contents:
+                for attachment in content.attachments:
+                    media_ids[attachment.media_id()] = None
+        return list(media_ids)
@@ -0,0 +1,208 @@
+import abc
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import datetime
+import logging
+import time
+from dataclasses import dataclass
+from typing import Generator, Optional
+
+from pydantic import BaseModel, Field, TypeAdapter
+from telebot_components.redis_utils.interface import RedisInterface
+from telebot_components.stores.generic import KeyDictStore
+
+from telebot_constructor.update_metrics import DURATION_BUCKETS, DurationHistogram
+from telebot_constructor.user_flow.blocks.base import UserFlowBlock
+from telebot_constructor.user_flow.types import UserFlowBlockId
+from telebot_constructor.utils.redis_lock import redis_lock
+
+logger = logging.getLogger(__name__)
+
+BLOCK_METRICS_KEY = "all"
+
+
+class BlockMetrics(BaseModel):
+    """Counters and entering duration histogram for a single block, mergeable to aggregate over time"""
+
+    block_type: str
+    entered: int = 0
+    errors: int = 0
+    duration_sum: float = 0.0
+    # see DURATION_BUCKETS, the last one is +Inf bucket
+    duration_bucket_counts: list[int] = Field(default_factory=lambda: [0] * (len(DURATION_BUCKETS) + 1))
+
+    def observe(self, duration: float, is_error: bool) -> None:
+        self.duration_bucket_counts[bisect.bisect_left(DURATION_BUCKETS, duration)] += 1
+        self.duration_sum += duration
+        self.entered += 1
+        if is_error:
+            self.errors += 1
+
+    def merge(self, other: "BlockMetrics") -> "BlockMetrics":
+        return BlockMetrics(
+            block_type=other.block_type,
+            entered=self.entered + other.entered,
+            errors=self.errors + other.errors,
+            duration_sum=self.duration_sum + other.duration_sum,
+            duration_bucket_counts=[a + b for a, b in zip(self.duration_bucket_counts, other.duration_bucket_counts)],
+        )
+
+    def duration_histogram(self) -> DurationHistogram:
+        histogram = DurationHistogram()
+        histogram.counts = list(self.duration_bucket_counts)
+        histogram.sum = self.duration_sum
+        histogram.count = sum(self.duration_bucket_counts)
+        return histogram
+
+    def summary(self) -> "BlockMetricsSummary":
+        histogram = self.duration_histogram()
+        return BlockMetricsSummary(
+            block_type=self.block_type,
+            entered=self.entered,
+            errors=self.errors,
+            avg_duration=self.duration_sum / histogram.count if histogram.count else None,
+            p95_duration=histogram.quantile(0.95),
+        )
+
+
+class BlockMetricsSummary(BaseModel):
+    block_type: str  # e.g. "ContentBlock"
+    entered: int
+    errors: int
+    avg_duration: Optional[float]  # seconds, not including blocks entered from this one
+    p95_duration: Optional[float]  # seconds, histogram bucket upper bound
+
+
+BlockMetricsSummaries = TypeAdapter(dict[UserFlowBlockId, BlockMetricsSummary])
+
+
+def block_metrics_store(bot_prefix: str, redis: RedisInterface) -> KeyDictStore[BlockMetrics]:
+    # BLOCK_METRICS_KEY -> block id -> metrics
+    return KeyDictStore[BlockMetrics](
+        name="block-metrics",
+        prefix=bot_prefix,
+        redis=redis,
+        expiration_time=datetime.timedelta(days=30),
+        dumper=BlockMetrics.model_dump_json,
+        loader=BlockMetrics.model_validate_json,
+    )
+
+
+async def load_block_metrics(bot_prefix: str, redis: RedisInterface) -> dict[UserFlowBlockId, BlockMetricsSummary]:
+    metrics = await block_metrics_store(bot_prefix, redis).load(BLOCK_METRICS_KEY)
+    return {block_id: block_metrics.summary() for block_id, block_metrics in metrics.items()}
+
+
+class BlockInstrumentation(abc.ABC):
+    """Hooks called by the user flow on every block entering"""
+
+    @abc.abstractmethod
+    def on_block_entered(self, block: UserFlowBlock, duration: float, exception: Optional[BaseException]) -> None:
+        """
+        Called after the block's enter method returned or raised; duration does not include time spent
+        in blocks entered from this one, exception is passed only if it was raised by this block
+        """
+        ...
+
+
+@dataclass
+class _EnterFrame:
+    nested_duration: float = 0.0
+    nested_exception: Optional[BaseException] = None
+
+
+_current_enter_frame: contextvars.ContextVar[Optional[_EnterFrame]] = contextvars.ContextVar(
+    "current_enter_frame", default=None
+)
+
+
+@contextlib.contextmanager
+def measure_block_enter(instrumentation: BlockInstrumentation, block: UserFlowBlock) -> Generator[None, None, None]:
+    parent_frame = _current_enter_frame.get()
+    frame = _EnterFrame()
+    token = _current_enter_frame.set(frame)
+    start_time = time.perf_counter()
+    exception: Optional[BaseException] = None
+    try:
+        yield
+    except BaseException as e:
+        exception = e
+        raise
+    finally:
+        duration = time.perf_counter() - start_time
+        _current_enter_frame.reset(token)
+        if parent_frame is not None:
+            parent_frame.nested_duration += duration
+            parent_frame.nested_exception = exception
+        own_exception = exception if exception is not frame.nested_exception else None
+        try:
+            instrumentation.on_block_entered(block, duration - frame.nested_duration, own_exception)
+        except Exception:
+            logger.exception("Error in block instrumentation hook")
+
+
+class BlockMetricsCollector(BlockInstrumentation):
+    """
+    Aggregates block metrics in memory and periodically adds them to the ones stored in Redis.
+    Hooks are called on the event loop and don't await anything, so no locking is needed.
+    """
+
+    LOCK_EXPIRATION = datetime.timedelta(seconds=30)
+
+    def __init__(
+        self,
+        bot_prefix: str,
+        redis: RedisInterface,
+        flush_period: datetime.timedelta = datetime.timedelta(minutes=1),
+    ) -> None:
+        self.bot_prefix = bot_prefix
+        self.flush_period = flush_period
+        self._redis = redis
+        self._store = block_metrics_store(bot_prefix, redis)
+        self._pending: dict[UserFlowBlockId, BlockMetrics] = dict()
+
+    def on_block_entered(self, block: UserFlowBlock, duration: float, exception: Optional[BaseException]) -> None:
+        block_metrics = self._pending.get(block.block_id)
+        if block_metrics is None:
+            block_metrics = BlockMetrics(block_type=block.__class__.__name__)
+            self._pending[block.block_id] = block_metrics
+        block_metrics.observe(duration, is_error=exception is not None)
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, dict()
+        if not pending:
+            return
+        # stored metrics are read, merged and written back under the lock, because during a restart the old
+        # and the new bot versions (possibly in different processes) flush their metrics concurrently
+        try:
+            async with redis_lock(
+                self._redis, key=f"{self.bot_prefix}/block-metrics-lock", expiration=self.LOCK_EXPIRATION
+            ):
+                for block_id in list(pending.keys()):
+                    block_metrics = pending[block_id]
+                    stored = await self._store.get_subkey(BLOCK_METRICS_KEY, block_id)
+                    if stored is not None and stored.block_type == block_metrics.block_type:
+                        block_metrics = stored.merge(block_metrics)
+                    await self._store.set_subkey(BLOCK_METRICS_KEY, block_id, block_metrics)
+                    del pending[block_id]
+        finally:
+            # metrics not written to the store are kept until the next flush
+            for block_id, block_metrics in pending.items():
+                collected_since = self._pending.get(block_id)
+                self._pending[block_id] = (
+                    block_metrics if collected_since is None else block_metrics.merge(collected_since)
+                )
+
+    async def flush_periodically(self) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.flush_period.total_seconds())
+                try:
+                    await self.flush()
+                except Exception:
+                    logger.exception(f"[{self.bot_prefix}] Error flushing block metrics")
+        finally:
+            # not to lose metrics collected since the last flush when the bot is stopped
+            await self.flush()
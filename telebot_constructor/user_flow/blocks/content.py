@@ -1,18 +1,24 @@
-import datetime
+import asyncio
+import contextlib
 import hashlib
 import logging
 import re
 from dataclasses import dataclass
-from typing import Any, Optional
+from typing import Any, Optional, Sequence
 
 from pydantic import BaseModel
 from telebot import types as tg
-from telebot_components.language import any_text_to_str, vaildate_singlelang_text
-from telebot_components.stores.generic import KeyValueStore
+from telebot.util import MAX_MESSAGE_LENGTH
+from telebot_components.language import (
+    MaybeLanguage,
+    any_text_to_str,
+    vaildate_singlelang_text,
+)
 from telebot_components.utils import TextMarkup
 
 from telebot_constructor.store.media import Media
 from telebot_constructor.user_flow.blocks.base import UserFlowBlock
+from telebot_constructor.user_flow.media_uploads import uploaded_photo_file_id
 from telebot_constructor.user_flow.types import (
     SetupResult,
     UserFlowBlockId,
@@ -27,6 +33,7 @@ from telebot_constructor.utils import (
 from telebot_constructor.utils.pydantic import (
     ExactlyOneNonNullFieldModel,
     LocalizableText,
+    join_localizable_texts,
 )
 
 
@@ -49,6 +56,22 @@ class ContentText(BaseModel):
         else:
             return any(len(v) == 0 for v in self.text.values())
 
+    @classmethod
+    def join(cls, texts: Sequence["ContentText"], sep: str) -> "ContentText":
+        """Texts must have the same markup; preprocessed texts are joined as is, not preprocessed again"""
+        if len({t.markup for t in texts}) != 1:
+            raise ValueError("Only texts with the same markup can be joined")
+        joined = cls(text=join_localizable_texts([t.text for t in texts], sep), markup=texts[0].markup)
+        joined._preprocessed_text = join_localizable_texts([t.preprocessed for t in texts], sep)
+        return joined
+
+    def max_preprocessed_length(self) -> int:
+        preprocessed = self.preprocessed
+        if isinstance(preprocessed, str):
+            return len(preprocessed)
+        else:
+            return max(len(v) for v in preprocessed.values())
+
 
 DATA_URL_PREFIX_REGEX = re.compile(r"^data:\w+/\w+;base64,")
 
@@ -75,6 +98,19 @@ class Content(BaseModel):
         self.attachments = [a for a in self.attachments if not a.is_legacy_base64_image()]
 
 
+def merge_text_contents(first: Content, second: Content) -> Optional[Content]:
+    """Merge two text-only contents into one, if it fits into a single message; None otherwise"""
+    if first.text is None or second.text is None or first.attachments or second.attachments:
+        return None
+    try:
+        text = ContentText.join([first.text, second.text], sep="\n\n")
+    except ValueError:
+        return None
+    if text.max_preprocessed_length() > MAX_MESSAGE_LENGTH:
+        return None
+    return Content(text=text, attachments=[])
+
+
 class ContentBlock(UserFlowBlock):
     """
     Simplest user flow block: static content sent by bot in one or several telegram messages.
@@ -118,6 +154,27 @@ class ContentBlock(UserFlowBlock):
             contents_validated.append(c)
 
         self.contents = contents_validated
+        # differ from the block's own contents and next block when it's coalesced with the following blocks
+        self._contents_to_send = self.contents
+        self._next_block_id_after_contents = self.next_block_id
+
+    def coalesce(self, following_blocks: list["ContentBlock"]) -> None:
+        """
+        Make the block send contents of the following content blocks as well. Consecutive blocks' texts are
+        merged into a single message where possible. The following blocks are still entered one by one, but
+        they don't send anything themselves. Called at the user flow construction for chains of content blocks.
+        """
+        contents = list(self.contents)
+        for block in following_blocks:
+            merged = merge_text_contents(contents[-1], block.contents[0])
+            if merged is not None:
+                contents[-1] = merged
+                contents.extend(block.contents[1:])
+            else:
+                contents.extend(block.contents)
+        self._contents_to_send = contents
+        for block in following_blocks:
+            block._contents_to_send = []
 
     @classmethod
     def simple_text(
@@ -140,113 +197,171 @@ class ContentBlock(UserFlowBlock):
 
     async def enter(self, context: UserFlowContext) -> None:
         chat_id = context.chat.id if context.chat is not None else context.user.id
-        language = (
-            await self._language_store.get_user_language(context.user) if self._language_store is not None else None
-        )
-        for content in self.contents:
-            parse_mode = content.text.markup.parse_mode() if content.text is not None else None
-
-            # preparing attachments: either loading from cache or from storage
-            prepared_attachments: list[PreparedAttachment] = []
-            for attachment in content.attachments:
-                source: str | Media | None = await self._tg_file_id_by_media_id_store.load(attachment.media_id())
-                if source is None and self._media_store is not None:
-                    source = await self._media_store.load_media(attachment.media_id())
-                    if source is None:
-                        self._logger.error(
-                            f"Failed to load media from the store: {attachment.media_id()}; will proceed without it"
-                        )
-                if source is not None:
-                    prepared_attachments.append(
-                        PreparedAttachment(
-                            attachment=attachment,
-                            source=source,
-                        )
-                    )
-            self._logger.debug("Prepared attachments: %s", prepared_attachments)
-
-            if not prepared_attachments:
-                if content.text is not None:
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=any_text_to_str(content.text.preprocessed, language),
-                        parse_mode=parse_mode,
-                        reply_markup=tg.ReplyKeyboardRemove(),
+        language = await context.get_language()
+        contents = self._contents_to_send
+        if not contents:
+            # the block's contents are sent by the first block of the coalesced chain
+            if self._next_block_id_after_contents is not None:
+                await context.enter_block(self._next_block_id_after_contents, context)
+            return
+        # media ids each content is responsible for uploading, see TelegramFileIdCache
+        uploading_media_ids: list[set[str]] = [set() for _ in contents]
+        # attachments for the next content are prepared while the current one is being sent; the sends
+        # themselves are sequential to keep the order of messages
+        preparing = self._start_preparing_attachments(contents[0], uploading_media_ids[0])
+        try:
+            for idx, content in enumerate(contents):
+                prepared_attachments = await preparing if preparing is not None else []
+                preparing = (
+                    self._start_preparing_attachments(contents[idx + 1], uploading_media_ids[idx + 1])
+                    if idx + 1 < len(contents)
+                    else None
+                )
+                try:
+                    await self._send_content(
+                        context, chat_id, content, prepared_attachments, language, uploading_media_ids[idx]
                     )
-                else:
-                    self._logger.error("Empty content block: no text and no attachments!")
+                finally:
+                    # reporting failed uploads so that concurrent senders (incl. the next content) don't wait for them
+                    await self._finish_uploads(uploading_media_ids[idx])
+        finally:
+            if preparing is not None and preparing.cancel():
+                with contextlib.suppress(asyncio.CancelledError):
+                    await preparing
+            for media_ids in uploading_media_ids:
+                await self._finish_uploads(media_ids)
+
+        if self._next_block_id_after_contents is not None:
+            await context.enter_block(self._next_block_id_after_contents, context)
+
+    def _start_preparing_attachments(
+        self, content: Content, uploading_media_ids: set[str]
+    ) -> Optional[asyncio.Task[list["PreparedAttachment"]]]:
+        if not content.attachments:
+            return None
+        return asyncio.create_task(self._prepare_attachments(content, uploading_media_ids))
+
+    async def _finish_uploads(self, uploading_media_ids: set[str]) -> None:
+        while uploading_media_ids:
+            await self._tg_file_id_cache.finish_upload(uploading_media_ids.pop(), file_id=None)
+
+    async def _prepare_attachments(self, content: Content, uploading_media_ids: set[str]) -> list["PreparedAttachment"]:
+        """Load attachments either from Telegram file id cache or from the storage"""
+        # uploads are reserved in a fixed order before loading anything, so that concurrent senders of the same
+        # media in different orders can't end up waiting for each other's uploads
+        media_ids = sorted({attachment.media_id() for attachment in content.attachments})
+        file_id_by_media_id: dict[str, str | None] = dict()
+        for media_id in media_ids:
+            file_id = await self._tg_file_id_cache.load_or_start_upload(media_id)
+            if file_id is None:
+                uploading_media_ids.add(media_id)
+            file_id_by_media_id[media_id] = file_id
+
+        media_by_id: dict[str, str | Media] = dict()
+        for media_id in media_ids:
+            source: str | Media | None = file_id_by_media_id[media_id]
+            if source is None and self._media_store is not None:
+                source = await self._media_store.load_media(media_id)
+            if source is None:
+                self._logger.error(f"Failed to load media from the store: {media_id}; will proceed without it")
             else:
-                # sending attachments and caching resulting file ids
-                if len(prepared_attachments) == 1:
-                    # single attachment
-                    pa = prepared_attachments[0]
-                    if pa.attachment.image is not None:
-                        messages = [
-                            await context.bot.send_photo(
-                                chat_id=chat_id,
-                                photo=pa.telegram_attachment(),
-                                caption=(
-                                    any_text_to_str(content.text.preprocessed, language)
-                                    if content.text is not None
-                                    else None
-                                ),
-                                parse_mode=parse_mode if content.text is not None else None,
-                                reply_markup=tg.ReplyKeyboardRemove(),
-                            )
-                        ]
-                    else:
-                        self._logger.error("Unexpected attachment type; only images are supported for now")
-                else:
-                    # multiple attachments case
-                    tg_input_media = [
-                        # input media handles both file_id and raw bytes case, even though it's not properly typed
-                        tg.InputMediaPhoto(pa.telegram_attachment())  # type: ignore
-                        for pa in prepared_attachments
+                media_by_id[media_id] = source
+
+        prepared_attachments = [
+            PreparedAttachment(
+                attachment=attachment,
+                source=media_by_id[attachment.media_id()],
+            )
+            for attachment in content.attachments
+            if attachment.media_id() in media_by_id
+        ]
+        self._logger.debug("Prepared attachments: %s", prepared_attachments)
+        return prepared_attachments
+
+    async def _send_content(
+        self,
+        context: UserFlowContext,
+        chat_id: int,
+        content: Content,
+        prepared_attachments: list["PreparedAttachment"],
+        language: MaybeLanguage,
+        uploading_media_ids: set[str],
+    ) -> None:
+        parse_mode = content.text.markup.parse_mode() if content.text is not None else None
+
+        if not prepared_attachments:
+            if content.text is not None:
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text=any_text_to_str(content.text.preprocessed, language),
+                    parse_mode=parse_mode,
+                    reply_markup=tg.ReplyKeyboardRemove(),
+                )
+            else:
+                self._logger.error("Empty content block: no text and no attachments!")
+        else:
+            # sending attachments and caching resulting file ids
+            if len(prepared_attachments) == 1:
+                # single attachment
+                pa = prepared_attachments[0]
+                if pa.attachment.image is not None:
+                    messages = [
+                        await context.bot.send_photo(
+                            chat_id=chat_id,
+                            photo=pa.telegram_attachment(),
+                            caption=(
+                                any_text_to_str(content.text.preprocessed, language)
+                                if content.text is not None
+                                else None
+                            ),
+                            parse_mode=parse_mode if content.text is not None else None,
+                            reply_markup=tg.ReplyKeyboardRemove(),
+                        )
                     ]
-                    # for media groups, text content is put to first media's caption
-                    if content.text is not None:
-                        tg_input_media[0].caption = any_text_to_str(content.text.preprocessed, language)
-                        tg_input_media[0].parse_mode = parse_mode
-                        # NOTE: reply markup is not available for media groups, so we don't send it
-
-                    messages = await context.bot.send_media_group(
-                        chat_id=chat_id,
-                        # bad typing in telebot (list[InputMediaPhoto | ...], complains because list is invariant)
-                        media=list(tg_input_media),
-                    )
-
-                self._logger.debug(f"Sent attachments in messages: {messages}")
+                else:
+                    self._logger.error("Unexpected attachment type; only images are supported for now")
+            else:
+                # multiple attachments case
+                tg_input_media = [
+                    # input media handles both file_id and raw bytes case, even though it's not properly typed
+                    tg.InputMediaPhoto(pa.telegram_attachment())  # type: ignore
+                    for pa in prepared_attachments
+                ]
+                # for media groups, text content is put to first media's caption
+                if content.text is not None:
+                    tg_input_media[0].caption = any_text_to_str(content.text.preprocessed, language)
+                    tg_input_media[0].parse_mode = parse_mode
+                    # NOTE: reply markup is not available for media groups, so we don't send it
+
+                messages = await context.bot.send_media_group(
+                    chat_id=chat_id,
+                    # bad typing in telebot (list[InputMediaPhoto | ...], complains because list is invariant)
+                    media=list(tg_input_media),
+                )
 
-                if len(messages) != len(prepared_attachments):
-                    self._logger.error(
-                        "The number of messages doesn't match the number of attachments"
-                        + f"({len(messages) = }, {len(prepared_attachments) = })"
-                    )
+            self._logger.debug(f"Sent attachments in messages: {messages}")
 
-                for message, pa in zip(messages, prepared_attachments):
-                    if isinstance(pa.source, str):
-                        # already cached
-                        continue
-                    if message.photo is None:
-                        self._logger.error("Got Message object without photo on unable to fill the cache, ignoring it")
-                        continue
-                    new_file_id = message.photo[0].file_id
-                    self._logger.debug(f"Caching Telegram file_id for attachment: {pa} -> {new_file_id}")
-                    await self._tg_file_id_by_media_id_store.save(pa.attachment.media_id(), new_file_id)
+            if len(messages) != len(prepared_attachments):
+                self._logger.error(
+                    "The number of messages doesn't match the number of attachments"
+                    + f"({len(messages) = }, {len(prepared_attachments) = })"
+                )
 
-        if self.next_block_id is not None:
-            await context.enter_block(self.next_block_id, context)
+            for message, pa in zip(messages, prepared_attachments):
+                media_id = pa.attachment.media_id()
+                if media_id not in uploading_media_ids:
+                    # already cached
+                    continue
+                new_file_id = uploaded_photo_file_id(message)
+                if new_file_id is None:
+                    self._logger.error("Got Message object without photo on unable to fill the cache, ignoring it")
+                    continue
+                uploading_media_ids.remove(media_id)
+                await self._tg_file_id_cache.finish_upload(media_id, new_file_id)
 
     async def setup(self, context: UserFlowSetupContext) -> SetupResult:
         self._logger = context.make_instrumented_logger(__name__)
-        self._tg_file_id_by_media_id_store = KeyValueStore[str](
-            name="file-id",
-            prefix=context.bot_prefix,
-            redis=context.redis,
-            expiration_time=datetime.timedelta(days=180),
-            dumper=str,
-            loader=str,
-        )
+        self._tg_file_id_cache = context.tg_file_id_cache
 
         self._language_store = context.language_store
         # validating texts against language store
@@ -1,7 +1,10 @@
 import abc
+import asyncio
 import logging
+import weakref
+from dataclasses import dataclass
 from enum import Enum
-from typing import Any, Literal, Optional, Sequence, Type, Union, cast
+from typing import Any, Callable, Literal, Mapping, Optional, Type, Union, cast
 
 from pydantic import BaseModel, ConfigDict, model_validator
 from telebot import types as tg
@@ -20,7 +23,7 @@ from telebot_components.form.handler import FormHandler as ComponentsFormHandler
 from telebot_components.form.handler import (
     FormHandlerConfig as ComponentsFormHandlerConfig,
 )
-from telebot_components.language import any_text_to_str
+from telebot_components.language import MaybeLanguage, any_text_to_str
 from telebot_components.utils import emoji_hash, telegram_html_escape
 from typing_extensions import Self
 
@@ -31,6 +34,7 @@ from telebot_constructor.store.form_results import (
     FormResult,
     empty_form_result,
 )
+from telebot_constructor.store.outbox import Outbox
 from telebot_constructor.user_flow.blocks.base import UserFlowBlock
 from telebot_constructor.user_flow.blocks.constants import (
     FORM_CANCEL_CMD,
@@ -52,7 +56,7 @@ from telebot_constructor.utils import (
 from telebot_constructor.utils.pydantic import (
     ExactlyOneNonNullFieldModel,
     LocalizableText,
-    MultilangText,
+    join_localizable_texts,
 )
 
 # region: form fields
@@ -124,26 +128,92 @@ class SingleSelectFormFieldConfig(BaseFormFieldConfig):
     invalid_enum_error_msg: LocalizableText
 
     def construct_field(self) -> SingleSelectField:
-        # HACK: we need to programmatically create Enum class from a user-provided set of options
-        # see https://docs.python.org/3/howto/enum.html#functional-api
-        # but also, we need to inject this class into global scope so that (de)serializers can find this class
-        # in the present module so we do this using globals()
-
-        # the form validates during construction that
-        # a) all field ids are unique within one form
-        # b) all single-select field ids are uniquely attributed to a particular form
-        #    = no interference between forms/users
-        enum_def = [(o.id, o.label) for o in self.options]
-        enum_class_name = f"{self.id}_single_select_field_options"
-        EnumClass: Type[Enum] = Enum(enum_class_name, enum_def, module=__name__)  # type: ignore
-        globals()[enum_class_name] = EnumClass
         return SingleSelectField(
-            EnumClass=EnumClass,
+            EnumClass=SINGLE_SELECT_ENUM_REGISTRY.enum_class(self.id, self.options),
             invalid_enum_value_error_msg=self.invalid_enum_error_msg,
             **self.base_field_kwargs(),  # type: ignore
         )
 
 
+class SingleSelectFieldOwner:
+    """Attribution of a single select field id to a form block instance, held by it"""
+
+    def __init__(self, field_id: str, form_block_id: UserFlowBlockId) -> None:
+        self.field_id = field_id
+        self.form_block_id = form_block_id
+
+    def __deepcopy__(self, memo: dict[int, Any]) -> Self:
+        # shared with the form block's copies, incl. the one set up in the bot (see UserFlowBlockConfig),
+        # so that the attribution is released when the bot is stopped
+        return self
+
+
+class SingleSelectEnumRegistry:
+    """
+    Enum classes for single select fields' options, created with the functional API
+    (see https://docs.python.org/3/howto/enum.html#functional-api) and deduplicated by field id
+    and options, so that the same field in many bots and config versions shares a single class.
+
+    Field attributions are released explicitly by form blocks when their bot is stopped; as a fallback for
+    form blocks that are never set up (e.g. only validated), they are also referenced weakly and released
+    once the form block is garbage collected. Classes are only referenced weakly: deduplication doesn't
+    depend on them being released, a lingering class is reused and a collected one is created again.
+    """
+
+    def __init__(self) -> None:
+        self._enum_classes: weakref.WeakValueDictionary[tuple[str, tuple[str, ...]], Type[Enum]] = (
+            weakref.WeakValueDictionary()
+        )
+        # form state (de)serializers find enum classes by name in the present module, see __getattr__ below
+        self._enum_class_by_name: weakref.WeakValueDictionary[str, Type[Enum]] = weakref.WeakValueDictionary()
+        # field id -> attributions held by form block instances, all to the same form block id
+        self._field_owners: dict[str, weakref.WeakSet[SingleSelectFieldOwner]] = dict()
+
+    def enum_class(self, field_id: str, options: list[EnumOption]) -> Type[Enum]:
+        key = (field_id, tuple(o.model_dump_json() for o in options))
+        EnumClass = self._enum_classes.get(key)
+        if EnumClass is None:
+            enum_def = [(o.id, o.label) for o in options]
+            EnumClass = cast(Type[Enum], Enum(f"{field_id}_single_select_field_options", enum_def, module=__name__))
+            self._enum_classes[key] = EnumClass
+        # the form validates that single select field ids are uniquely attributed to a particular form,
+        # so the name is shared only by versions of the same field and the latest one is used
+        self._enum_class_by_name[EnumClass.__name__] = EnumClass
+        return EnumClass
+
+    def enum_class_by_name(self, name: str) -> Optional[Type[Enum]]:
+        return self._enum_class_by_name.get(name)
+
+    def claim_field(self, field_id: str, form_block_id: UserFlowBlockId) -> Optional[SingleSelectFieldOwner]:
+        """Attribute the field to the form block; returns None if the field id is used by another live form"""
+        owners = self._field_owners.setdefault(field_id, weakref.WeakSet())
+        if any(owner.form_block_id != form_block_id for owner in owners):
+            return None
+        owner = SingleSelectFieldOwner(field_id, form_block_id)
+        owners.add(owner)
+        return owner
+
+    def release_field(self, owner: SingleSelectFieldOwner) -> None:
+        owners = self._field_owners.get(owner.field_id)
+        if owners is None:
+            return
+        owners.discard(owner)
+        if not owners:
+            self._field_owners.pop(owner.field_id)
+
+
+SINGLE_SELECT_ENUM_REGISTRY = SingleSelectEnumRegistry()
+
+
+def __getattr__(name: str) -> Type[Enum]:
+    # module-level attribute lookup fallback (PEP 562) for single select fields' enum classes, which
+    # are serialized as part of form state by their qualified names
+    EnumClass = SINGLE_SELECT_ENUM_REGISTRY.enum_class_by_name(name)
+    if EnumClass is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return EnumClass
+
+
 class FormFieldConfig(ExactlyOneNonNullFieldModel):
     """Wrapper object for all kinds of fields; see individual classes for details on each field's specifics"""
 
@@ -283,12 +353,127 @@ class FormResultsExport(BaseModel):
         return self
 
 
+@dataclass
+class _FieldResultTemplate:
+    field_name: str
+    is_omitted: bool = False  # field has no result formatting options and is only counted
+    prefix: str = ""  # e.g. "<b>Field name</b>: "
+    suffix: str = ""
+    value_formatter: Optional[Callable[[Any, MaybeLanguage], str]] = None
+    # for fields with a finite set of values, i.e. single select options
+    value_strs: Optional[dict[Any, str]] = None
+    escaped_value_strs: Optional[dict[Any, str]] = None
+
+
+class FormResultRenderer:
+    """
+    Renders form results the same way as telebot_components' Form.result_to_html and fields' value_to_str,
+    but using templates precompiled for each language from field names and single select options
+    """
+
+    OMITTED_FIELDS_COUNT_TEMPLATE = "<i>+{} omitted</i>"
+
+    def __init__(self, form: ComponentsForm, languages: list[MaybeLanguage]) -> None:
+        self.form = form
+        self._templates_by_language = {lang: self._compile(lang) for lang in languages}
+        self._template_by_field_name_by_language = {
+            lang: {t.field_name: t for t in templates} for lang, templates in self._templates_by_language.items()
+        }
+
+    def _compile(self, lang: MaybeLanguage) -> list[_FieldResultTemplate]:
+        """Templates for all fields, in the rendering order"""
+        templates: list[_FieldResultTemplate] = []
+        field_names = self.form.topologically_sorted_field_names or sorted(f.name for f in self.form.fields)
+        for field_name in field_names:
+            field = self.form.fields_by_name[field_name]
+            opts = field.result_formatting_opts
+            if not opts:
+                templates.append(_FieldResultTemplate(field_name=field_name, is_omitted=True))
+                continue
+            if not isinstance(opts, FormFieldResultFormattingOpts):
+                opts = FormFieldResultFormattingOpts(descr=field.query_message, is_multiline=False)
+
+            if isinstance(opts.descr, str):
+                descr = opts.descr
+            else:
+                try:
+                    descr = any_text_to_str(opts.descr, lang)
+                except Exception:
+                    descr = any_text_to_str(opts.descr, next(iter(opts.descr.keys())))  # type: ignore
+
+            template = _FieldResultTemplate(
+                field_name=field_name,
+                prefix=f"<b>{telegram_html_escape(descr)}</b>" + ("\n" if opts.is_multiline else ": "),
+                suffix="\n" if opts.is_multiline else "",
+                value_formatter=opts.value_formatter or field.value_to_str,
+            )
+            if isinstance(field, SingleSelectField) and opts.value_formatter is None:
+                try:
+                    value_strs = {option: field.value_to_str(option, lang) for option in field.EnumClass}
+                except Exception:
+                    # e.g. options are not localized to the language, so it fails only when actually rendered
+                    pass
+                else:
+                    template.value_strs = value_strs
+                    template.escaped_value_strs = {
+                        option: telegram_html_escape(value_str) for option, value_str in value_strs.items()
+                    }
+            templates.append(template)
+        return templates
+
+    def _templates(self, lang: MaybeLanguage) -> list[_FieldResultTemplate]:
+        templates = self._templates_by_language.get(lang)
+        if templates is None:
+            # e.g. when the language store is not used, but the result is rendered for a specific language
+            templates = self._compile(lang)
+            self._templates_by_language[lang] = templates
+            self._template_by_field_name_by_language[lang] = {t.field_name: t for t in templates}
+        return templates
+
+    def result_to_html(self, result: Mapping[str, Any], lang: MaybeLanguage) -> str:
+        parts: list[str] = []
+        omitted_field_count = 0
+        for template in self._templates(lang):
+            if template.field_name not in result:
+                globally_required_fields = self.form.globally_required_fields
+                if globally_required_fields is not None and template.field_name in globally_required_fields:
+                    raise ValueError(f"Globally required field {template.field_name!r} not found in result")
+                continue
+            if template.is_omitted:
+                omitted_field_count += 1
+                continue
+            value = result[template.field_name]
+            if value is None:
+                continue
+            if parts:
+                parts.append("\n")
+            escaped_value_str = template.escaped_value_strs.get(value) if template.escaped_value_strs else None
+            if escaped_value_str is None and template.value_formatter is not None:
+                escaped_value_str = telegram_html_escape(template.value_formatter(value, lang))
+            parts.append(template.prefix)
+            parts.append(escaped_value_str or "")
+            parts.append(template.suffix)
+        if omitted_field_count:
+            if parts:
+                parts.append("\n")
+            parts.append(self.OMITTED_FIELDS_COUNT_TEMPLATE.format(omitted_field_count))
+        return "".join(parts)
+
+    def value_to_str(self, field_name: str, value: Any, lang: MaybeLanguage) -> str:
+        self._templates(lang)
+        template = self._template_by_field_name_by_language[lang][field_name]
+        value_str = template.value_strs.get(value) if template.value_strs else None
+        if value_str is None:
+            value_str = self.form.fields_by_name[field_name].value_to_str(value, lang)
+        return value_str
+
+
 # endregion
 
 
-# to ensure unique single select field -> form attribution
-# see the comment in the field's construction method
-FORM_ID_BY_SINGLE_SELECT_FIELD_ID = dict[str, str]()
+class FormResultToChatExportJob(BaseModel):
+    user: dict[str, Any]  # Telegram user object who filled the form
+    text: str  # HTML-formatted form result
 
 
 class FormBlock(UserFlowBlock):
@@ -323,12 +508,18 @@ class FormBlock(UserFlowBlock):
         )
         self._field_names = {f.specific_config().id: f.specific_config().name for f in all_field_configs}
 
+        # the form keeps its single select fields attributed to it until its bot is stopped (or while it's
+        # alive, if it's never set up), so that forms don't interfere with each other
+        self._single_select_field_owners: list[SingleSelectFieldOwner] = []
         for f in all_field_configs:
             field_id = f.specific_config().id
             if field_id in RESERVED_FORM_FIELD_IDS:
                 raise ValueError(form_id_error_prefix + f"Field id {field_id!r} is reserved")
             if f.single_select is not None:
-                if self.block_id != FORM_ID_BY_SINGLE_SELECT_FIELD_ID.setdefault(field_id, self.block_id):
+                owner = SINGLE_SELECT_ENUM_REGISTRY.claim_field(field_id, self.block_id)
+                if owner is not None:
+                    self._single_select_field_owners.append(owner)
+                else:
                     raise ValueError(
                         form_id_error_prefix
                         + f"Attempt to create form block with a single select field id={field_id!r} "
@@ -344,6 +535,7 @@ class FormBlock(UserFlowBlock):
 
         # real store is supplied only during setup
         self._store: BotSpecificFormResultsStore | None = None
+        self._to_chat_outbox: Outbox[FormResultToChatExportJob] | None = None
 
     @property
     def store(self) -> BotSpecificFormResultsStore:
@@ -355,6 +547,11 @@ class FormBlock(UserFlowBlock):
         self._store = context.form_results_store
         self._logger = context.make_instrumented_logger(__name__)
 
+        self._result_renderer = FormResultRenderer(
+            form=self._form,
+            languages=list(context.language_store.languages) if context.language_store is not None else [None],
+        )
+
         cancelling_because_of_error_eng = "Something went wrong, details: {}"
         if context.language_store is not None:
             cancelling_because_of_error: LocalizableText = {
@@ -406,60 +603,34 @@ class FormBlock(UserFlowBlock):
         async def on_form_completed(form_exit_context: ComponentsFormExitContext):
             user = form_exit_context.last_update.from_user
             result = form_exit_context.result
+            # the same context is used for the next block, so that the user's language is looked up once
+            next_block_context = _user_flow_context_for_next_block(form_exit_context)
             # to localize data for admins
             admin_lang = context.language_store.default_language if context.language_store is not None else None
 
             # first, exporting results to whenever the config tells us
             if self.results_export.echo_to_user:
                 try:
-                    user_lang = (
-                        await context.language_store.get_user_language(user)
-                        if context.language_store is not None
-                        else None
-                    )
-                    text = self._form.result_to_html(result=result, lang=user_lang)
+                    user_lang = await next_block_context.get_language()
+                    text = self._result_renderer.result_to_html(result=result, lang=user_lang)
                     await context.bot.send_message(chat_id=user.id, text=text, parse_mode="HTML")
                 except Exception:
                     self._logger.exception(f"Error sending form result back to the user: {result}")
-            if self.results_export.to_chat is not None:
+            if self.results_export.to_chat is not None and self._to_chat_outbox is not None:
                 try:
-                    feedback_handler = (
-                        context.feedback_handlers.get(self.results_export.to_chat.chat_id)
-                        if self.results_export.to_chat.via_feedback_handler
-                        else None
-                    )
-                    text = self._form.result_to_html(result=result, lang=admin_lang)
-                    if feedback_handler is not None:
-                        await feedback_handler.emulate_user_message(
-                            bot=context.bot,
-                            user=user,
-                            text=text,
-                            attachment=None,
-                            no_response=True,
-                            send_user_identifier_message=(
-                                self.results_export.user_attribution.should_send_user_identifier(
-                                    feedback_handler.config
-                                )
-                            ),
-                            parse_mode="HTML",
-                        )
-                    else:
-                        if user_id_text := self.results_export.user_attribution.user_html(user, self.block_id):
-                            text = user_id_text + "\n\n" + text
-                        await context.bot.send_message(
-                            chat_id=self.results_export.to_chat.chat_id,
-                            text=text,
-                            parse_mode="HTML",
+                    await self._to_chat_outbox.enqueue(
+                        FormResultToChatExportJob(
+                            user=user.to_dict(),
+                            text=self._result_renderer.result_to_html(result=result, lang=admin_lang),
                         )
+                    )
                 except Exception:
-                    self._logger.exception(f"Error sending form result to admin chat: {result}")
+                    self._logger.exception(f"Error enqueueing form result export to admin chat: {result}")
             if self.results_export.to_store:
                 try:
                     result_dump: FormResult = empty_form_result()
                     for field_id, field_value in result.items():
-                        result_dump[field_id] = self._form.fields_by_name[field_id].value_to_str(
-                            field_value, admin_lang
-                        )
+                        result_dump[field_id] = self._result_renderer.value_to_str(field_id, field_value, admin_lang)
                     if user_str := self.results_export.user_attribution.user_plain(user, self.block_id):
                         result_dump[USER_KEY] = user_str
                     await self.store.save_form_result(
@@ -474,10 +645,48 @@ class FormBlock(UserFlowBlock):
                     self._logger.exception(f"Error saving form result to internal storage: {result}")
 
             if self.form_completed_next_block_id is not None:
-                await context.enter_block(
-                    self.form_completed_next_block_id,
-                    _user_flow_context_for_next_block(form_exit_context),
+                await context.enter_block(self.form_completed_next_block_id, next_block_context)
+
+        async def export_to_chat(job: FormResultToChatExportJob) -> None:
+            to_chat = self.results_export.to_chat
+            if to_chat is None:
+                return
+            user = tg.User.de_json(job.user)
+            text = job.text
+            feedback_handler = context.feedback_handlers.get(to_chat.chat_id) if to_chat.via_feedback_handler else None
+            if feedback_handler is not None:
+                await feedback_handler.emulate_user_message(
+                    bot=context.bot,
+                    user=user,
+                    text=text,
+                    attachment=None,
+                    no_response=True,
+                    send_user_identifier_message=(
+                        self.results_export.user_attribution.should_send_user_identifier(feedback_handler.config)
+                    ),
+                    parse_mode="HTML",
                 )
+            else:
+                if user_id_text := self.results_export.user_attribution.user_html(user, self.block_id):
+                    text = user_id_text + "\n\n" + text
+                await context.bot.send_message(chat_id=to_chat.chat_id, text=text, parse_mode="HTML")
+
+        setup_result = SetupResult.empty()
+        if self.results_export.to_chat is not None:
+            # sending results to the admin chat may be slow (e.g. rate limited), so it's done in the background
+            # not to delay the user's flow, and retried on errors; the outbox is named after the block id and
+            # not the form name, which can be changed in the editor, orphaning pending exports
+            self._to_chat_outbox = Outbox[FormResultToChatExportJob](
+                name=f"{self.block_id}-results-to-chat",
+                prefix=context.bot_prefix,
+                redis=context.redis,
+                dumper=FormResultToChatExportJob.model_dump_json,
+                loader=FormResultToChatExportJob.model_validate_json,
+                logger=self._logger,
+            )
+            setup_result.background_jobs.append(self._to_chat_outbox.run_worker(export_to_chat))
+        if self._single_select_field_owners:
+            setup_result.background_jobs.append(self._release_single_select_fields_on_stop())
 
         async def on_form_cancelled(form_exit_context: ComponentsFormExitContext):
             if self.form_cancelled_next_block_id is not None:
@@ -493,7 +702,16 @@ class FormBlock(UserFlowBlock):
         )
 
         # NOTE: not exporting commands like /skip and /cancel because they are only form-specific
-        return SetupResult.empty()
+        return setup_result
+
+    async def _release_single_select_fields_on_stop(self) -> None:
+        try:
+            # background jobs are cancelled when the bot is stopped
+            await asyncio.Event().wait()
+        finally:
+            for owner in self._single_select_field_owners:
+                SINGLE_SELECT_ENUM_REGISTRY.release_field(owner)
+            self._single_select_field_owners.clear()
 
     async def enter(self, context: UserFlowContext) -> None:
         await self._form_handler.start(
@@ -502,25 +720,3 @@ class FormBlock(UserFlowBlock):
             initial_form_result=None,
             separate_field_prompt_message=True,
         )
-
-
-def join_localizable_texts(msgs: Sequence[LocalizableText], sep: str) -> LocalizableText:
-    if not msgs:
-        raise ValueError("Nothing to join")
-
-    def _join_str(strings: list[str]) -> str:
-        return sep.join([s for s in strings if s])
-
-    if all(isinstance(msg, str) for msg in msgs):
-        return _join_str(cast(list[str], msgs))
-    else:
-        if any(isinstance(msg, str) for msg in msgs):
-            raise ValueError("All msgs must be strings or multilang texts, not mixed")
-        multilang_msgs = cast(list[MultilangText], msgs)
-        multilang_msgs_aggregated = {lang: [localization] for lang, localization in multilang_msgs[0].items()}
-        for msg in multilang_msgs[1:]:
-            for key, localizations in multilang_msgs_aggregated.items():
-                if key not in msg:
-                    raise ValueError(f"All msgs must be localized to the same languages, but {msg} misses {key!r}")
-                localizations.append(msg[key])
-        return {lang: _join_str(localization) for lang, localization in multilang_msgs_aggregated.items()}
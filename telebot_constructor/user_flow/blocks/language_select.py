@@ -1,7 +1,17 @@
+import collections
+import dataclasses
+import datetime
+import time
 from typing import Any, Optional
 
 from pydantic import BaseModel
-from telebot_components.language import LanguageChangeContext
+from telebot import types as tg
+from telebot_components.language import (
+    AnyLanguage,
+    LanguageChangeContext,
+    LanguageData,
+    any_language_to_language_data,
+)
 from telebot_components.stores.language import LanguageLabelPart
 from telebot_components.stores.language import (
     LanguageSelectionMenuConfig as ComponentsLanguageSelectionMenuConfig,
@@ -18,6 +28,54 @@ from telebot_constructor.user_flow.types import (
 from telebot_constructor.utils import without_nones
 from telebot_constructor.utils.pydantic import Language, MultilangText
 
+USER_LANGUAGE_CACHE_TTL = datetime.timedelta(seconds=30)
+USER_LANGUAGE_CACHE_MAX_SIZE = 10_000
+
+
+class CachedLanguageStore(LanguageStore):
+    """
+    Language store with users' selected languages cached in memory for a short time, so that handlers of
+    consecutive updates don't read them from Redis every time. The cache is updated when the language is set
+    through this store; TTL is a safety net for changes not seen by this instance (e.g. by the bot running elsewhere).
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        cache_ttl: datetime.timedelta = USER_LANGUAGE_CACHE_TTL,
+        cache_max_size: int = USER_LANGUAGE_CACHE_MAX_SIZE,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.cache_ttl = cache_ttl
+        self.cache_max_size = cache_max_size
+        # user id -> (expiration monotonic time, selected language), in LRU order
+        self._cache: collections.OrderedDict[int, tuple[float, Optional[LanguageData]]] = collections.OrderedDict()
+
+    async def get_selected_user_language(self, user: tg.User) -> Optional[LanguageData]:
+        now = time.monotonic()
+        cached = self._cache.get(user.id)
+        if cached is not None and cached[0] > now:
+            self._cache.move_to_end(user.id)
+            return cached[1]
+        language = await super().get_selected_user_language(user)
+        self._cache_language(user, language, now)
+        return language
+
+    def _cache_language(self, user: tg.User, language: Optional[LanguageData], now: float) -> None:
+        self._cache[user.id] = (now + self.cache_ttl.total_seconds(), language)
+        self._cache.move_to_end(user.id)
+        while len(self._cache) > self.cache_max_size:
+            self._cache.popitem(last=False)
+
+    async def set_user_language(self, user: tg.User, language_data: AnyLanguage) -> bool:
+        saved = await super().set_user_language(user, language_data)
+        if saved:
+            self._cache_language(user, any_language_to_language_data(language_data), now=time.monotonic())
+        else:
+            self._cache.pop(user.id, None)
+        return saved
+
 
 class LanguageSelectionMenuConfig(BaseModel):
     propmt: MultilangText
@@ -43,10 +101,10 @@ class LanguageSelectBlock(UserFlowBlock):
         return without_nones([self.language_selected_next_block_id])
 
     def model_post_init(self, __context: Any) -> None:
-        self._language_store: Optional[LanguageStore] = None
+        self._language_store: Optional[CachedLanguageStore] = None
 
     @property
-    def language_store(self) -> LanguageStore:
+    def language_store(self) -> CachedLanguageStore:
         if self._language_store is None:
             raise RuntimeError("Language selection block was not set up")
         return self._language_store
@@ -60,7 +118,7 @@ class LanguageSelectBlock(UserFlowBlock):
             await context.enter_block(self.next_block_id, context)
 
     async def setup(self, context: UserFlowSetupContext) -> SetupResult:
-        self._language_store = LanguageStore(
+        self._language_store = CachedLanguageStore(
             redis=context.redis,
             bot_prefix=context.bot_prefix,
             supported_languages=self.supported_languages,
@@ -76,15 +134,15 @@ class LanguageSelectBlock(UserFlowBlock):
 
         async def on_language_change(lang_change_context: LanguageChangeContext) -> None:
             if self.language_selected_next_block_id is not None:
-                await context.enter_block(
-                    self.language_selected_next_block_id,
-                    UserFlowContext.from_setup_context(
-                        setup_ctx=context,
-                        chat=None,
-                        user=lang_change_context.user,
-                        last_update_content=lang_change_context.message,
-                    ),
+                next_block_context = UserFlowContext.from_setup_context(
+                    # this block is set up before the language store is added to the context for other blocks
+                    setup_ctx=dataclasses.replace(context, language_store=self.language_store),
+                    chat=None,
+                    user=lang_change_context.user,
+                    last_update_content=lang_change_context.message,
                 )
+                next_block_context.resolved_languages[lang_change_context.user.id] = lang_change_context.language
+                await context.enter_block(self.language_selected_next_block_id, next_block_context)
 
         await self.language_store.setup(bot=context.bot, on_language_change=on_language_change)
 
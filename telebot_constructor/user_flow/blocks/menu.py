@@ -1,6 +1,9 @@
-from typing import Any, Optional
+from types import MappingProxyType
+from typing import Any, Mapping, Optional, Union
 
 from pydantic import BaseModel
+from telebot import types as tg
+from telebot_components.language import MaybeLanguage
 from telebot_components.menu.menu import Menu as ComponentsMenu
 from telebot_components.menu.menu import MenuConfig as ComponentsMenuConfig
 from telebot_components.menu.menu import MenuHandler
@@ -23,6 +26,29 @@ from telebot_constructor.utils.pydantic import LocalizableText
 
 NOOP_TERMINATOR = "noop"
 
+KeyboardMarkup = Union[tg.InlineKeyboardMarkup, tg.ReplyKeyboardMarkup]
+
+
+class PrerenderedComponentsMenu(ComponentsMenu):
+    """
+    Components menu with keyboards rendered once per language instead of on every menu navigation;
+    must be prerendered after the menu handler assigned ids to menus and items, as they are used in
+    buttons' callback data
+    """
+
+    _keyboard_markup_by_language: Mapping[MaybeLanguage, KeyboardMarkup] = MappingProxyType({})
+
+    def prerender(self, languages: list[MaybeLanguage]) -> None:
+        self._keyboard_markup_by_language = MappingProxyType(
+            {language: super(PrerenderedComponentsMenu, self).get_keyboard_markup(language) for language in languages}
+        )
+
+    def get_keyboard_markup(self, language: MaybeLanguage) -> KeyboardMarkup:
+        keyboard_markup = self._keyboard_markup_by_language.get(language)
+        if keyboard_markup is None:
+            return super().get_keyboard_markup(language)
+        return keyboard_markup
+
 
 class MenuItem(BaseModel):
     label: LocalizableText
@@ -60,14 +86,14 @@ class Menu(BaseModel):
     config: MenuConfig
     markup: TextMarkup = TextMarkup.NONE
 
-    def to_components_menu(self) -> ComponentsMenu:
+    def to_components_menu(self) -> PrerenderedComponentsMenu:
         config = ComponentsMenuConfig(
             back_label=self.config.back_label,
             lock_after_termination=self.config.lock_after_termination,
             mechanism=self.config.mechanism,
             text_markup=self.markup,
         )
-        return ComponentsMenu(
+        return PrerenderedComponentsMenu(
             text=preprocess_for_telegram(self.text, self.markup),
             menu_items=[item.to_components_menu_item() for item in self.items],
             config=config,
@@ -108,6 +134,12 @@ class MenuBlock(UserFlowBlock):
             language_store=context.language_store,
         )
         context.errors_store.instrument(self._components_menu_handler.logger)
+        languages: list[MaybeLanguage] = (
+            list(context.language_store.languages) if context.language_store is not None else [None]
+        )
+        for menu in self._components_menu_handler.menus_list:
+            if isinstance(menu, PrerenderedComponentsMenu):
+                menu.prerender(languages)
 
         async def on_terminal_menu_option_selected(terminator_context: TerminatorContext) -> Optional[TerminatorResult]:
             terminator = terminator_context.terminator
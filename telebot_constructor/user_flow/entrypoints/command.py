@@ -9,7 +9,6 @@ from telebot_constructor.user_flow.types import (
     BotCommandInfo,
     SetupResult,
     UserFlowBlockId,
-    UserFlowContext,
     UserFlowSetupContext,
 )
 from telebot_constructor.utils import without_nones
@@ -29,31 +28,16 @@ class CommandEntryPoint(UserFlowEntryPoint):
     scope: CommandScope = CommandScope.PRIVATE
     short_description: Optional[str] = None  # used for native Telegram menu
 
-    async def setup(self, context: UserFlowSetupContext) -> SetupResult:
+    def chat_types(self) -> Optional[list[tg_const.ChatType]]:
         if self.scope is CommandScope.PRIVATE:
-            chat_types: Optional[list[tg_const.ChatType]] = [tg_const.ChatType.private]
+            return [tg_const.ChatType.private]
         elif self.scope is CommandScope.GROUP:
-            chat_types = [tg_const.ChatType.group, tg_const.ChatType.supergroup]
+            return [tg_const.ChatType.group, tg_const.ChatType.supergroup]
         else:
-            chat_types = None
-
-        @context.bot.message_handler(
-            commands=[self.command],
-            chat_types=chat_types,
-            func=context.banned_users_store.not_from_banned_user,
-        )
-        async def cmd_handler(message: tg.Message) -> None:
-            if self.next_block_id is not None:
-                await context.enter_block(
-                    self.next_block_id,
-                    UserFlowContext.from_setup_context(
-                        setup_ctx=context,
-                        chat=message.chat,
-                        user=message.from_user,
-                        last_update_content=message,
-                    ),
-                )
+            return None
 
+    async def setup(self, context: UserFlowSetupContext) -> SetupResult:
+        # NOTE: messages are dispatched to the entrypoint by EntryPointRouter set up by the user flow
         res = SetupResult.empty()
         if self.short_description is not None:
             if self.scope is CommandScope.PRIVATE:
@@ -0,0 +1,174 @@
+import logging
+import re
+from dataclasses import dataclass
+from typing import Optional, Union
+
+from telebot import types as tg
+from telebot import util as tg_util
+from telebot.types import constants as tg_const
+from telebot.types import service as tg_service
+
+from telebot_constructor.user_flow.entrypoints.base import UserFlowEntryPoint
+from telebot_constructor.user_flow.entrypoints.command import CommandEntryPoint
+from telebot_constructor.user_flow.entrypoints.regex_match import RegexMatchEntryPoint
+from telebot_constructor.user_flow.types import UserFlowContext, UserFlowSetupContext
+
+logger = logging.getLogger(__name__)
+
+RoutedEntryPoint = Union[CommandEntryPoint, RegexMatchEntryPoint]
+
+
+@dataclass
+class _RegexMatcher:
+    """
+    One or several regex entrypoints searched with a single pattern. A combined pattern consists of
+    alternatives like (?P<ep3>(?=[\\s\\S]*?(?:regex))) matched at the start of the text: each is equivalent
+    to searching the regex anywhere in the text and they are tried in order, so the name of the matched
+    group is the first matching entrypoint.
+    """
+
+    pattern: re.Pattern[str]
+    is_combined: bool
+    entrypoint_by_group: dict[str, tuple[int, RegexMatchEntryPoint]]
+
+    def find(self, text: str) -> Optional[tuple[int, RegexMatchEntryPoint]]:
+        if self.is_combined:
+            match = self.pattern.match(text)
+            if match is None or match.lastgroup is None:
+                return None
+            return self.entrypoint_by_group[match.lastgroup]
+        elif self.pattern.search(text):
+            return next(iter(self.entrypoint_by_group.values()))
+        else:
+            return None
+
+
+def _combinable_alternative(group: str, entrypoint: RegexMatchEntryPoint) -> Optional[str]:
+    # regexes with their own groups are not combined to keep their (numbered) backreferences intact
+    if entrypoint.pattern.groups > 0:
+        return None
+    alternative = rf"(?P<{group}>(?=[\s\S]*?(?:{entrypoint.regex})))"
+    try:
+        # e.g. global inline flags are not allowed in the middle of the combined pattern
+        re.compile(alternative)
+    except re.error:
+        return None
+    return alternative
+
+
+def _compile_regex_matchers(entrypoints: list[tuple[int, RegexMatchEntryPoint]]) -> list[_RegexMatcher]:
+    matchers: list[_RegexMatcher] = []
+    alternatives: list[str] = []
+    combined_entrypoints: dict[str, tuple[int, RegexMatchEntryPoint]] = dict()
+
+    def flush_combined() -> None:
+        if not alternatives:
+            return
+        matchers.append(
+            _RegexMatcher(
+                pattern=re.compile("|".join(alternatives), re.IGNORECASE),
+                is_combined=True,
+                entrypoint_by_group=combined_entrypoints.copy(),
+            )
+        )
+        alternatives.clear()
+        combined_entrypoints.clear()
+
+    for idx, entrypoint in entrypoints:
+        group = f"ep{idx}"
+        alternative = _combinable_alternative(group, entrypoint)
+        if alternative is not None:
+            alternatives.append(alternative)
+            combined_entrypoints[group] = (idx, entrypoint)
+        else:
+            # keeping the order of entrypoints, which defines their priority
+            flush_combined()
+            matchers.append(
+                _RegexMatcher(
+                    pattern=entrypoint.pattern,
+                    is_combined=False,
+                    entrypoint_by_group={group: (idx, entrypoint)},
+                )
+            )
+    flush_combined()
+    return matchers
+
+
+class EntryPointRouter:
+    """
+    Single message handler for all command and regex match entrypoints in the user flow. Instead of
+    testing each entrypoint's filters in turn, the router looks the command up in a dict and searches
+    regexes with a combined pattern, then checks the user ban once, so per-message cost does not grow
+    with the number of entrypoints. As with separate handlers, the first matching entrypoint in the flow
+    wins and non-matching messages are left for other handlers.
+    """
+
+    def __init__(self, entrypoints: list[UserFlowEntryPoint]) -> None:
+        self._command_entrypoints: dict[str, tuple[int, CommandEntryPoint]] = dict()
+        regex_entrypoints: list[tuple[int, RegexMatchEntryPoint]] = []
+        for idx, entrypoint in enumerate(entrypoints):
+            if isinstance(entrypoint, CommandEntryPoint):
+                self._command_entrypoints[entrypoint.command] = (idx, entrypoint)
+            elif isinstance(entrypoint, RegexMatchEntryPoint):
+                regex_entrypoints.append((idx, entrypoint))
+        self._regex_matchers = _compile_regex_matchers(regex_entrypoints)
+
+    def is_empty(self) -> bool:
+        return not self._command_entrypoints and not self._regex_matchers
+
+    def _match_command(self, message: tg.Message) -> Optional[tuple[int, CommandEntryPoint]]:
+        command = tg_util.extract_command(message.text_content)
+        if command is None:
+            return None
+        idx_and_entrypoint = self._command_entrypoints.get(command)
+        if idx_and_entrypoint is None:
+            return None
+        chat_types = idx_and_entrypoint[1].chat_types()
+        if chat_types is not None and tg_const.ChatType(message.chat.type) not in chat_types:
+            return None
+        return idx_and_entrypoint
+
+    def _match_regex(self, message: tg.Message) -> Optional[tuple[int, RegexMatchEntryPoint]]:
+        text = message.text_content
+        for matcher in self._regex_matchers:
+            idx_and_entrypoint = matcher.find(text)
+            if idx_and_entrypoint is not None:
+                return idx_and_entrypoint
+        return None
+
+    def match(self, message: tg.Message) -> Optional[RoutedEntryPoint]:
+        if message.content_type != "text":
+            return None
+        matches: list[tuple[int, RoutedEntryPoint]] = []
+        command_match = self._match_command(message)
+        if command_match is not None:
+            matches.append(command_match)
+        regex_match = self._match_regex(message)
+        if regex_match is not None:
+            matches.append(regex_match)
+        if not matches:
+            return None
+        _, entrypoint = min(matches, key=lambda idx_and_entrypoint: idx_and_entrypoint[0])
+        return entrypoint
+
+    def setup(self, context: UserFlowSetupContext) -> None:
+        if self.is_empty():
+            return
+
+        @context.bot.message_handler()
+        async def entrypoint_router(message: tg.Message) -> Optional[tg_service.HandlerResult]:
+            entrypoint = self.match(message)
+            if entrypoint is None or await context.banned_users_store.is_banned(message.from_user.id):
+                return tg_service.HandlerResult(continue_to_other_handlers=True)
+            logger.debug(f"[{context.bot_prefix}] Message routed to {entrypoint}")
+            if entrypoint.next_block_id is not None:
+                await context.enter_block(
+                    entrypoint.next_block_id,
+                    UserFlowContext.from_setup_context(
+                        setup_ctx=context,
+                        chat=message.chat,
+                        user=message.from_user,
+                        last_update_content=message,
+                    ),
+                )
+            return None
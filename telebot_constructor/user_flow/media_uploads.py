@@ -0,0 +1,101 @@
+import asyncio
+import datetime
+import logging
+
+from telebot import AsyncTeleBot
+from telebot import types as tg
+from telebot_components.redis_utils.interface import RedisInterface
+from telebot_components.stores.generic import KeyValueStore
+
+from telebot_constructor.store.errors import BotSpecificErrorsStore
+from telebot_constructor.store.media import MediaId, UserSpecificMediaStore
+from telebot_constructor.utils import AnyChatId
+from telebot_constructor.utils.rate_limit_retry import rate_limit_retry
+
+
+def uploaded_photo_file_id(message: tg.Message) -> str | None:
+    if message.photo is None:
+        return None
+    return message.photo[0].file_id
+
+
+class TelegramFileIdCache:
+    """
+    Telegram file ids for the bot's media, so that each media is uploaded to Telegram only once.
+
+    The first sender of a media not yet uploaded becomes responsible for uploading it and reporting the
+    resulting file id; concurrent senders of the same media wait for that instead of uploading raw bytes again.
+    """
+
+    def __init__(self, bot_prefix: str, redis: RedisInterface, errors_store: BotSpecificErrorsStore) -> None:
+        self._logger = logging.getLogger(__name__ + f"[{bot_prefix}]")
+        errors_store.instrument(self._logger)
+        self._file_id_store = KeyValueStore[str](
+            name="file-id",
+            prefix=bot_prefix,
+            redis=redis,
+            expiration_time=datetime.timedelta(days=180),
+            dumper=str,
+            loader=str,
+        )
+        self._uploads: dict[MediaId, asyncio.Future[str | None]] = dict()
+
+    async def load_or_start_upload(self, media_id: MediaId) -> str | None:
+        """
+        Returns file id for the media or None; in the latter case the caller must upload the media
+        and report the result with finish_upload
+        """
+        while True:
+            file_id = await self._file_id_store.load(media_id)
+            if file_id is not None:
+                return file_id
+            upload = self._uploads.get(media_id)
+            if upload is None:
+                self._uploads[media_id] = asyncio.get_running_loop().create_future()
+                return None
+            # waiting for the concurrent upload; if it fails, the next iteration will try to upload the media again
+            file_id = await asyncio.shield(upload)
+            if file_id is not None:
+                return file_id
+
+    async def finish_upload(self, media_id: MediaId, file_id: str | None) -> None:
+        """Must be called after load_or_start_upload returned None, with None file id if the upload failed"""
+        try:
+            if file_id is not None:
+                self._logger.debug(f"Caching Telegram file_id for media: {media_id} -> {file_id}")
+                await self._file_id_store.save(media_id, file_id)
+        finally:
+            upload = self._uploads.pop(media_id, None)
+            if upload is not None and not upload.done():
+                upload.set_result(file_id)
+
+    async def warm_up(
+        self,
+        bot: AsyncTeleBot,
+        media_store: UserSpecificMediaStore,
+        media_ids: list[MediaId],
+        chat_id: AnyChatId,
+    ) -> None:
+        """Upload media not yet known to Telegram by sending (and immediately deleting) it in the given chat"""
+        for media_id in media_ids:
+            if await self.load_or_start_upload(media_id) is not None:
+                continue
+            file_id: str | None = None
+            try:
+                media = await media_store.load_media(media_id)
+                if media is None:
+                    self._logger.error(f"Failed to load media from the store for warm-up: {media_id}")
+                    continue
+                async for attempt in rate_limit_retry():
+                    with attempt:
+                        message = await bot.send_photo(chat_id=chat_id, photo=media.content, disable_notification=True)
+                file_id = uploaded_photo_file_id(message)
+                try:
+                    await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+                except Exception:
+                    self._logger.info("Failed to delete warm-up message with uploaded media", exc_info=True)
+            except Exception:
+                self._logger.exception(f"Failed to upload media for warm-up: {media_id}")
+            finally:
+                await self.finish_upload(media_id, file_id)
+        self._logger.info(f"Media warm-up completed ({len(media_ids)} media)")
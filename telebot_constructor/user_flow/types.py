@@ -8,6 +8,7 @@ from telebot import types as tg
 from telebot.runner import AuxBotEndpoint
 from telebot.types import service as service_types
 from telebot_components.feedback import FeedbackHandler
+from telebot_components.language import LanguageData, MaybeLanguage
 from telebot_components.redis_utils.interface import RedisInterface
 from telebot_components.stores.banned_users import BannedUsersStore
 from telebot_components.stores.language import LanguageStore
@@ -15,6 +16,7 @@ from telebot_components.stores.language import LanguageStore
 from telebot_constructor.store.errors import BotSpecificErrorsStore
 from telebot_constructor.store.form_results import BotSpecificFormResultsStore
 from telebot_constructor.store.media import UserSpecificMediaStore
+from telebot_constructor.user_flow.media_uploads import TelegramFileIdCache
 from telebot_constructor.utils import AnyChatId
 
 
@@ -31,6 +33,7 @@ class UserFlowSetupContext:
     enter_block: "EnterUserFlowBlockCallback"
     get_active_block_id: "GetActiveUserFlowBlockId"
     media_store: UserSpecificMediaStore | None
+    tg_file_id_cache: TelegramFileIdCache
 
     def make_instrumented_logger(self, module_name: str) -> logging.Logger:
         logger = logging.getLogger(module_name + f"[{self.bot_prefix}]")
@@ -47,8 +50,21 @@ class UserFlowContext:
     chat: Optional[tg.Chat]
     user: tg.User
     last_update_content: Optional[service_types.UpdateContent]
+    language_store: Optional[LanguageStore] = None
 
     visited_block_ids: set[str] = dataclasses.field(default_factory=set)
+    # user id -> language, resolved once for the interaction, see get_language
+    resolved_languages: dict[int, LanguageData] = dataclasses.field(default_factory=dict)
+
+    async def get_language(self) -> MaybeLanguage:
+        """User's language, looked up in the language store only once for all blocks entered in the interaction"""
+        if self.language_store is None:
+            return None
+        language = self.resolved_languages.get(self.user.id)
+        if language is None:
+            language = await self.language_store.get_user_language(self.user)
+            self.resolved_languages[self.user.id] = language
+        return language
 
     @classmethod
     def from_setup_context(
@@ -66,6 +82,7 @@ class UserFlowContext:
             chat=chat,
             user=user,
             last_update_content=last_update_content,
+            language_store=setup_ctx.language_store,
         )
 
 
@@ -161,6 +161,12 @@ def page_params_to_redis_indices(offset: int, count: int) -> tuple[int, int]:
     return start, end
 
 
+# markdown conversion is relatively slow and runs on every config validation, while many texts (e.g. prefilled
+# ones) repeat across bots and config versions, so results are memoized process-wide
+PREPROCESSED_MARKDOWN_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=PREPROCESSED_MARKDOWN_CACHE_SIZE)
 def preprocess_markdown_for_telegram(text: str) -> str:
     if not text:
         return text
@@ -1,4 +1,4 @@
-from typing import Any, Union, get_args, get_origin
+from typing import Any, Sequence, Union, cast, get_args, get_origin
 
 from pydantic import (
     BaseModel,
@@ -59,3 +59,25 @@ MultilangText = dict[Language, str]
 
 # AKA AnyText in telebot_components, here renamed to clearly mark strings that allow localization
 LocalizableText = Union[str, MultilangText]
+
+
+def join_localizable_texts(msgs: Sequence[LocalizableText], sep: str) -> LocalizableText:
+    if not msgs:
+        raise ValueError("Nothing to join")
+
+    def _join_str(strings: list[str]) -> str:
+        return sep.join([s for s in strings if s])
+
+    if all(isinstance(msg, str) for msg in msgs):
+        return _join_str(cast(list[str], msgs))
+    else:
+        if any(isinstance(msg, str) for msg in msgs):
+            raise ValueError("All msgs must be strings or multilang texts, not mixed")
+        multilang_msgs = cast(list[MultilangText], msgs)
+        multilang_msgs_aggregated = {lang: [localization] for lang, localization in multilang_msgs[0].items()}
+        for msg in multilang_msgs[1:]:
+            for key, localizations in multilang_msgs_aggregated.items():
+                if key not in msg:
+                    raise ValueError(f"All msgs must be localized to the same languages, but {msg} misses {key!r}")
+                localizations.append(msg[key])
+        return {lang: _join_str(localization) for lang, localization in multilang_msgs_aggregated.items()}
@@ -0,0 +1,42 @@
+import asyncio
+import contextlib
+import datetime
+import time
+import uuid
+from typing import AsyncIterator, Optional
+
+from telebot_components.redis_utils.interface import RedisInterface
+
+
+@contextlib.asynccontextmanager
+async def redis_lock(
+    redis: RedisInterface,
+    key: str,
+    expiration: datetime.timedelta,
+    acquire_timeout: Optional[datetime.timedelta] = None,
+    retry_period_sec: float = 0.05,
+) -> AsyncIterator[None]:
+    """
+    Lock shared by all processes using the same Redis; expiration only guards against locks left by crashed
+    processes, so it must be longer than the locked section takes. Acquiring the lock raises TimeoutError after
+    acquire_timeout, by default twice the expiration: enough for a lock left by a crashed process to expire and
+    for one more holder to finish.
+
+    Release is not atomic (GET then DEL, since the Redis interface has no scripting), so a lock that expired
+    in between and was acquired by someone else may be released. This only happens if the locked section
+    takes longer than the expiration, which breaks the mutual exclusion anyway, so the race is accepted.
+    """
+    if acquire_timeout is None:
+        acquire_timeout = 2 * expiration
+    deadline = time.monotonic() + acquire_timeout.total_seconds()
+    token = uuid.uuid4().hex.encode("utf-8")
+    while not await redis.set(key, token, ex=expiration, nx=True):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Failed to acquire Redis lock {key!r} in {acquire_timeout}")
+        await asyncio.sleep(retry_period_sec)
+    try:
+        yield
+    finally:
+        # not releasing the lock acquired by someone else after this one has expired
+        if await redis.get(key) == token:
+            await redis.delete(key)
@@ -23,6 +23,9 @@ class MockBotRunner(ConstructedBotRunner):
         self.running: dict[str, dict[str, BotRunner]] = collections.defaultdict(dict)
 
     async def start(self, owner_id: str, bot_id: str, bot_runner: BotRunner) -> bool:
+        # background jobs are not run by the mock runner
+        for job in bot_runner.background_jobs:
+            job.close()
         self.running[owner_id][bot_id] = bot_runner
         return True
 
@@ -30,6 +33,9 @@ class MockBotRunner(ConstructedBotRunner):
         stopped = self.running[username].pop(bot_id, None)
         return stopped is not None
 
+    async def is_running(self, owner_id: str, bot_id: str) -> bool:
+        return bot_id in self.running.get(owner_id, {})
+
     async def cleanup(self) -> None:
         pass
 
@@ -1,8 +1,13 @@
+import functools
+
 import aiohttp.web
 from pytest_aiohttp.plugin import AiohttpClient  # type: ignore
+from telebot.runner import BotRunner
 
 from telebot_constructor.app import TelebotConstructorApp
-from tests.utils import RECENT_TIMESTAMP, mask_recent_timestamps
+from telebot_constructor.runners import BotConstructionError, ConstructedBotRunner
+from tests.test_app.conftest import MockBotRunner
+from tests.utils import EMPTY_UPDATE_METRICS, RECENT_TIMESTAMP, mask_recent_timestamps
 
 
 async def test_get_logged_in_user(
@@ -38,7 +43,12 @@ async def test_bot_config(
     # saving first version of bot config
     bot_config_1 = {
         "token_secret_name": "test-1312-token",
-        "user_flow_config": {"entrypoints": [], "blocks": [], "node_display_coords": {}},
+        "user_flow_config": {
+            "entrypoints": [],
+            "blocks": [],
+            "node_display_coords": {},
+            "media_warm_up_chat_id": None,
+        },
         "display_name": None,
     }
     resp = await client.post(
@@ -84,6 +94,7 @@ async def test_bot_config(
             "last_errors": [],
             "admin_chat_ids": [],
             "alert_chat_id": None,
+            "update_metrics": None,
         }
     ]
     bot_created_event = resp_json_1[0]["last_events"][0]  # type: ignore
@@ -127,6 +138,7 @@ async def test_bot_config(
             "last_errors": [],
             "admin_chat_ids": [],
             "alert_chat_id": None,
+            "update_metrics": EMPTY_UPDATE_METRICS,
         }
     ]
     bot_started_event = resp_json_2[0]["last_events"][1]  # type: ignore
@@ -162,6 +174,7 @@ async def test_bot_config(
             ],
             "blocks": [],
             "node_display_coords": {},
+            "media_warm_up_chat_id": None,
         },
         "display_name": None,
     }
@@ -223,6 +236,7 @@ async def test_bot_config(
         "last_errors": [],
         "admin_chat_ids": [],
         "alert_chat_id": None,
+        "update_metrics": EMPTY_UPDATE_METRICS,
     }
     bot_edited_event, bot_stopped_event, bot_started_again_event = resp_json_3["last_events"][2:]  # type: ignore
 
@@ -260,6 +274,7 @@ async def test_bot_config(
         "last_errors": [],
         "admin_chat_ids": [],
         "alert_chat_id": None,
+        "update_metrics": EMPTY_UPDATE_METRICS,  # kept after the bot is stopped
     }
 
     # let's delete this bot for good
@@ -367,5 +382,181 @@ async def test_admin_chat_ids(
             "last_errors": [],
             "admin_chat_ids": [987654321],
             "alert_chat_id": None,
+            "update_metrics": None,
         }
     ]
+
+
+async def test_bot_is_not_constructed_for_runner_reconstructing_bots(
+    constructor_app: tuple[TelebotConstructorApp, aiohttp.web.Application],
+    aiohttp_client: AiohttpClient,
+) -> None:
+    constructor, web_app = constructor_app
+    client = await aiohttp_client(web_app)
+    runner = constructor.runner
+    assert isinstance(runner, MockBotRunner)
+    runner.reconstructs_bots = True
+
+    bot_id = "test-bot-1312"
+    resp = await client.post("/api/secrets/test-1312-reconstructed-token", data="reconstructed-token")
+    assert resp.status == 200
+    bot_config = {
+        "token_secret_name": "test-1312-reconstructed-token",
+        "user_flow_config": {
+            "entrypoints": [
+                {
+                    "command": {
+                        "entrypoint_id": "default-start-command",
+                        "command": "start",
+                        "next_block_id": None,
+                        "scope": "private",
+                        "short_description": None,
+                    },
+                    "catch_all": None,
+                    "regex": None,
+                },
+            ],
+            "blocks": [],
+            "node_display_coords": {},
+            "media_warm_up_chat_id": None,
+        },
+        "display_name": None,
+    }
+    resp = await client.post(
+        f"/api/config/{bot_id}",
+        json={"config": bot_config, "start": True, "version_message": "init", "display_name": "my bot"},
+    )
+    assert resp.status == 201
+
+    # the runner got a bare bot with no handlers, it constructs the bot on its own
+    bot_runner = runner.running["no-auth"][bot_id]
+    assert not bot_runner.bot.message_handlers
+    assert not bot_runner.background_jobs
+
+
+async def test_construction_error_reported_by_runner_reconstructing_bots(
+    constructor_app: tuple[TelebotConstructorApp, aiohttp.web.Application],
+    aiohttp_client: AiohttpClient,
+) -> None:
+    constructor, web_app = constructor_app
+    client = await aiohttp_client(web_app)
+    runner = constructor.runner
+    assert isinstance(runner, MockBotRunner)
+    runner.reconstructs_bots = True
+
+    bot_id = "test-bot-1312"
+    resp = await client.post("/api/secrets/test-1312-token", data="token")
+    assert resp.status == 200
+    bot_config = {
+        "token_secret_name": "test-1312-token",
+        "user_flow_config": {
+            "entrypoints": [],
+            "blocks": [],
+            "node_display_coords": {},
+            "media_warm_up_chat_id": None,
+        },
+        "display_name": None,
+    }
+    resp = await client.post(
+        f"/api/config/{bot_id}",
+        json={"config": bot_config, "start": True, "version_message": "init", "display_name": "my bot"},
+    )
+    assert resp.status == 201
+
+    async def failing_swap(owner_id: str, bot_id: str, bot_runner: BotRunner) -> bool:
+        raise BotConstructionError("Error setting up block")
+
+    # the error is shown to the user as with the bot constructed by the app, and the old version keeps running
+    runner.swap = failing_swap  # type: ignore
+    resp = await client.post(f"/api/start/{bot_id}", json={"version": 0})
+    assert resp.status == 400
+    assert resp.reason == "Error setting up block"
+    assert await runner.is_running("no-auth", bot_id)
+    resp = await client.get(f"/api/info/{bot_id}")
+    assert (await resp.json())["running_version"] == 0
+
+
+async def test_bot_marked_not_running_after_failed_restart(
+    constructor_app: tuple[TelebotConstructorApp, aiohttp.web.Application],
+    aiohttp_client: AiohttpClient,
+) -> None:
+    constructor, web_app = constructor_app
+    client = await aiohttp_client(web_app)
+    runner = constructor.runner
+    assert isinstance(runner, MockBotRunner)
+
+    bot_id = "test-bot-1312"
+    resp = await client.post("/api/secrets/test-1312-token", data="token")
+    assert resp.status == 200
+    bot_config = {
+        "token_secret_name": "test-1312-token",
+        "user_flow_config": {
+            "entrypoints": [],
+            "blocks": [],
+            "node_display_coords": {},
+            "media_warm_up_chat_id": None,
+        },
+        "display_name": None,
+    }
+    resp = await client.post(
+        f"/api/config/{bot_id}",
+        json={"config": bot_config, "start": True, "version_message": "init", "display_name": "my bot"},
+    )
+    assert resp.status == 201
+    resp = await client.get(f"/api/info/{bot_id}")
+    assert (await resp.json())["running_version"] == 0
+
+    async def failing_start(owner_id: str, bot_id: str, bot_runner: BotRunner) -> bool:
+        for job in bot_runner.background_jobs:
+            job.close()
+        return False
+
+    # the default swap stops the old bot before starting the new one, so it's not running after the failure
+    runner.start = failing_start  # type: ignore
+    resp = await client.post(f"/api/start/{bot_id}", json={"version": 0})
+    assert resp.status == 500
+    assert not await runner.is_running("no-auth", bot_id)
+    resp = await client.get(f"/api/info/{bot_id}")
+    assert (await resp.json())["running_version"] is None
+
+
+async def test_failed_restart_with_runner_not_reporting_running_bots(
+    constructor_app: tuple[TelebotConstructorApp, aiohttp.web.Application],
+    aiohttp_client: AiohttpClient,
+) -> None:
+    constructor, web_app = constructor_app
+    client = await aiohttp_client(web_app)
+    runner = constructor.runner
+    assert isinstance(runner, MockBotRunner)
+
+    bot_id = "test-bot-1312"
+    resp = await client.post("/api/secrets/test-1312-token", data="token")
+    assert resp.status == 200
+    bot_config = {
+        "token_secret_name": "test-1312-token",
+        "user_flow_config": {
+            "entrypoints": [],
+            "blocks": [],
+            "node_display_coords": {},
+            "media_warm_up_chat_id": None,
+        },
+        "display_name": None,
+    }
+    resp = await client.post(
+        f"/api/config/{bot_id}",
+        json={"config": bot_config, "start": True, "version_message": "init", "display_name": "my bot"},
+    )
+    assert resp.status == 201
+
+    async def failing_swap(owner_id: str, bot_id: str, bot_runner: BotRunner) -> bool:
+        for job in bot_runner.background_jobs:
+            job.close()
+        return False
+
+    # as with runners implemented before is_running was added, the previous version is assumed to keep running
+    runner.swap = failing_swap  # type: ignore
+    runner.is_running = functools.partial(ConstructedBotRunner.is_running, runner)  # type: ignore
+    resp = await client.post(f"/api/start/{bot_id}", json={"version": 0})
+    assert resp.status == 500
+    resp = await client.get(f"/api/info/{bot_id}")
+    assert (await resp.json())["running_version"] == 0
@@ -76,8 +76,8 @@ async def test_bot_level_errors(
         assert isinstance(error, dict)
         assert error["timestamp"] == RECENT_TIMESTAMP
         assert error["message"].startswith(
-            "Error processing update with handler 'telebot_constructor.user_flow.entrypoints.command."
-            + "CommandEntryPoint.setup.<locals>.cmd_handler': Message({'content_type': 'text', 'id': 1, "
+            "Error processing update with handler 'telebot_constructor.user_flow.entrypoints.router."
+            + "EntryPointRouter.setup.<locals>.entrypoint_router': Message({'content_type': 'text', 'id': 1, "
             + "'message_id': 1, 'from_user': {'id': "
             + f"{user_id}, 'is_bot': False, 'first_name': 'john pork'"
         )
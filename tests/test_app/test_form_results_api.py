@@ -8,6 +8,7 @@ from telebot.test_util import MockedAsyncTeleBot
 from telebot_constructor.app import TelebotConstructorApp
 from tests.test_app.conftest import MockBotRunner
 from tests.utils import (
+    EMPTY_UPDATE_METRICS,
     RECENT_TIMESTAMP,
     assert_method_call_kwargs_include,
     mask_recent_timestamps,
@@ -128,6 +129,7 @@ async def test_form_results_api(
         "last_errors": [],
         "admin_chat_ids": [],
         "alert_chat_id": None,
+        "update_metrics": EMPTY_UPDATE_METRICS,
     }
 
     assert isinstance(constructor.runner, MockBotRunner)
@@ -214,6 +216,7 @@ async def test_form_results_api(
         "last_errors": [],
         "admin_chat_ids": [],
         "alert_chat_id": None,
+        "update_metrics": EMPTY_UPDATE_METRICS,
     }
 
     # finally, calling the form results api to get user's responses
@@ -268,6 +271,7 @@ async def test_form_results_api(
             },
             "admin_chat_ids": [],
             "alert_chat_id": None,
+            "update_metrics": None,
         },
     }
 
@@ -315,6 +319,7 @@ async def test_form_results_api(
             },
             "admin_chat_ids": [],
             "alert_chat_id": None,
+            "update_metrics": None,
         },
     }
 
@@ -1,11 +1,18 @@
+import time
 from typing import Tuple
 
 import aiohttp.web
+import pytest
 from pytest_aiohttp.plugin import AiohttpClient  # type: ignore
 from telebot import types as tg
 from telebot.test_util import MockedAsyncTeleBot
+from telebot_components.redis_utils.emulation import RedisEmulation
 
 from telebot_constructor.app import TelebotConstructorApp
+from telebot_constructor.group_chat_discovery import GroupChatDiscoveryHandler
+from telebot_constructor.telegram_files_downloader import (
+    InmemoryCacheTelegramFilesDownloader,
+)
 from tests.test_app.conftest import MockBotRunner
 from tests.utils import tg_update_message_to_bot
 
@@ -77,3 +84,52 @@ async def test_group_chat_discovery(
             "photo": None,
         }
     ]
+
+
+async def test_discovery_mode_state_is_kept_in_process() -> None:
+    redis = RedisEmulation()
+    handler = GroupChatDiscoveryHandler(redis=redis, telegram_files_downloader=InmemoryCacheTelegramFilesDownloader())
+    assert not handler.is_discovering("user", "bot")
+    await handler.start_discovery("user", "bot")
+    assert handler.is_discovering("user", "bot")
+    assert not handler.is_discovering("user", "other-bot")
+
+    # e.g. after constructor restart, the state is loaded from the store when setting up bot handlers
+    restarted_handler = GroupChatDiscoveryHandler(
+        redis=redis, telegram_files_downloader=InmemoryCacheTelegramFilesDownloader()
+    )
+    assert not restarted_handler.is_discovering("user", "bot")
+    await restarted_handler.setup_handlers("user", "bot", bot=MockedAsyncTeleBot("token"))
+    assert restarted_handler.is_discovering("user", "bot")
+
+    await restarted_handler.stop_discovery("user", "bot")
+    assert not restarted_handler.is_discovering("user", "bot")
+    await handler.load_discovery_mode("user", "other-bot")
+    assert not handler.is_discovering("user", "other-bot")
+
+    # state changed by another process is picked up on sync
+    assert handler.is_discovering("user", "bot")
+    await handler.sync_discovery_modes()
+    assert not handler.is_discovering("user", "bot")
+    await restarted_handler.start_discovery("user", "bot")
+    await handler.sync_discovery_modes()
+    assert handler.is_discovering("user", "bot")
+
+
+async def test_discovery_mode_deadline_is_kept_after_restart(monkeypatch: pytest.MonkeyPatch) -> None:
+    redis = RedisEmulation()
+    handler = GroupChatDiscoveryHandler(redis=redis, telegram_files_downloader=InmemoryCacheTelegramFilesDownloader())
+    started_at = time.time()
+    await handler.start_discovery("user", "bot")
+
+    duration = GroupChatDiscoveryHandler.DISCOVERY_MODE_DURATION.total_seconds()
+    monkeypatch.setattr(time, "time", lambda: started_at + 0.9 * duration)
+    restarted_handler = GroupChatDiscoveryHandler(
+        redis=redis, telegram_files_downloader=InmemoryCacheTelegramFilesDownloader()
+    )
+    await restarted_handler.load_discovery_mode("user", "bot")
+    assert restarted_handler.is_discovering("user", "bot")
+
+    # discovery mode ends when it was originally scheduled to, not a full duration after the restart
+    monkeypatch.setattr(time, "time", lambda: started_at + 1.1 * duration)
+    assert not restarted_handler.is_discovering("user", "bot")
@@ -1,7 +1,25 @@
+import asyncio
+import tempfile
+from pathlib import Path
+from typing import Any, AsyncIterator
+
 import aiohttp.web
 from pytest_aiohttp.plugin import AiohttpClient  # type: ignore
+from telebot_components.redis_utils.emulation import RedisEmulation
 
 from telebot_constructor.app import TelebotConstructorApp
+from telebot_constructor.store.media import (
+    AwsS3Credentials,
+    AwsS3MediaStore,
+    AwsS3MediaStoreConfig,
+    CachingMediaStore,
+    ContentAddressedMediaStore,
+    FilesystemMediaStore,
+    Media,
+    MediaStream,
+    RedisMediaStore,
+)
+from tests.utils import NxRedisEmulation
 
 
 async def test_media_api(
@@ -29,3 +47,358 @@ async def test_media_api(
     assert resp.status == 404
     resp = await client.delete(f"/api/media/{media_id}")
     assert resp.status == 404
+
+
+async def test_media_api_ranges_and_etag(
+    constructor_app: tuple[TelebotConstructorApp, aiohttp.web.Application],
+    aiohttp_client: AiohttpClient,
+) -> None:
+    _, web_app = constructor_app
+    client = await aiohttp_client(web_app)
+
+    content = bytes(range(256)) * 1024
+    resp = await client.post("/api/media", data=content, headers={"X-Telebot-Constructor-Filename": "data.bin"})
+    assert resp.status == 200
+    media_id = await resp.text()
+
+    resp = await client.get(f"/api/media/{media_id}")
+    assert resp.status == 200
+    assert resp.headers["Accept-Ranges"] == "bytes"
+    assert await resp.read() == content
+    etag = resp.headers["ETag"]
+
+    resp = await client.get(f"/api/media/{media_id}", headers={"If-None-Match": etag})
+    assert resp.status == 304
+    assert await resp.read() == b""
+
+    resp = await client.get(f"/api/media/{media_id}", headers={"Range": "bytes=10-19"})
+    assert resp.status == 206
+    assert resp.headers["Content-Range"] == f"bytes 10-19/{len(content)}"
+    assert await resp.read() == content[10:20]
+
+    resp = await client.get(f"/api/media/{media_id}", headers={"Range": "bytes=-100"})
+    assert resp.status == 206
+    assert await resp.read() == content[-100:]
+
+    resp = await client.get(f"/api/media/{media_id}", headers={"Range": "bytes=100000-"})
+    assert resp.status == 206
+    assert await resp.read() == content[100000:]
+
+    resp = await client.get(f"/api/media/{media_id}", headers={"Range": f"bytes={len(content)}-"})
+    assert resp.status == 416
+
+
+async def _read_all(media_stream: MediaStream, start: int, end: int) -> bytes:
+    return b"".join([chunk async for chunk in media_stream.read(start, end)])
+
+
+async def test_filesystem_media_store() -> None:
+    with tempfile.TemporaryDirectory() as tempdir:
+        store = FilesystemMediaStore(Path(tempdir), io_threads=2)
+        content = b"hello world" * 10_000
+        media_id = await store.save_media("owner", Media(content=content, filename="hello.txt"))
+        assert media_id is not None
+        assert sorted(p.name for p in (Path(tempdir) / "owner").iterdir()) == [media_id, f"{media_id}.filename"]
+
+        media = await store.load_media("owner", media_id)
+        assert media == Media(content=content, filename="hello.txt")
+
+        media_stream = await store.load_media_stream("owner", media_id)
+        assert media_stream is not None
+        assert media_stream.size == len(content)
+        assert media_stream.filename == "hello.txt"
+        assert media_stream.mimetype == "text/plain"
+        assert media_stream.path is not None
+        assert await _read_all(media_stream, 0, media_stream.size) == content
+        assert await _read_all(media_stream, 5, 100_005) == content[5:100_005]
+        assert await _read_all(media_stream, 10, 10) == b""
+
+        assert await store.delete_media("owner", media_id)
+        assert not await store.delete_media("owner", media_id)
+        assert await store.load_media("owner", media_id) is None
+        assert await store.load_media_stream("owner", media_id) is None
+        assert list((Path(tempdir) / "owner").iterdir()) == []
+
+        media_id = await store.save_media("owner", Media(content=content, filename=None))
+        assert media_id is not None
+        assert await store.load_media("owner", media_id) == Media(content=content, filename=None)
+        await store.cleanup()
+
+
+async def test_content_addressed_media_store() -> None:
+    redis = RedisEmulation()
+    blob_store = RedisMediaStore(redis)
+    store = ContentAddressedMediaStore(blob_store, redis=redis)
+
+    content = b"some image"
+    media_id_1 = await store.save_media("owner-1", Media(content=content, filename="image.png"))
+    media_id_2 = await store.save_media("owner-2", Media(content=content, filename="image.png"))
+    media_id_3 = await store.save_media("owner-1", Media(content=b"other image", filename=None))
+    assert media_id_1 is not None and media_id_2 is not None and media_id_3 is not None
+    assert media_id_1 == media_id_2
+    assert media_id_1 != media_id_3
+    # the same content is stored only once
+    assert len(await redis.keys("telebot-constructor/media/content-addressed-blobs/*")) == 2
+
+    assert await store.load_media("owner-1", media_id_1) == Media(content=content, filename="image.png")
+    assert await store.load_media("owner-2", media_id_2) == Media(content=content, filename="image.png")
+    assert await store.load_media("owner-2", media_id_3) is None  # not referenced by this owner
+    media_stream = await store.load_media_stream("owner-2", media_id_2)
+    assert media_stream is not None
+    assert media_stream.filename == "image.png"
+    assert await _read_all(media_stream, 0, media_stream.size) == content
+
+    assert await store.delete_media("owner-1", media_id_1)
+    assert not await store.delete_media("owner-1", media_id_1)
+    assert await store.load_media("owner-1", media_id_1) is None
+    assert await store.load_media("owner-2", media_id_2) == Media(content=content, filename="image.png")
+
+    # the same content saved by the owner several times is referenced until all copies are deleted
+    media_id_4 = await store.save_media("owner-2", Media(content=content, filename="image.png"))
+    media_id_5 = await store.save_media("owner-2", Media(content=content, filename="renamed.png"))
+    assert media_id_4 == media_id_2
+    assert media_id_5 is not None and media_id_5 != media_id_2
+    assert await store.load_media("owner-2", media_id_5) == Media(content=content, filename="renamed.png")
+    assert await store.delete_media("owner-2", media_id_2)
+    assert await store.load_media("owner-2", media_id_2) == Media(content=content, filename="image.png")
+    assert await store.delete_media("owner-2", media_id_2)
+    assert await store.load_media("owner-2", media_id_2) is None
+    assert await store.load_media("owner-2", media_id_5) == Media(content=content, filename="renamed.png")
+    assert len(await redis.keys("telebot-constructor/media/content-addressed-blobs/*")) == 2
+
+    assert await store.delete_media("owner-2", media_id_5)
+    assert await store.load_media("owner-2", media_id_5) is None
+    assert len(await redis.keys("telebot-constructor/media/content-addressed-blobs/*")) == 1
+
+    # media saved directly to the underlying store before deduplication are still available
+    legacy_media_id = await blob_store.save_media("owner-1", Media(content=b"legacy", filename=None))
+    assert legacy_media_id is not None
+    assert await store.load_media("owner-1", legacy_media_id) == Media(content=b"legacy", filename=None)
+    assert await store.delete_media("owner-1", legacy_media_id)
+
+
+class SlowMediaStore(RedisMediaStore):
+    async def save_media(self, owner_id: str, media: Media) -> str | None:
+        await asyncio.sleep(0.01)
+        return await super().save_media(owner_id, media)
+
+
+async def test_content_addressed_media_store_shared_by_processes() -> None:
+    redis = NxRedisEmulation()
+    blob_store = SlowMediaStore(redis)
+    # stores in different processes only share Redis
+    stores = [ContentAddressedMediaStore(blob_store, redis=redis) for _ in range(2)]
+
+    content = b"some image"
+    media_ids = await asyncio.gather(
+        *[store.save_media(f"owner-{idx}", Media(content=content, filename=None)) for idx, store in enumerate(stores)]
+    )
+    assert media_ids[0] is not None and media_ids[0] == media_ids[1]
+    # the blob is uploaded once, despite concurrent saves
+    assert len(await redis.keys("telebot-constructor/media/content-addressed-blobs/*")) == 1
+    assert not await redis.keys("telebot-constructor/content-addressed-media/blob-lock/*")
+
+    # deleting the last reference races with adding a new one, the blob must survive
+    await asyncio.gather(
+        stores[0].delete_media("owner-0", media_ids[0]),
+        stores[1].save_media("owner-2", Media(content=content, filename=None)),
+    )
+    assert await stores[0].delete_media("owner-1", media_ids[0])
+    assert await stores[1].load_media("owner-2", media_ids[0]) == Media(content=content, filename=None)
+
+
+class CountingMediaStore(RedisMediaStore):
+    def __init__(self, redis: RedisEmulation) -> None:
+        super().__init__(redis)
+        self.loads = 0
+
+    async def load_media(self, owner_id: str, media_id: str) -> Media | None:
+        self.loads += 1
+        await asyncio.sleep(0.01)
+        return await super().load_media(owner_id, media_id)
+
+
+async def test_caching_media_store() -> None:
+    underlying = CountingMediaStore(RedisEmulation())
+    store = CachingMediaStore(underlying, max_size_bytes=10, max_item_size_bytes=6)
+
+    media_1 = Media(content=b"12345", filename="1.png")
+    media_2 = Media(content=b"abcde", filename="2.png")
+    media_id_1 = await store.save_media("owner", media_1)
+    media_id_2 = await store.save_media("owner", media_2)
+    large_media_id = await store.save_media("owner", Media(content=b"too large", filename=None))
+    assert media_id_1 is not None and media_id_2 is not None and large_media_id is not None
+
+    # concurrent loads are coalesced
+    assert await asyncio.gather(*[store.load_media("owner", media_id_1) for _ in range(10)]) == [media_1] * 10
+    assert underlying.loads == 1
+    assert await store.load_media("owner", media_id_1) == media_1
+    assert underlying.loads == 1
+    assert (store.metrics.hits, store.metrics.misses, store.metrics.coalesced) == (1, 1, 9)
+
+    assert await store.load_media("owner", media_id_2) == media_2
+    assert store.metrics.cached_bytes == 10
+    assert await store.load_media("owner", large_media_id) is not None
+    assert await store.load_media("owner", large_media_id) is not None
+    assert underlying.loads == 4
+    assert store.metrics.cached_items == 2
+
+    # least recently used media is evicted
+    media_3 = Media(content=b"xyz", filename=None)
+    media_id_3 = await store.save_media("owner", media_3)
+    assert media_id_3 is not None
+    assert await store.load_media("owner", media_id_3) == media_3
+    assert store.metrics.evictions == 1
+    assert store.metrics.cached_bytes == 8
+    assert await store.load_media("owner", media_id_2) == media_2
+    assert underlying.loads == 5
+
+    # deleted media is dropped from cache, including the load in progress
+    load = asyncio.create_task(store.load_media("owner", media_id_1))
+    await asyncio.sleep(0)
+    assert await store.delete_media("owner", media_id_1)
+    await load
+    assert await store.load_media("owner", media_id_1) is None
+    assert await store.delete_media("owner", media_id_2)
+    assert await store.load_media("owner", media_id_2) is None
+    assert store.metrics.cached_items == 1
+
+
+class FakeS3Body:
+    def __init__(self, content: bytes) -> None:
+        self.content = content
+
+    async def __aenter__(self) -> "FakeS3Body":
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        pass
+
+    async def iter_chunks(self, chunk_size: int) -> AsyncIterator[bytes]:
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start : start + chunk_size]
+
+
+class FakeS3Client:
+    """Stand-in for aiobotocore S3 client, recording calls and the number of concurrent requests"""
+
+    def __init__(self, failing_part_number: int | None = None) -> None:
+        self.objects: dict[str, bytes] = dict()
+        self.uploads: dict[str, dict[int, bytes]] = dict()
+        self.calls: list[str] = []
+        self.failing_part_number = failing_part_number
+        self.concurrent_requests = 0
+        self.max_concurrent_requests = 0
+
+    async def _request(self, method: str) -> None:
+        self.calls.append(method)
+        self.concurrent_requests += 1
+        self.max_concurrent_requests = max(self.max_concurrent_requests, self.concurrent_requests)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.concurrent_requests -= 1
+
+    async def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs: Any) -> dict:
+        await self._request("put_object")
+        self.objects[Key] = Body
+        return {}
+
+    async def create_multipart_upload(self, Bucket: str, Key: str, **kwargs: Any) -> dict:
+        await self._request("create_multipart_upload")
+        self.uploads[Key] = dict()
+        return {"UploadId": Key}
+
+    async def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes) -> dict:
+        await self._request("upload_part")
+        if PartNumber == self.failing_part_number:
+            raise RuntimeError("part upload failed")
+        self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": f"etag-{PartNumber}"}
+
+    async def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict) -> dict:
+        await self._request("complete_multipart_upload")
+        parts = self.uploads.pop(UploadId)
+        assert [part["PartNumber"] for part in MultipartUpload["Parts"]] == sorted(parts)
+        self.objects[Key] = b"".join(parts[part_number] for part_number in sorted(parts))
+        return {}
+
+    async def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str) -> dict:
+        await self._request("abort_multipart_upload")
+        self.uploads.pop(UploadId)
+        return {}
+
+    async def head_object(self, Bucket: str, Key: str) -> dict:
+        await self._request("head_object")
+        return {"ContentLength": len(self.objects[Key])}
+
+    async def get_object(self, Bucket: str, Key: str, Range: str | None = None) -> dict:
+        await self._request("get_object")
+        content = self.objects[Key]
+        if Range is not None:
+            start, end = Range.removeprefix("bytes=").split("-")
+            content = content[int(start) : int(end) + 1]
+        return {"Body": FakeS3Body(content)}
+
+
+def make_fake_s3_media_store(config: AwsS3MediaStoreConfig, client: FakeS3Client) -> AwsS3MediaStore:
+    store = AwsS3MediaStore(
+        credentials=AwsS3Credentials(access_key_id="key", secret_access_key="secret", region="region", bucket="b"),
+        config=config,
+    )
+    store._client = client
+    return store
+
+
+async def test_aws_s3_media_store_multipart_upload() -> None:
+    client = FakeS3Client()
+    config = AwsS3MediaStoreConfig(multipart_upload_threshold=10, multipart_upload_part_size=4)
+    store = make_fake_s3_media_store(config, client)
+
+    small_media_id = await store.save_media("owner", Media(content=b"small", filename=None))
+    assert small_media_id is not None
+    assert client.calls == ["put_object"]
+
+    content = b"large enough media"
+    media_id = await store.save_media("owner", Media(content=content, filename=None))
+    assert media_id is not None
+    assert client.calls.count("upload_part") == 5
+    assert client.calls[-1] == "complete_multipart_upload"
+    assert await store.load_media("owner", media_id) == Media(content=content, filename=None)
+
+
+async def test_aws_s3_media_store_aborts_failed_multipart_upload() -> None:
+    client = FakeS3Client(failing_part_number=2)
+    config = AwsS3MediaStoreConfig(multipart_upload_threshold=10, multipart_upload_part_size=4)
+    store = make_fake_s3_media_store(config, client)
+
+    assert await store.save_media("owner", Media(content=b"large enough media", filename=None)) is None
+    assert client.calls[-1] == "abort_multipart_upload"
+    assert "complete_multipart_upload" not in client.calls
+    assert not client.uploads
+    assert not client.objects
+
+
+async def test_aws_s3_media_store_concurrency_limits() -> None:
+    client = FakeS3Client()
+    config = AwsS3MediaStoreConfig(max_concurrent_requests=2, max_concurrent_streams=1)
+    store = make_fake_s3_media_store(config, client)
+
+    media_ids = await asyncio.gather(
+        *[store.save_media("owner", Media(content=f"media {i}".encode(), filename=None)) for i in range(6)]
+    )
+    assert all(media_id is not None for media_id in media_ids)
+    assert client.max_concurrent_requests == 2
+
+    # a stream being read by a slow client doesn't take request slots
+    media_stream = await store.load_media_stream("owner", str(media_ids[0]))
+    assert media_stream is not None
+    chunks = media_stream.read(0, media_stream.size)
+    assert await anext(chunks) == b"media 0"
+    client.max_concurrent_requests = 0
+    media_ids = await asyncio.gather(
+        *[store.save_media("owner", Media(content=b"media", filename=None)) for _ in range(4)]
+    )
+    assert all(media_id is not None for media_id in media_ids)
+    assert client.max_concurrent_requests == 2
+    assert [chunk async for chunk in chunks] == []
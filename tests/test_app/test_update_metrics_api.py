@@ -0,0 +1,115 @@
+import time
+from typing import Tuple
+
+import aiohttp.web
+from pytest_aiohttp.plugin import AiohttpClient  # type: ignore
+from telebot.metrics import TelegramUpdateMetrics
+from telebot.test_util import MockedAsyncTeleBot
+
+from telebot_constructor.app import TelebotConstructorApp
+from tests.test_app.conftest import MockBotRunner
+from tests.utils import tg_update_message_to_bot
+
+
+async def test_update_metrics(
+    constructor_app: Tuple[TelebotConstructorApp, aiohttp.web.Application],
+    aiohttp_client: AiohttpClient,
+) -> None:
+    constructor, web_app = constructor_app
+    client = await aiohttp_client(web_app)
+
+    resp = await client.post("/api/secrets/test-token", data="update-metrics-token")
+    assert resp.status == 200
+    resp = await client.post(
+        "/api/config/mybot",
+        json={
+            "config": {
+                "token_secret_name": "test-token",
+                "user_flow_config": {
+                    "entrypoints": [
+                        {
+                            "command": {
+                                "entrypoint_id": "start",
+                                "command": "start",
+                                "next_block_id": "message",
+                            },
+                        }
+                    ],
+                    "blocks": [
+                        {
+                            "content": {
+                                "block_id": "message",
+                                "contents": [{"text": {"text": "hello", "markup": "none"}, "attachments": []}],
+                                "next_block_id": None,
+                            }
+                        }
+                    ],
+                    "node_display_coords": {},
+                },
+            },
+            "display_name": "my test bot",
+            "start": True,
+            "version_message": "init",
+        },
+    )
+    assert resp.status == 201
+
+    resp = await client.get("/api/info/mybot")
+    assert resp.status == 200
+    assert (await resp.json())["update_metrics"] == {
+        "updates": 0,
+        "unhandled_updates": 0,
+        "errors": 0,
+        "recent_updates_per_minute": 0.0,
+        "avg_processing_duration": None,
+        "p95_processing_duration": None,
+        "last_update_at": None,
+    }
+
+    assert isinstance(constructor.runner, MockBotRunner)
+    bot = constructor.runner.running["no-auth"]["mybot"].bot
+    assert isinstance(bot, MockedAsyncTeleBot)
+    await bot.process_new_updates(
+        [
+            tg_update_message_to_bot(
+                user_id=123,
+                first_name="john pork",
+                text=text,
+                metrics=TelegramUpdateMetrics(bot_prefix="test-bot", received_at=time.time(), update_type="message"),
+            )
+            for text in ["/start", "/start", "not a command"]
+        ]
+    )
+
+    resp = await client.get("/api/info")
+    assert resp.status == 200
+    [bot_info] = await resp.json()
+    update_metrics = bot_info["update_metrics"]
+    assert update_metrics["updates"] == 3
+    assert update_metrics["unhandled_updates"] == 1
+    assert update_metrics["errors"] == 0
+    assert update_metrics["recent_updates_per_minute"] > 0
+    assert update_metrics["avg_processing_duration"] is not None
+    assert update_metrics["p95_processing_duration"] is not None
+    assert update_metrics["last_update_at"] is not None
+
+    # metrics of all owners' bots are not available to regular users
+    resp = await client.get("/api/metrics")
+    assert resp.status == 404
+
+    constructor.metrics_token = "secret"
+    resp = await client.get("/api/metrics")
+    assert resp.status == 401
+    resp = await client.get("/api/metrics", headers={"Authorization": "Bearer sécret"})
+    assert resp.status == 401
+    resp = await client.get("/api/metrics", headers={"Authorization": "Bearer secret"})
+    assert resp.status == 200
+    metrics_text = await resp.text()
+    assert 'telebot_constructor_updates_total{owner_id="no-auth",bot_id="mybot",update_type="message"} 3' in (
+        metrics_text
+    )
+    assert 'telebot_constructor_unhandled_updates_total{owner_id="no-auth",bot_id="mybot"} 1' in metrics_text
+    assert 'telebot_constructor_update_processing_seconds_count{owner_id="no-auth",bot_id="mybot"} 3' in metrics_text
+    assert 'telebot_constructor_update_processing_seconds_bucket{owner_id="no-auth",bot_id="mybot",le="+Inf"} 3' in (
+        metrics_text
+    )
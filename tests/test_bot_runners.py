@@ -1,11 +1,28 @@
 import asyncio
 
+import pytest
 from aioresponses import aioresponses
+from telebot import types as tg
 from telebot.runner import BotRunner
 from telebot.test_util import MockedAsyncTeleBot
+from telebot.webhook import WebhookApp
 from yarl import URL
 
-from telebot_constructor.runners import PollingConstructedBotRunner
+from telebot_constructor.runners import (
+    BotConstructionError,
+    ConsistentHashRing,
+    DrainablePolling,
+    PollingConstructedBotRunner,
+    ShardedPollingConstructedBotRunner,
+    WebhookAppConstructedBotRunner,
+    WorkerContext,
+)
+from telebot_constructor.update_metrics import UpdateMetricsCollector
+from telebot_constructor.update_scheduler import (
+    FairUpdateScheduler,
+    UpdateSchedulerConfig,
+)
+from tests.utils import tg_update_message_to_bot
 
 
 async def test_polling_bot_runner() -> None:
@@ -34,3 +51,281 @@ async def test_polling_bot_runner() -> None:
         await asyncio.sleep(0.1)
         assert ("get", URL("https://api.telegram.org/botTOKEN/getUpdates")) in mock.requests
         await runner.stop(owner_id="user", bot_id="bot")
+
+
+class PollingStubBot(MockedAsyncTeleBot):
+    """Returns given updates until they are confirmed by a request with a higher offset, like Telegram does"""
+
+    def __init__(self, token: str, updates: list[tg.Update] | None = None) -> None:
+        super().__init__(token)
+        self.pending_updates = updates or []
+        self.get_updates_offsets: list[int | None] = []
+
+    async def get_updates(  # type: ignore
+        self, offset: int | None = None, timeout: int | None = None, **kwargs
+    ) -> list[tg.Update]:
+        self.get_updates_offsets.append(offset)
+        if offset is not None:
+            self.pending_updates = [update for update in self.pending_updates if update.update_id >= offset]
+        if self.pending_updates:
+            return list(self.pending_updates)
+        if timeout:
+            await asyncio.Event().wait()
+        return []
+
+
+async def idle_bot_runner_factory(owner_id: str, bot_id: str) -> BotRunner:
+    return BotRunner(bot_prefix=f"{owner_id}/{bot_id}", bot=PollingStubBot("TOKEN"))
+
+
+async def idle_worker_setup() -> WorkerContext:
+    update_metrics = UpdateMetricsCollector()
+
+    async def bot_runner_factory(owner_id: str, bot_id: str) -> BotRunner:
+        if bot_id == "broken-bot":
+            raise ValueError("Error setting up block")
+        update_metrics.handler_for(owner_id, bot_id)
+        return await idle_bot_runner_factory(owner_id, bot_id)
+
+    return WorkerContext(
+        bot_runner_factory=bot_runner_factory,
+        render_prometheus_metrics=update_metrics.render_prometheus,
+        update_metrics_summary=update_metrics.summary,
+    )
+
+
+def test_consistent_hash_ring() -> None:
+    keys = [f"user/bot-{i}" for i in range(1000)]
+    ring = ConsistentHashRing(shards=4)
+    shards = [ring.shard_for(key) for key in keys]
+    assert all(shards.count(shard) > 150 for shard in range(4))
+
+    # adding a shard only moves keys to it
+    bigger_ring = ConsistentHashRing(shards=5)
+    for key, shard in zip(keys, shards):
+        assert bigger_ring.shard_for(key) in {shard, 4}
+
+
+async def test_sharded_polling_bot_runner() -> None:
+    runner = ShardedPollingConstructedBotRunner(worker_setup=idle_worker_setup, workers=2)
+    assert await runner.stop(owner_id="user", bot_id="bot-0") is False
+    processes = [worker.process for worker in runner._workers]
+    bot_ids = [f"bot-{i}" for i in range(6)]
+    assert {runner.ring.shard_for(f"user/{bot_id}") for bot_id in bot_ids} == {0, 1}
+    try:
+        for bot_id in bot_ids:
+            bot_runner = await idle_bot_runner_factory("user", bot_id)
+            assert await runner.start(owner_id="user", bot_id=bot_id, bot_runner=bot_runner)
+        assert not await runner.start(owner_id="user", bot_id="bot-0", bot_runner=bot_runner)
+
+        assert await runner.stop(owner_id="user", bot_id="bot-0")
+        assert not await runner.stop(owner_id="user", bot_id="bot-0")
+        assert await runner.start(owner_id="user", bot_id="bot-0", bot_runner=bot_runner)
+
+        # metrics collected by the workers are merged, with each metric declared once
+        metrics = await runner.render_prometheus_metrics()
+        for metric in ("unhandled_updates_total", "queued_updates"):
+            assert metrics.count(f"# TYPE telebot_constructor_{metric} ") == 1
+            for bot_id in bot_ids:
+                assert f'telebot_constructor_{metric}{{owner_id="user",bot_id="{bot_id}"}} 0' in metrics
+        summary = await runner.update_metrics_summary(owner_id="user", bot_id="bot-1")
+        assert summary is not None
+        assert summary.updates == 0
+        assert await runner.update_metrics_summary(owner_id="user", bot_id="unknown-bot") is None
+
+        # construction errors in the worker are reported back
+        with pytest.raises(BotConstructionError, match="Error setting up block"):
+            await runner.start(owner_id="user", bot_id="broken-bot", bot_runner=bot_runner)
+        assert not await runner.is_running(owner_id="user", bot_id="broken-bot")
+    finally:
+        await runner.cleanup()
+    assert len(processes) == 2
+    assert all(not process.is_alive() for process in processes)
+
+
+@pytest.mark.parametrize("drain_timeout, is_handler_finished", [(1.0, True), (0.05, False)])
+async def test_polling_bot_runner_drains_bot_on_stop(drain_timeout: float, is_handler_finished: bool) -> None:
+    update = tg_update_message_to_bot(user_id=1, first_name="User", text="hello")
+    bot = PollingStubBot("TOKEN", updates=[update])
+    handler_started = asyncio.Event()
+    handler_finished = asyncio.Event()
+
+    @bot.message_handler()
+    async def slow_handler(message: tg.Message) -> None:
+        handler_started.set()
+        await asyncio.sleep(0.2)
+        handler_finished.set()
+
+    runner = PollingConstructedBotRunner(drain_timeout=drain_timeout)
+    assert await runner.start(owner_id="user", bot_id="bot", bot_runner=BotRunner(bot_prefix="bot-prefix", bot=bot))
+    await handler_started.wait()
+
+    polling, _ = runner.running_bots["user"]["bot"]
+    assert await runner.stop(owner_id="user", bot_id="bot")
+    assert handler_finished.is_set() is is_handler_finished
+    assert polling.drain_report is not None
+    assert polling.drain_report.processed_batches == int(is_handler_finished)
+    assert polling.drain_report.cancelled_batches == int(not is_handler_finished)
+    assert polling.drain_report.duration < drain_timeout + 0.1
+    # processed update is confirmed to Telegram when stopping the bot
+    assert bot.get_updates_offsets == [None, update.update_id + 1]
+
+
+async def test_polling_bot_runner_does_not_confirm_queued_updates_on_stop() -> None:
+    updates = [tg_update_message_to_bot(user_id=1, first_name="User", text=f"hello {i}") for i in range(3)]
+    for update_id, update in enumerate(updates, start=10):
+        update.update_id = update_id
+    bot = PollingStubBot("TOKEN", updates=updates)
+    handler_started = asyncio.Event()
+    handled_texts: list[str] = []
+
+    @bot.message_handler()
+    async def slow_handler(message: tg.Message) -> None:
+        handler_started.set()
+        await asyncio.sleep(0.1)
+        handled_texts.append(message.text_content)
+
+    runner = PollingConstructedBotRunner(
+        scheduler=FairUpdateScheduler(UpdateSchedulerConfig(max_concurrency_per_bot=1))
+    )
+    assert await runner.start(owner_id="user", bot_id="bot", bot_runner=BotRunner(bot_prefix="bot-prefix", bot=bot))
+    await handler_started.wait()
+
+    polling, _ = runner.running_bots["user"]["bot"]
+    assert await runner.stop(owner_id="user", bot_id="bot")
+    assert handled_texts == ["hello 0"]
+    assert polling.drain_report is not None
+    assert polling.drain_report.unstarted_updates == 2
+    # only the processed update is confirmed, the queued ones will be received again on the next start
+    assert bot.get_updates_offsets == [None, 11]
+    # stopped bot's queue is dropped from the scheduler
+    assert runner.scheduler.summary(("user", "bot")) is None
+
+
+async def test_polling_bot_runner_keeps_queued_updates_unconfirmed_while_polling(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(DrainablePolling, "INTERVAL_SEC", 0.01)
+    updates = [tg_update_message_to_bot(user_id=1, first_name="User", text=f"hello {i}") for i in range(3)]
+    for update_id, update in enumerate(updates, start=10):
+        update.update_id = update_id
+    bot = PollingStubBot("TOKEN", updates=updates)
+    handler_started = asyncio.Event()
+    handled_texts: list[str] = []
+
+    @bot.message_handler()
+    async def slow_handler(message: tg.Message) -> None:
+        handler_started.set()
+        await asyncio.sleep(0.1)
+        handled_texts.append(message.text_content)
+
+    runner = PollingConstructedBotRunner(
+        scheduler=FairUpdateScheduler(UpdateSchedulerConfig(max_concurrency_per_bot=1))
+    )
+    assert await runner.start(owner_id="user", bot_id="bot", bot_runner=BotRunner(bot_prefix="bot-prefix", bot=bot))
+    await handler_started.wait()
+    await asyncio.sleep(0.05)
+
+    # polling continued while the first update was processed, without confirming the queued ones
+    assert len(bot.get_updates_offsets) > 2
+    assert set(bot.get_updates_offsets[1:]) == {11}
+    assert await runner.stop(owner_id="user", bot_id="bot")
+    assert handled_texts == ["hello 0"]
+    # queued updates are still there for the next start
+    assert [update.update_id for update in bot.pending_updates] == [11, 12]
+
+    bot.offset = None  # as on a fresh start
+    assert await runner.start(owner_id="user", bot_id="bot", bot_runner=BotRunner(bot_prefix="bot-prefix", bot=bot))
+    await asyncio.sleep(0.3)
+    assert await runner.stop(owner_id="user", bot_id="bot")
+    # updates received again while queued are not processed twice
+    assert handled_texts == ["hello 0", "hello 1", "hello 2"]
+    assert bot.pending_updates == []
+
+
+async def test_polling_bot_runner_swaps_bot_without_downtime() -> None:
+    update = tg_update_message_to_bot(user_id=1, first_name="User", text="hello")
+    old_bot = PollingStubBot("TOKEN", updates=[update])
+    new_bot = PollingStubBot("TOKEN")
+    handler_started = asyncio.Event()
+    handler_finished = asyncio.Event()
+
+    @old_bot.message_handler()
+    async def slow_handler(message: tg.Message) -> None:
+        handler_started.set()
+        await asyncio.sleep(0.2)
+        handler_finished.set()
+
+    runner = PollingConstructedBotRunner()
+    assert await runner.start(owner_id="user", bot_id="bot", bot_runner=BotRunner(bot_prefix="old", bot=old_bot))
+    await handler_started.wait()
+
+    swap = asyncio.create_task(
+        runner.swap(owner_id="user", bot_id="bot", bot_runner=BotRunner(bot_prefix="new", bot=new_bot))
+    )
+    await asyncio.sleep(0.05)
+    # the new bot continues polling from the old one's offset while the old one still processes the update
+    assert new_bot.get_updates_offsets == [update.update_id + 1]
+    assert not handler_finished.is_set()
+    assert await swap
+    assert handler_finished.is_set()
+    assert old_bot.get_updates_offsets == [None]
+
+    polling, _ = runner.running_bots["user"]["bot"]
+    assert polling.bot is new_bot
+    assert await runner.stop(owner_id="user", bot_id="bot")
+
+
+async def test_webhook_bot_runner_swaps_bot_without_resetting_webhook() -> None:
+    webhook_app = WebhookApp(base_url="https://example.com")
+    runner = WebhookAppConstructedBotRunner(webhook_app)
+    old_bot = MockedAsyncTeleBot("TOKEN")
+    old_bot.add_return_values(
+        "get_webhook_info",
+        tg.WebhookInfo(url="", has_custom_certificate=False, pending_update_count=0),
+    )
+    old_bot_runner = BotRunner(bot_prefix="bot-prefix", bot=old_bot)
+    assert await runner.start(owner_id="user", bot_id="bot", bot_runner=old_bot_runner)
+    assert len(old_bot.method_calls["set_webhook"]) == 1
+
+    new_bot = MockedAsyncTeleBot("TOKEN")
+    new_bot_runner = BotRunner(bot_prefix="bot-prefix", bot=new_bot)
+    assert await runner.swap(owner_id="user", bot_id="bot", bot_runner=new_bot_runner)
+    assert not new_bot.method_calls
+    assert "delete_webhook" not in old_bot.method_calls
+    assert webhook_app.bot_runner_by_subroute == {old_bot_runner.webhook_subroute(): new_bot_runner}
+    assert runner.added_runners["user"]["bot"] is new_bot_runner
+
+
+async def test_fair_update_scheduler() -> None:
+    scheduler = FairUpdateScheduler(UpdateSchedulerConfig(max_concurrency=1, max_queue_size_per_bot=8))
+    processing_order: list[str] = []
+
+    async def process(bot_id: str) -> None:
+        async with scheduler.slot(("user", bot_id)):
+            await asyncio.sleep(0.01)
+            processing_order.append(bot_id)
+
+    flood = [asyncio.create_task(process("viral")) for _ in range(10)]
+    await asyncio.sleep(0)
+    queue_space = asyncio.create_task(scheduler.wait_for_queue_space(("user", "viral")))
+    await asyncio.sleep(0.005)
+    assert not queue_space.done()
+    quiet = asyncio.create_task(process("quiet"))
+    await asyncio.gather(*flood, quiet, queue_space)
+
+    # the quiet bot doesn't wait for the flood to be processed
+    assert processing_order.index("quiet") <= 2
+    viral_summary = scheduler.summary(("user", "viral"))
+    assert viral_summary is not None
+    assert viral_summary.processed == 10
+    assert viral_summary.queued == 0
+    quiet_summary = scheduler.summary(("user", "quiet"))
+    assert quiet_summary is not None
+    assert quiet_summary.avg_wait_duration is not None
+    assert viral_summary.avg_wait_duration is not None
+    assert quiet_summary.avg_wait_duration < viral_summary.avg_wait_duration
+
+    metrics = scheduler.render_prometheus()
+    assert 'telebot_constructor_queued_updates{owner_id="user",bot_id="viral"} 0' in metrics
+    assert 'telebot_constructor_update_queue_wait_seconds_count{owner_id="user",bot_id="viral"} 10' in metrics
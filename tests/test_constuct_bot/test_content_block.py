@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import copy
 import time
@@ -15,13 +16,20 @@ from telebot_constructor.bot_config import (
     UserFlowEntryPointConfig,
 )
 from telebot_constructor.construct import construct_bot
-from telebot_constructor.store.media import Media, RedisMediaStore
+from telebot_constructor.store.media import Media, MediaId, RedisMediaStore
+from telebot_constructor.user_flow.block_metrics import load_block_metrics
 from telebot_constructor.user_flow.blocks.content import (
     Content,
     ContentBlock,
     ContentBlockContentAttachment,
     ContentText,
 )
+from telebot_constructor.user_flow.blocks.human_operator import (
+    FeedbackHandlerConfig,
+    HumanOperatorBlock,
+    MessagesToAdmin,
+    MessagesToUser,
+)
 from telebot_constructor.user_flow.entrypoints.command import CommandEntryPoint
 from tests.utils import (
     assert_method_call_dictified_kwargs_include,
@@ -572,3 +580,408 @@ def test_content_block_splits_too_many_attachments() -> None:
     img_content_2 = block.contents[2]
     assert img_content_2.text is None
     assert len(img_content_2.attachments) == 5
+
+
+class SlowRedisMediaStore(RedisMediaStore):
+    async def load_media(self, owner_id: str, media_id: MediaId) -> Media | None:
+        await asyncio.sleep(0.01)
+        return await super().load_media(owner_id, media_id)
+
+
+async def test_concurrent_first_time_photo_uploads() -> None:
+    redis = RedisEmulation()
+    secret_store = dummy_secret_store(redis)
+    owner_id = "test-username"
+    await secret_store.save_secret(secret_name="token", secret_value="<token>", owner_id=owner_id)
+
+    media_store = SlowRedisMediaStore(redis)
+    media_id = await media_store.save_media(owner_id, Media(content=b"attachment-body", filename=None))
+    assert media_id is not None
+
+    bot_config = BotConfig(
+        token_secret_name="token",
+        display_name="Content block test bot",
+        user_flow_config=UserFlowConfig(
+            entrypoints=[
+                UserFlowEntryPointConfig(
+                    command=CommandEntryPoint(
+                        entrypoint_id="command-1",
+                        command="start",
+                        next_block_id="content-1",
+                        short_description="start cmd",
+                    ),
+                )
+            ],
+            blocks=[
+                UserFlowBlockConfig(
+                    content=ContentBlock(
+                        block_id="content-1",
+                        contents=[
+                            Content(
+                                text=None,
+                                attachments=[ContentBlockContentAttachment(image=media_id)],
+                            )
+                        ],
+                        next_block_id=None,
+                    ),
+                ),
+            ],
+            node_display_coords={},
+        ),
+    )
+    bot_runner = await construct_bot(
+        owner_id=owner_id,
+        bot_id="simple-user-flow-bot",
+        bot_config=bot_config,
+        form_results_store=dummy_form_results_store(),
+        errors_store=dummy_errors_store(),
+        secret_store=secret_store,
+        redis=redis,
+        media_store=media_store.adapter_for(owner_id),
+        _bot_factory=MockedAsyncTeleBot,
+    )
+    bot = bot_runner.bot
+    assert isinstance(bot, MockedAsyncTeleBot)
+    bot.method_calls.clear()
+
+    for _ in range(3):
+        bot.add_return_values(
+            "send_photo",
+            tg.Message(
+                message_id=1,
+                from_user=tg.User(id=1, is_bot=True, first_name="Bot"),
+                date=int(time.time()),
+                chat=None,  # type: ignore
+                content_type="photo",
+                options={
+                    "photo": [tg.PhotoSize(file_id="example-file-id", file_unique_id="unused", width=1, height=1)]
+                },
+                json_string={},
+            ),
+        )
+
+    # the first user uploads the photo, others wait for its file id instead of uploading it too
+    await asyncio.gather(
+        *[
+            bot.process_new_updates([tg_update_message_to_bot(user_id=user_id, first_name="User", text="/start")])
+            for user_id in (1, 2, 3)
+        ]
+    )
+    assert sorted(
+        ((call.kwargs["chat_id"], call.kwargs["photo"]) for call in bot.method_calls["send_photo"]),
+        key=lambda p: p[0],
+    ) == [
+        (1, b"attachment-body"),
+        (2, "example-file-id"),
+        (3, "example-file-id"),
+    ]
+
+
+async def test_concurrent_uploads_of_same_media_in_different_orders() -> None:
+    redis = RedisEmulation()
+    secret_store = dummy_secret_store(redis)
+    owner_id = "test-username"
+    await secret_store.save_secret(secret_name="token", secret_value="<token>", owner_id=owner_id)
+
+    media_store = SlowRedisMediaStore(redis)
+    media_id_1 = await media_store.save_media(owner_id, Media(content=b"attachment-1-body", filename=None))
+    media_id_2 = await media_store.save_media(owner_id, Media(content=b"attachment-2-body", filename=None))
+    assert media_id_1 is not None and media_id_2 is not None
+
+    def album_block(block_id: str, media_ids: list[MediaId]) -> UserFlowBlockConfig:
+        return UserFlowBlockConfig(
+            content=ContentBlock(
+                block_id=block_id,
+                contents=[
+                    Content(
+                        text=None,
+                        attachments=[ContentBlockContentAttachment(image=media_id) for media_id in media_ids],
+                    )
+                ],
+                next_block_id=None,
+            ),
+        )
+
+    bot_config = BotConfig(
+        token_secret_name="token",
+        display_name="Content block test bot",
+        user_flow_config=UserFlowConfig(
+            entrypoints=[
+                UserFlowEntryPointConfig(
+                    command=CommandEntryPoint(
+                        entrypoint_id=f"command-{command}",
+                        command=command,
+                        next_block_id=f"content-{command}",
+                        short_description="cmd",
+                    ),
+                )
+                for command in ("straight", "reversed")
+            ],
+            blocks=[
+                album_block("content-straight", [media_id_1, media_id_2]),
+                album_block("content-reversed", [media_id_2, media_id_1]),
+            ],
+            node_display_coords={},
+        ),
+    )
+    bot_runner = await construct_bot(
+        owner_id=owner_id,
+        bot_id="simple-user-flow-bot",
+        bot_config=bot_config,
+        form_results_store=dummy_form_results_store(),
+        errors_store=dummy_errors_store(),
+        secret_store=secret_store,
+        redis=redis,
+        media_store=media_store.adapter_for(owner_id),
+        _bot_factory=MockedAsyncTeleBot,
+    )
+    bot = bot_runner.bot
+    assert isinstance(bot, MockedAsyncTeleBot)
+    bot.method_calls.clear()
+
+    def sent_album(file_ids: list[str]) -> list[tg.Message]:
+        return [
+            tg.Message(
+                message_id=1,
+                from_user=tg.User(id=1, is_bot=True, first_name="Bot"),
+                date=int(time.time()),
+                chat=None,  # type: ignore
+                content_type="photo",
+                options={"photo": [tg.PhotoSize(file_id=file_id, file_unique_id="unused", width=1, height=1)]},
+                json_string={},
+            )
+            for file_id in file_ids
+        ]
+
+    # whichever user sends the album first, their media are in the order of the straight album
+    bot.add_return_values("send_media_group", sent_album(["file-id-1", "file-id-2"]), repeating=True)
+
+    # both users start uploading, each waiting for the media the other one is uploading would hang forever
+    await asyncio.wait_for(
+        asyncio.gather(
+            bot.process_new_updates([tg_update_message_to_bot(user_id=1, first_name="User", text="/straight")]),
+            bot.process_new_updates([tg_update_message_to_bot(user_id=2, first_name="User", text="/reversed")]),
+        ),
+        timeout=5,
+    )
+    sent_media = sorted(
+        (call.kwargs["chat_id"], [m.media for m in call.kwargs["media"]])
+        for call in bot.method_calls["send_media_group"]
+    )
+    assert sent_media == [
+        (1, [b"attachment-1-body", b"attachment-2-body"]),
+        (2, ["file-id-2", "file-id-1"]),
+    ]
+
+
+async def test_chained_content_blocks_are_coalesced() -> None:
+    redis = RedisEmulation()
+    secret_store = dummy_secret_store(redis)
+    owner_id = "test-username"
+    await secret_store.save_secret(secret_name="token", secret_value="<token>", owner_id=owner_id)
+
+    media_store = RedisMediaStore(redis)
+    media_id = await media_store.save_media(owner_id, Media(content=b"attachment-body", filename=None))
+    assert media_id is not None
+
+    long_text = "x" * 3999
+    bot_config = BotConfig(
+        token_secret_name="token",
+        display_name="Content block test bot",
+        user_flow_config=UserFlowConfig(
+            entrypoints=[
+                UserFlowEntryPointConfig(
+                    command=CommandEntryPoint(
+                        entrypoint_id="command-1",
+                        command="start",
+                        next_block_id="text-1",
+                        short_description="start cmd",
+                    ),
+                ),
+                UserFlowEntryPointConfig(
+                    command=CommandEntryPoint(
+                        entrypoint_id="command-2",
+                        command="bye",
+                        next_block_id="text-4",
+                        short_description="bye cmd",
+                    ),
+                ),
+            ],
+            blocks=[
+                UserFlowBlockConfig(content=ContentBlock.simple_text("text-1", "hello", next_block_id="text-2")),
+                UserFlowBlockConfig(content=ContentBlock.simple_text("text-2", "world", next_block_id="photo")),
+                UserFlowBlockConfig(
+                    content=ContentBlock(
+                        block_id="photo",
+                        contents=[Content(text=None, attachments=[ContentBlockContentAttachment(image=media_id)])],
+                        next_block_id="text-3",
+                    ),
+                ),
+                UserFlowBlockConfig(content=ContentBlock.simple_text("text-3", long_text, next_block_id="text-4")),
+                # entered from another entrypoint as well, so it's not merged into the chain
+                UserFlowBlockConfig(content=ContentBlock.simple_text("text-4", "bye", next_block_id=None)),
+            ],
+            node_display_coords={},
+        ),
+    )
+    bot_runner = await construct_bot(
+        owner_id=owner_id,
+        bot_id="simple-user-flow-bot",
+        bot_config=bot_config,
+        form_results_store=dummy_form_results_store(),
+        errors_store=dummy_errors_store(),
+        secret_store=secret_store,
+        redis=redis,
+        media_store=media_store.adapter_for(owner_id),
+        collect_block_metrics=True,
+        _bot_factory=MockedAsyncTeleBot,
+    )
+    [flush_job] = bot_runner.background_jobs
+    flush_task = asyncio.create_task(flush_job)
+    bot = bot_runner.bot
+    assert isinstance(bot, MockedAsyncTeleBot)
+    bot.method_calls.clear()
+    bot.add_return_values(
+        "send_photo",
+        tg.Message(
+            message_id=1,
+            from_user=tg.User(id=1, is_bot=True, first_name="Bot"),
+            date=int(time.time()),
+            chat=None,  # type: ignore
+            content_type="photo",
+            options={"photo": [tg.PhotoSize(file_id="example-file-id", file_unique_id="unused", width=1, height=1)]},
+            json_string={},
+        ),
+    )
+
+    await bot.process_new_updates([tg_update_message_to_bot(user_id=1, first_name="User", text="/start")])
+    assert_method_call_kwargs_include(
+        bot.method_calls["send_message"],
+        [
+            {"chat_id": 1, "text": "hello\n\nworld"},
+            {"chat_id": 1, "text": long_text},  # too long to be merged with the next one
+            {"chat_id": 1, "text": "bye"},
+        ],
+    )
+    assert_method_call_kwargs_include(bot.method_calls["send_photo"], [{"chat_id": 1, "photo": b"attachment-body"}])
+
+    # blocks inside the chain are still entered on their own, without sending anything
+    flush_task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await flush_task
+    block_metrics = await load_block_metrics(bot_runner.bot_prefix, redis)
+    assert {block_id: m.entered for block_id, m in block_metrics.items()} == {
+        "text-1": 1,
+        "text-2": 1,
+        "photo": 1,
+        "text-3": 1,
+        "text-4": 1,
+    }
+
+
+@pytest.mark.parametrize("warm_up_enabled", [True, False])
+async def test_media_warm_up(warm_up_enabled: bool) -> None:
+    ADMIN_CHAT_ID = 123456
+    WARM_UP_CHAT_ID = -100654321
+    redis = RedisEmulation()
+    secret_store = dummy_secret_store(redis)
+    owner_id = "test-username"
+    await secret_store.save_secret(secret_name="token", secret_value="<token>", owner_id=owner_id)
+
+    media_store = RedisMediaStore(redis)
+    media_id = await media_store.save_media(owner_id, Media(content=b"attachment-body", filename=None))
+    assert media_id is not None
+
+    blocks = [
+        UserFlowBlockConfig(
+            content=ContentBlock(
+                block_id="content-1",
+                contents=[Content(text=None, attachments=[ContentBlockContentAttachment(image=media_id)])],
+                next_block_id=None,
+            ),
+        ),
+        # feedback admin chat must not be used for warm-up
+        UserFlowBlockConfig(
+            human_operator=HumanOperatorBlock(
+                block_id="human-operator-1",
+                catch_all=True,
+                feedback_handler_config=FeedbackHandlerConfig(
+                    admin_chat_id=ADMIN_CHAT_ID,
+                    forum_topic_per_user=False,
+                    messages_to_user=MessagesToUser(forwarded_to_admin_ok="ok", throttling=""),
+                    messages_to_admin=MessagesToAdmin(
+                        copied_to_user_ok="copied ok", deleted_message_ok="", can_not_delete_message=""
+                    ),
+                    anonimyze_users=False,
+                    max_messages_per_minute=10,
+                    hashtags_in_admin_chat=True,
+                    unanswered_hashtag="unanswered",
+                    hashtag_message_rarer_than=None,
+                    message_log_to_admin_chat=True,
+                ),
+            ),
+        ),
+    ]
+    bot_config = BotConfig(
+        token_secret_name="token",
+        display_name="Content block test bot",
+        user_flow_config=UserFlowConfig(
+            entrypoints=[
+                UserFlowEntryPointConfig(
+                    command=CommandEntryPoint(entrypoint_id="command-1", command="start", next_block_id="content-1"),
+                )
+            ],
+            blocks=blocks,
+            node_display_coords={},
+            media_warm_up_chat_id=WARM_UP_CHAT_ID if warm_up_enabled else None,
+        ),
+    )
+    bot_runner = await construct_bot(
+        owner_id=owner_id,
+        bot_id="warm-up-bot",
+        bot_config=bot_config,
+        form_results_store=dummy_form_results_store(),
+        errors_store=dummy_errors_store(),
+        secret_store=secret_store,
+        redis=redis,
+        media_store=media_store.adapter_for(owner_id),
+        _bot_factory=MockedAsyncTeleBot,
+    )
+    bot = bot_runner.bot
+    assert isinstance(bot, MockedAsyncTeleBot)
+    bot.method_calls.clear()
+
+    warm_up_jobs = [job for job in bot_runner.background_jobs if job.__name__ == "warm_up"]
+    for job in bot_runner.background_jobs:
+        if job not in warm_up_jobs:
+            job.close()
+    if not warm_up_enabled:
+        assert not warm_up_jobs
+        return
+
+    bot.add_return_values(
+        "send_photo",
+        tg.Message(
+            message_id=42,
+            from_user=tg.User(id=1, is_bot=True, first_name="Bot"),
+            date=int(time.time()),
+            chat=None,  # type: ignore
+            content_type="photo",
+            options={"photo": [tg.PhotoSize(file_id="example-file-id", file_unique_id="unused", width=1, height=1)]},
+            json_string={},
+        ),
+    )
+    [warm_up_job] = warm_up_jobs
+    await warm_up_job
+    assert_method_call_kwargs_include(
+        bot.method_calls["send_photo"],
+        [{"chat_id": WARM_UP_CHAT_ID, "photo": b"attachment-body", "disable_notification": True}],
+    )
+    assert_method_call_kwargs_include(
+        bot.method_calls["delete_message"], [{"chat_id": WARM_UP_CHAT_ID, "message_id": 42}]
+    )
+    bot.method_calls.clear()
+
+    # the first user already gets the photo by its cached file id
+    await bot.process_new_updates([tg_update_message_to_bot(user_id=111111, first_name="User", text="/start")])
+    assert_method_call_kwargs_include(bot.method_calls["send_photo"], [{"chat_id": 111111, "photo": "example-file-id"}])
@@ -1,7 +1,29 @@
+import asyncio
+import dataclasses
+import datetime
+import enum
+import gc
 from typing import Any
 
 import pytest
 from telebot.test_util import MockedAsyncTeleBot
+from telebot_components.form.field import (
+    AttachmentsField,
+    DateField,
+    DateMenuField,
+    DynamicSingleSelectField,
+    FormField,
+    FormFieldResultFormattingOpts,
+    IntegerField,
+    IntegerListField,
+    MultipleSelectField,
+    PlainTextField,
+    SearchableSingleSelectField,
+    SearchableSingleSelectItem,
+    SingleSelectField,
+    TimeField,
+)
+from telebot_components.form.form import Form as ComponentsForm
 from telebot_components.redis_utils.emulation import RedisEmulation
 
 from telebot_constructor.bot_config import (
@@ -18,19 +40,23 @@ from telebot_constructor.store.form_results import (
 )
 from telebot_constructor.user_flow.blocks.content import ContentBlock
 from telebot_constructor.user_flow.blocks.form import (
+    SINGLE_SELECT_ENUM_REGISTRY,
     BranchingFormMemberConfig,
     EnumOption,
     FormBlock,
     FormBranchConfig,
     FormFieldConfig,
     FormMessages,
+    FormResultRenderer,
     FormResultsExport,
     FormResultsExportToChatConfig,
     FormResultUserAttribution,
     PlainTextFormFieldConfig,
+    SingleSelectEnumRegistry,
     SingleSelectFormFieldConfig,
 )
 from telebot_constructor.user_flow.entrypoints.command import CommandEntryPoint
+from telebot_constructor.utils.pydantic import Language
 from tests.utils import (
     RECENT_TIMESTAMP,
     assert_method_call_dictified_kwargs_include,
@@ -200,8 +226,11 @@ async def test_user_flow_with_form(
         redis=redis,
         _bot_factory=MockedAsyncTeleBot,
     )
-    assert not bot_runner.background_jobs
+    # export to admin chat worker and single select fields release
+    assert len(bot_runner.background_jobs) == 2
     assert not bot_runner.aux_endpoints
+    export_worker = asyncio.create_task(bot_runner.background_jobs[0])
+    release_job = asyncio.create_task(bot_runner.background_jobs[1])
 
     bot = bot_runner.bot
     assert isinstance(bot, MockedAsyncTeleBot)
@@ -254,6 +283,12 @@ async def test_user_flow_with_form(
     bot.method_calls.clear()
 
     await bot.process_new_updates([tg_update_message_to_bot(161, first_name="User", text="granny smith")])
+    for _ in range(100):
+        if len(bot.method_calls["send_message"]) == 3:
+            break
+        await asyncio.sleep(0.01)
+    export_worker.cancel()
+    # the user's flow continues right away, form result is sent to the admin chat in the background
     assert len(bot.method_calls) == 1
     assert_method_call_kwargs_include(
         bot.method_calls["send_message"],
@@ -263,6 +298,7 @@ async def test_user_flow_with_form(
                 "text": ("<b>Name</b>: John Doe\n" + "<b>Apples</b>: Yes I do\n" + "<b>Which apples</b>: granny smith"),
                 "parse_mode": "HTML",
             },
+            {"text": "thanks for using the bot", "chat_id": 161},
             {
                 "chat_id": 111222,
                 "text": (
@@ -273,11 +309,17 @@ async def test_user_flow_with_form(
                 ),
                 "parse_mode": "HTML",
             },
-            {"text": "thanks for using the bot", "chat_id": 161},
         ],
     )
     bot.method_calls.clear()
 
+    # the single select field is attributed to the form until the bot is stopped, even if its config is still loaded
+    assert SINGLE_SELECT_ENUM_REGISTRY.claim_field("does_like_apples", form_block_id="other-form") is None
+    release_job.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await release_job
+    assert SINGLE_SELECT_ENUM_REGISTRY.claim_field("does_like_apples", form_block_id="other-form") is not None
+
 
 async def test_form_results_internal_storage() -> None:
     bot_config = BotConfig(
@@ -465,3 +507,246 @@ async def test_form_results_internal_storage() -> None:
             "dog_name": "My dog is called Mary after me",
         },
     ]
+
+
+def test_single_select_enum_registry() -> None:
+    registry = SingleSelectEnumRegistry()
+    options = [EnumOption(id="yes", label="Yes"), EnumOption(id="no", label="No")]
+
+    EnumClass = registry.enum_class("field", options)
+    assert [(e.name, e.value) for e in EnumClass] == [("yes", "Yes"), ("no", "No")]
+    assert registry.enum_class("field", [o.model_copy() for o in options]) is EnumClass
+    assert registry.enum_class("field", options[:1]) is not EnumClass
+    assert registry.enum_class("other-field", options) is not EnumClass
+    assert registry.enum_class_by_name("field_single_select_field_options") is not EnumClass  # the latest version
+    assert registry.enum_class("field", options) is EnumClass
+    assert registry.enum_class_by_name("field_single_select_field_options") is EnumClass
+
+    # e.g. the old and the new version of the same form block
+    owners = [registry.claim_field("field", form_block_id="form-1") for _ in range(2)]
+    assert all(owner is not None for owner in owners)
+    assert registry.claim_field("field", form_block_id="form-2") is None
+
+    # the field is released explicitly when the bot is stopped, once by each form using it
+    registry.release_field(owners[0])  # type: ignore
+    assert registry.claim_field("field", form_block_id="form-2") is None
+    registry.release_field(owners[1])  # type: ignore
+    owner = registry.claim_field("field", form_block_id="form-2")
+    assert owner is not None
+
+    # or with the last form using it, if it's never set up
+    del owner
+    gc.collect()
+    assert registry.claim_field("field", form_block_id="form-3") is not None
+
+
+def test_form_result_renderer() -> None:
+    EN = Language.lookup("en")
+    RU = Language.lookup("ru")
+    form_block = FormBlock(
+        block_id="rendering-test-form",
+        form_name="rendering-test-form",
+        members=[
+            BranchingFormMemberConfig(
+                field=FormFieldConfig(
+                    plain_text=PlainTextFormFieldConfig(
+                        id="rendering_name",
+                        name="Name <required>",
+                        prompt={EN: "name?", RU: "имя?"},
+                        is_long_text=False,
+                        is_required=True,
+                        result_formatting="auto",
+                        empty_text_error_msg={EN: "empty", RU: "пусто"},
+                    ),
+                )
+            ),
+            BranchingFormMemberConfig(
+                field=FormFieldConfig(
+                    single_select=SingleSelectFormFieldConfig(
+                        id="rendering_fruit",
+                        name="Fruit",
+                        prompt={EN: "fruit?", RU: "фрукт?"},
+                        is_required=True,
+                        result_formatting="auto",
+                        options=[
+                            EnumOption(id="apple", label={EN: "Apple & co", RU: "Яблоко"}),
+                            EnumOption(id="pear", label={EN: "Pear", RU: "Груша"}),
+                        ],
+                        invalid_enum_error_msg={EN: "use buttons", RU: "кнопки"},
+                    ),
+                )
+            ),
+            BranchingFormMemberConfig(
+                branch=FormBranchConfig(
+                    members=[
+                        BranchingFormMemberConfig(
+                            field=FormFieldConfig(
+                                plain_text=PlainTextFormFieldConfig(
+                                    id="rendering_story",
+                                    name="Story",
+                                    prompt={EN: "story?", RU: "история?"},
+                                    is_long_text=True,
+                                    is_required=False,
+                                    result_formatting="auto",
+                                    empty_text_error_msg={EN: "empty", RU: "пусто"},
+                                ),
+                            )
+                        ),
+                        BranchingFormMemberConfig(
+                            field=FormFieldConfig(
+                                plain_text=PlainTextFormFieldConfig(
+                                    id="rendering_secret",
+                                    name="Secret",
+                                    prompt={EN: "secret?", RU: "секрет?"},
+                                    is_long_text=False,
+                                    is_required=False,
+                                    result_formatting=None,
+                                    empty_text_error_msg={EN: "empty", RU: "пусто"},
+                                ),
+                            )
+                        ),
+                    ],
+                    condition_match_value="apple",
+                )
+            ),
+        ],
+        messages=FormMessages(
+            form_start={EN: "start", RU: "старт"},
+            cancel_command_is={EN: "{} - cancel", RU: "{} - отмена"},
+            field_is_skippable={EN: "skip - {}", RU: "пропустить - {}"},
+            field_is_not_skippable={EN: "not skippable", RU: "нельзя пропустить"},
+            please_enter_correct_value={EN: "correct value please", RU: "исправьте"},
+            unsupported_command={EN: "commands: {}", RU: "команды: {}"},
+        ),
+        results_export=FormResultsExport(
+            user_attribution=FormResultUserAttribution.NONE,
+            echo_to_user=True,
+            to_chat=None,
+        ),
+        form_completed_next_block_id=None,
+        form_cancelled_next_block_id=None,
+    )
+    form = form_block._form
+    Fruit = form.fields_by_name["rendering_fruit"].EnumClass  # type: ignore
+    renderer = FormResultRenderer(form, languages=[EN])  # RU templates are compiled on the first use
+
+    results: list[dict[str, Any]] = [
+        {"rendering_name": "John <b>", "rendering_fruit": Fruit.pear},
+        {
+            "rendering_name": "Mary",
+            "rendering_fruit": Fruit.apple,
+            "rendering_story": "once upon\na time",
+            "rendering_secret": "xyz",
+        },
+        {"rendering_name": "Bob", "rendering_fruit": Fruit.apple, "rendering_story": None},
+    ]
+    for result in results:
+        for lang in [EN, RU]:
+            assert renderer.result_to_html(result, lang) == form.result_to_html(result, lang)
+            for field_name, value in result.items():
+                if value is not None:
+                    expected_value_str = form.fields_by_name[field_name].value_to_str(value, lang)
+                    assert renderer.value_to_str(field_name, value, lang) == expected_value_str
+
+    with pytest.raises(ValueError, match="Globally required field"):
+        renderer.result_to_html({"rendering_fruit": Fruit.pear}, EN)
+
+
+_EN = Language.lookup("en")
+_RU = Language.lookup("ru")
+_COLOR = enum.Enum("_COLOR", [("red", {_EN: "Red <3", _RU: "Красный"}), ("blue", {_EN: "Blue", _RU: "Синий"})])
+_SEARCHABLE_COLOR = enum.Enum(
+    "_SEARCHABLE_COLOR",
+    [
+        ("red", SearchableSingleSelectItem(button_label={_EN: "Red <3", _RU: "Красный"})),
+        ("blue", SearchableSingleSelectItem(button_label={_EN: "Blue", _RU: "Синий"})),
+    ],
+)
+_FIELD_KWARGS: dict[str, Any] = dict(name="tested", required=True, query_message={_EN: "value?", _RU: "значение?"})
+_INLINE_FIELD_KWARGS: dict[str, Any] = dict(_FIELD_KWARGS, please_use_inline_menu="use menu")
+
+
+@pytest.mark.parametrize(
+    "field, value",
+    [
+        pytest.param(PlainTextField(**_FIELD_KWARGS, empty_text_error_msg="empty"), "a <b>", id="plain text"),
+        pytest.param(IntegerField(**_FIELD_KWARGS, not_an_integer_error_msg="int"), 42, id="integer"),
+        pytest.param(
+            IntegerListField(**_FIELD_KWARGS, not_an_integer_list_error_msg="ints"), [1, 2], id="integer list"
+        ),
+        pytest.param(
+            DateField(**_FIELD_KWARGS, timezone=datetime.timezone.utc, bad_date_format_error_msg="date"),
+            datetime.date(2024, 2, 29),
+            id="date",
+        ),
+        pytest.param(TimeField(**_FIELD_KWARGS, bad_time_format_msg="time"), datetime.time(13, 37), id="time"),
+        pytest.param(
+            AttachmentsField(
+                **_FIELD_KWARGS,
+                attachments_expected_error_msg="attachments",
+                only_one_media_message_allowed_error_msg="one",
+                bad_attachment_type_error_msg="type",
+            ),
+            [object(), object()],
+            id="attachments",
+        ),
+        pytest.param(
+            SingleSelectField(**_FIELD_KWARGS, EnumClass=_COLOR, invalid_enum_value_error_msg="enum"),
+            _COLOR.red,
+            id="single select",
+        ),
+        pytest.param(
+            SearchableSingleSelectField(
+                **_FIELD_KWARGS, EnumClass=_SEARCHABLE_COLOR, no_matches_found="none", choose_from_matches="choose"
+            ),
+            _SEARCHABLE_COLOR.red,
+            id="searchable single select",
+        ),
+        pytest.param(
+            DynamicSingleSelectField(**_FIELD_KWARGS, invalid_enum_value_error_msg="option"),
+            "dynamic <option>",
+            id="dynamic single select",
+        ),
+        pytest.param(
+            MultipleSelectField(
+                **_INLINE_FIELD_KWARGS,
+                EnumClass=_COLOR,
+                inline_menu_row_width=2,
+                options_per_page=10,
+                finish_field_button_caption="finish",
+                next_page_button_caption="next",
+                prev_page_button_caption="prev",
+            ),
+            {_COLOR.red, _COLOR.blue},
+            id="multiple select",
+        ),
+        pytest.param(DateMenuField(**_INLINE_FIELD_KWARGS), datetime.date(2024, 2, 29), id="date menu"),
+    ],
+)
+@pytest.mark.parametrize(
+    "formatting",
+    [
+        pytest.param(True, id="auto"),
+        pytest.param(FormFieldResultFormattingOpts(descr={_EN: "Value", _RU: "Значение"}), id="localized descr"),
+        pytest.param(FormFieldResultFormattingOpts(descr="Value <>", is_multiline=True), id="multiline"),
+        pytest.param(
+            FormFieldResultFormattingOpts(descr="Value", value_formatter=lambda v, lang: f"{lang}: {v!r}"),
+            id="custom formatter",
+        ),
+        pytest.param(None, id="omitted"),
+    ],
+)
+def test_form_result_renderer_matches_components_form(field: FormField, value: Any, formatting: Any) -> None:
+    form = ComponentsForm(
+        [
+            dataclasses.replace(field, result_formatting_opts=formatting),
+            PlainTextField(name="other", required=False, query_message="other?", empty_text_error_msg="empty"),
+        ]
+    )
+    renderer = FormResultRenderer(form, languages=[_EN, _RU])
+    for result in [{"tested": value, "other": None}, {"tested": value, "other": "other value"}]:
+        for lang in [_EN, _RU]:
+            assert renderer.result_to_html(result, lang) == form.result_to_html(result, lang)
+            assert renderer.value_to_str("tested", value, lang) == form.fields_by_name["tested"].value_to_str(
+                value, lang
+            )
@@ -9,6 +9,10 @@ from telebot_constructor.bot_config import (
 )
 from telebot_constructor.construct import construct_bot
 from telebot_constructor.user_flow.blocks.content import ContentBlock
+from telebot_constructor.user_flow.blocks.language_select import (
+    LanguageSelectBlock,
+    LanguageSelectionMenuConfig,
+)
 from telebot_constructor.user_flow.blocks.menu import (
     Menu,
     MenuBlock,
@@ -17,6 +21,7 @@ from telebot_constructor.user_flow.blocks.menu import (
     MenuMechanism,
 )
 from telebot_constructor.user_flow.entrypoints.command import CommandEntryPoint
+from telebot_constructor.utils.pydantic import Language
 from tests.utils import (
     assert_method_call_dictified_kwargs_include,
     assert_method_call_kwargs_include,
@@ -871,3 +876,134 @@ async def test_rhombus_menu() -> None:
         ],
     )
     bot.method_calls.clear()
+
+
+def test_menu_trees_share_subtrees() -> None:
+    """
+    Several menus lead to the same submenu hierarchy, which is built only once
+
+    ┌───┐ ┌───┐ ┌───┐
+    │ A │ │ B │ │ C │
+    └─┬─┘ └─┬─┘ └─┬─┘
+      │   ┌─▼─┐   │
+      └──►│ D │◄──┘
+          └─┬─┘
+          ┌─▼─┐
+          │ E │
+          └───┘
+    """
+    user_flow = UserFlowConfig(
+        entrypoints=[],
+        blocks=[
+            UserFlowBlockConfig(menu=menu)
+            for menu in make_menu_blocks({"A": ["D"], "B": ["D"], "C": ["D"], "D": ["E"], "E": []})
+        ],
+        node_display_coords={},
+    ).to_user_flow()
+
+    def menu_of(block_id: str) -> Menu:
+        block = user_flow.block_by_id[block_id]
+        assert isinstance(block, MenuBlock)
+        return block.menu
+
+    d_subtree = menu_of("menu-D")
+    assert [item.label for item in d_subtree.items] == ["E"]
+    assert d_subtree.items[0].next_block_id is None
+    assert d_subtree.items[0].submenu is menu_of("menu-E")
+    for root in ["menu-A", "menu-B", "menu-C"]:
+        [item] = menu_of(root).items
+        assert item.next_block_id is None
+        assert item.submenu is d_subtree
+
+
+async def test_multilang_menu_keyboards_are_prerendered() -> None:
+    USER_ID = 1312
+    EN = Language.lookup("en")
+    RU = Language.lookup("ru")
+    bot_config = BotConfig(
+        token_secret_name="token",
+        display_name="Menu bot",
+        user_flow_config=UserFlowConfig(
+            entrypoints=[
+                UserFlowEntryPointConfig(
+                    command=CommandEntryPoint(entrypoint_id="start-cmd", command="start", next_block_id="menu"),
+                ),
+                UserFlowEntryPointConfig(
+                    command=CommandEntryPoint(
+                        entrypoint_id="language-cmd", command="language", next_block_id="language-select"
+                    ),
+                ),
+            ],
+            blocks=[
+                UserFlowBlockConfig(
+                    menu=MenuBlock(
+                        block_id="menu",
+                        menu=Menu(
+                            text={EN: "menu", RU: "меню"},
+                            items=[MenuItem(label={EN: "one", RU: "один"}, next_block_id=None)],
+                            config=MenuConfig(
+                                back_label={EN: "back", RU: "назад"},
+                                lock_after_termination=False,
+                                mechanism=MenuMechanism.INLINE_BUTTONS,
+                            ),
+                        ),
+                    )
+                ),
+                UserFlowBlockConfig(
+                    language_select=LanguageSelectBlock(
+                        block_id="language-select",
+                        menu_config=LanguageSelectionMenuConfig(
+                            propmt={EN: "choose language", RU: "выберите язык"},
+                            is_blocking=True,
+                            emoji_buttons=True,
+                        ),
+                        supported_languages=[EN, RU],
+                        default_language=EN,
+                        language_selected_next_block_id=None,
+                    )
+                ),
+            ],
+            node_display_coords={},
+        ),
+    )
+
+    redis = RedisEmulation()
+    secret_store = dummy_secret_store(redis)
+    username = "user123"
+    await secret_store.save_secret(secret_name="token", secret_value="mock-token", owner_id=username)
+    bot_runner = await construct_bot(
+        owner_id=username,
+        bot_id="menu-bot",
+        bot_config=bot_config,
+        form_results_store=dummy_form_results_store(),
+        errors_store=dummy_errors_store(),
+        secret_store=secret_store,
+        redis=redis,
+        _bot_factory=MockedAsyncTeleBot,
+    )
+
+    bot = bot_runner.bot
+    assert isinstance(bot, MockedAsyncTeleBot)
+    bot.method_calls.clear()
+
+    for _ in range(2):
+        await bot.process_new_updates([tg_update_message_to_bot(USER_ID, first_name="User", text="/start")])
+    en_menu_1, en_menu_2 = bot.method_calls["send_message"]
+    assert en_menu_1.full_kwargs["text"] == "menu"
+    assert en_menu_1.full_kwargs["reply_markup"].to_dict() == {
+        "inline_keyboard": [[{"text": "one", "callback_data": "terminator:8d6ab84ca2af9fcc-0"}]]
+    }
+    # the same keyboard object is reused instead of rendering it on every menu sending
+    assert en_menu_1.full_kwargs["reply_markup"] is en_menu_2.full_kwargs["reply_markup"]
+    bot.method_calls.clear()
+
+    await bot.process_new_updates([tg_update_message_to_bot(USER_ID, first_name="User", text="/language")])
+    await bot.process_new_updates([tg_update_message_to_bot(USER_ID, first_name="User", text="🇷🇺 Русский")])
+    bot.method_calls.clear()
+
+    await bot.process_new_updates([tg_update_message_to_bot(USER_ID, first_name="User", text="/start")])
+    [ru_menu] = bot.method_calls["send_message"]
+    assert ru_menu.full_kwargs["text"] == "меню"
+    assert ru_menu.full_kwargs["reply_markup"].to_dict() == {
+        "inline_keyboard": [[{"text": "один", "callback_data": "terminator:8d6ab84ca2af9fcc-0"}]]
+    }
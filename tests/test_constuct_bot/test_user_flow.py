@@ -1,5 +1,9 @@
+import asyncio
+from typing import Optional
+
 import pytest
 from pydantic import ValidationError
+from telebot import types as tg
 from telebot.test_util import MockedAsyncTeleBot
 from telebot_components.redis_utils.emulation import RedisEmulation
 
@@ -10,6 +14,10 @@ from telebot_constructor.bot_config import (
     UserFlowEntryPointConfig,
 )
 from telebot_constructor.construct import construct_bot
+from telebot_constructor.user_flow.block_metrics import (
+    BlockMetricsCollector,
+    load_block_metrics,
+)
 from telebot_constructor.user_flow.blocks.content import ContentBlock
 from telebot_constructor.user_flow.blocks.human_operator import (
     FeedbackHandlerConfig,
@@ -17,15 +25,22 @@ from telebot_constructor.user_flow.blocks.human_operator import (
     MessagesToAdmin,
     MessagesToUser,
 )
+from telebot_constructor.user_flow.blocks.internal import BotErrorBlock
 from telebot_constructor.user_flow.blocks.language_select import (
+    CachedLanguageStore,
     LanguageSelectBlock,
     LanguageSelectionMenuConfig,
 )
 from telebot_constructor.user_flow.entrypoints.catch_all import CatchAllEntryPoint
-from telebot_constructor.user_flow.entrypoints.command import CommandEntryPoint
+from telebot_constructor.user_flow.entrypoints.command import (
+    CommandEntryPoint,
+    CommandScope,
+)
 from telebot_constructor.user_flow.entrypoints.regex_match import RegexMatchEntryPoint
+from telebot_constructor.user_flow.entrypoints.router import EntryPointRouter
 from telebot_constructor.utils.pydantic import Language
 from tests.utils import (
+    NxRedisEmulation,
     assert_method_call_kwargs_include,
     dummy_errors_store,
     dummy_form_results_store,
@@ -115,11 +130,11 @@ async def test_simple_user_flow() -> None:
     # user interaction
     await bot.process_new_updates([tg_update_message_to_bot(1312, first_name="User", text="/hello")])
     assert len(bot.method_calls) == 1
+    # chained text-only content blocks are sent as a single message
     assert_method_call_kwargs_include(
         bot.method_calls["send_message"],
         [
-            {"chat_id": 1312, "text": "hello!"},
-            {"chat_id": 1312, "text": "how are you today?"},
+            {"chat_id": 1312, "text": "hello!\n\nhow are you today?"},
         ],
     )
 
@@ -410,6 +425,160 @@ async def test_regex_match_entrypoint() -> None:
     bot.method_calls.clear()
 
 
+def test_entrypoint_router() -> None:
+    router = EntryPointRouter(
+        [
+            CommandEntryPoint(entrypoint_id="start", command="start", next_block_id=None),
+            RegexMatchEntryPoint(entrypoint_id="hello", regex="hello", next_block_id=None),
+            CommandEntryPoint(entrypoint_id="hello-cmd", command="hello", next_block_id=None),
+            # backreference, not combined with other regexes
+            RegexMatchEntryPoint(entrypoint_id="repeat", regex=r"(\w+) \1", next_block_id=None),
+            RegexMatchEntryPoint(entrypoint_id="start-anchored", regex="^start", next_block_id=None),
+            CommandEntryPoint(entrypoint_id="group-cmd", command="group", scope=CommandScope.GROUP, next_block_id=None),
+            RegexMatchEntryPoint(entrypoint_id="digits", regex=r"\d{3}", next_block_id=None),
+        ]
+    )
+
+    def routed_entrypoint_id(text: str, group_chat_id: int | None = None) -> str | None:
+        message = tg_update_message_to_bot(1, first_name="User", text=text, group_chat_id=group_chat_id).message
+        assert message is not None
+        entrypoint = router.match(message)
+        return entrypoint.entrypoint_id if entrypoint is not None else None
+
+    assert routed_entrypoint_id("/start") == "start"
+    assert routed_entrypoint_id("/start@somebot hello") == "start"
+    assert routed_entrypoint_id("/hello") == "hello"  # regex entrypoint comes first
+    assert routed_entrypoint_id("say HELLO please") == "hello"
+    assert routed_entrypoint_id("bye bye 123") == "repeat"
+    assert routed_entrypoint_id("Starting 123") == "start-anchored"
+    assert routed_entrypoint_id("not starting 123") == "digits"
+    assert routed_entrypoint_id("/group") is None  # group-only command in private chat
+    assert routed_entrypoint_id("/group", group_chat_id=-100) == "group-cmd"
+    assert routed_entrypoint_id("nothing to see here") is None
+
+
+async def test_block_metrics() -> None:
+    USER_ID = 1312
+    bot_config = BotConfig(
+        token_secret_name="token",
+        display_name="",
+        user_flow_config=UserFlowConfig(
+            entrypoints=[
+                UserFlowEntryPointConfig(
+                    command=CommandEntryPoint(entrypoint_id="command", command="cmd", next_block_id="message-1"),
+                ),
+                UserFlowEntryPointConfig(
+                    command=CommandEntryPoint(entrypoint_id="error", command="error", next_block_id="message-2"),
+                ),
+            ],
+            blocks=[
+                UserFlowBlockConfig(
+                    content=ContentBlock.simple_text(
+                        block_id="message-1", message_text="Message 1", next_block_id=None
+                    ),
+                ),
+                UserFlowBlockConfig(
+                    content=ContentBlock.simple_text(
+                        block_id="message-2", message_text="Message 2", next_block_id="error-block"
+                    ),
+                ),
+                UserFlowBlockConfig(error=BotErrorBlock(block_id="error-block")),
+            ],
+            node_display_coords={},
+        ),
+    )
+
+    redis = RedisEmulation()
+    secret_store = dummy_secret_store(redis)
+    username = "user123"
+    await secret_store.save_secret(secret_name="token", secret_value="mock-token", owner_id=username)
+    bot_runner = await construct_bot(
+        owner_id=username,
+        bot_id="block-metrics-bot",
+        bot_config=bot_config,
+        form_results_store=dummy_form_results_store(),
+        errors_store=dummy_errors_store(),
+        secret_store=secret_store,
+        redis=redis,
+        collect_block_metrics=True,
+        _bot_factory=MockedAsyncTeleBot,
+    )
+    [flush_job] = bot_runner.background_jobs
+    flush_task = asyncio.create_task(flush_job)
+
+    bot = bot_runner.bot
+    assert isinstance(bot, MockedAsyncTeleBot)
+    for text in ["/cmd", "/cmd", "/error"]:
+        await bot.process_new_updates([tg_update_message_to_bot(USER_ID, first_name="User", text=text)])
+
+    # metrics are flushed to redis when the bot is stopped
+    flush_task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await flush_task
+
+    block_metrics = await load_block_metrics(bot_runner.bot_prefix, redis)
+    assert {block_id: (m.block_type, m.entered, m.errors) for block_id, m in block_metrics.items()} == {
+        "message-1": ("ContentBlock", 2, 0),
+        "message-2": ("ContentBlock", 1, 0),  # error raised by the next block is not counted
+        "error-block": ("BotErrorBlock", 1, 1),
+    }
+    assert all(m.avg_duration is not None and m.p95_duration is not None for m in block_metrics.values())
+
+
+async def test_block_metrics_flushes_are_serialized() -> None:
+    redis = NxRedisEmulation()
+    block = ContentBlock.simple_text(block_id="message", message_text="Message", next_block_id=None)
+    # e.g. the old and the new version of the bot during a restart
+    collectors = [BlockMetricsCollector(bot_prefix="bot-prefix", redis=redis) for _ in range(2)]
+    for collector in collectors:
+        for _ in range(3):
+            collector.on_block_entered(block, duration=0.01, exception=None)
+
+    # the lock is held by another process
+    await redis.set("bot-prefix/block-metrics-lock", b"other", nx=True)
+    flushes = asyncio.gather(*[collector.flush() for collector in collectors])
+    await asyncio.sleep(0.1)
+    assert not flushes.done()
+    await redis.delete("bot-prefix/block-metrics-lock")
+    await flushes
+
+    block_metrics = await load_block_metrics("bot-prefix", redis)
+    assert block_metrics["message"].entered == 6
+    assert not await redis.exists("bot-prefix/block-metrics-lock")
+
+
+async def test_block_metrics_are_kept_on_failed_flush() -> None:
+    class InterruptingRedis(NxRedisEmulation):
+        interrupt_reading: set[str] = set()
+
+        async def hget(self, name: str, key: str) -> Optional[bytes]:
+            if key in self.interrupt_reading:
+                # not retried by the store, unlike regular errors
+                raise asyncio.CancelledError()
+            return await super().hget(name, key)
+
+    redis = InterruptingRedis()
+    collector = BlockMetricsCollector(bot_prefix="bot-prefix", redis=redis)
+    blocks = [
+        ContentBlock.simple_text(block_id=block_id, message_text="Message", next_block_id=None)
+        for block_id in ["message-1", "message-2"]
+    ]
+    for block in blocks:
+        collector.on_block_entered(block, duration=0.01, exception=None)
+
+    # flush is interrupted after the first block's metrics are written
+    redis.interrupt_reading = {"message-2"}
+    with pytest.raises(asyncio.CancelledError):
+        await collector.flush()
+    for block in blocks:
+        collector.on_block_entered(block, duration=0.01, exception=None)
+    redis.interrupt_reading = set()
+    await collector.flush()
+
+    block_metrics = await load_block_metrics("bot-prefix", redis)
+    assert {block_id: m.entered for block_id, m in block_metrics.items()} == {"message-1": 2, "message-2": 2}
+
+
 async def test_forbid_multiple_catch_all() -> None:
     with pytest.raises(ValidationError, match=".*At most one catch-all block/entrypoint is allowed, but found:"):
         BotConfig(
@@ -575,6 +744,34 @@ async def test_multilang_user_flow() -> None:
     bot.method_calls.clear()
 
 
+async def test_cached_language_store() -> None:
+    store = CachedLanguageStore(
+        redis=RedisEmulation(),
+        bot_prefix="test",
+        supported_languages=[Language.lookup("en"), Language.lookup("ru")],
+        default_language=Language.lookup("en"),
+    )
+    loaded_user_ids: list[int] = []
+    load = store.user_language_store.load
+
+    async def counting_load(user_id: int) -> object:
+        loaded_user_ids.append(user_id)
+        return await load(user_id)
+
+    store.user_language_store.load = counting_load  # type: ignore
+    user = tg.User(id=161, is_bot=False, first_name="User")
+
+    assert await store.get_user_language(user) == Language.lookup("en")
+    assert await store.get_user_language(user) == Language.lookup("en")
+    assert loaded_user_ids == [161]
+
+    # the cached language is replaced without reloading it
+    assert await store.set_user_language(user, Language.lookup("ru"))
+    assert await store.get_user_language(user) == Language.lookup("ru")
+    assert await store.get_user_language(user) == Language.lookup("ru")
+    assert loaded_user_ids == [161]
+
+
 async def test_no_infinte_loop_flow() -> None:
     bot_config = BotConfig(
         token_secret_name="token",
@@ -636,7 +833,69 @@ async def test_no_infinte_loop_flow() -> None:
     assert_method_call_kwargs_include(
         bot.method_calls["send_message"],
         [
-            {"chat_id": 1312, "text": "hello!"},
-            {"chat_id": 1312, "text": "how are you today?"},
+            {"chat_id": 1312, "text": "hello!\n\nhow are you today?"},
         ],
     )
+
+
+async def test_bot_commands_are_set_only_when_changed() -> None:
+    def make_config(commands: list[tuple[str, CommandScope]]) -> BotConfig:
+        return BotConfig(
+            token_secret_name="token",
+            display_name="Test bot",
+            user_flow_config=UserFlowConfig(
+                entrypoints=[
+                    UserFlowEntryPointConfig(
+                        command=CommandEntryPoint(
+                            entrypoint_id=f"command-{command}",
+                            command=command,
+                            next_block_id="message-1",
+                            short_description=f"{command} command",
+                            scope=scope,
+                        ),
+                    )
+                    for command, scope in commands
+                ],
+                blocks=[
+                    UserFlowBlockConfig(
+                        content=ContentBlock.simple_text(block_id="message-1", message_text="hi", next_block_id=None),
+                    ),
+                ],
+                node_display_coords={},
+            ),
+        )
+
+    redis = RedisEmulation()
+    secret_store = dummy_secret_store(redis)
+    username = "user123"
+    await secret_store.save_secret(secret_name="token", secret_value="mock-token", owner_id=username)
+
+    async def construct(bot_config: BotConfig) -> MockedAsyncTeleBot:
+        bot_runner = await construct_bot(
+            owner_id=username,
+            bot_id="bot",
+            bot_config=bot_config,
+            form_results_store=dummy_form_results_store(),
+            errors_store=dummy_errors_store(),
+            secret_store=secret_store,
+            redis=redis,
+            _bot_factory=MockedAsyncTeleBot,
+        )
+        assert isinstance(bot_runner.bot, MockedAsyncTeleBot)
+        return bot_runner.bot
+
+    config_1 = make_config([("hello", CommandScope.PRIVATE), ("group", CommandScope.GROUP)])
+    bot = await construct(config_1)
+    assert len(bot.method_calls["set_my_commands"]) == 2
+
+    # reconstructing the same bot doesn't set commands again
+    bot = await construct(config_1)
+    assert "set_my_commands" not in bot.method_calls
+    assert "delete_my_commands" not in bot.method_calls
+
+    # only the changed scope is updated, and the scope no longer used is cleaned up
+    bot = await construct(make_config([("hello", CommandScope.PRIVATE), ("start", CommandScope.ANY)]))
+    assert [call.full_kwargs["scope"] for call in bot.method_calls["set_my_commands"]] == [None]
+    assert [call.full_kwargs["scope"].to_json() for call in bot.method_calls["delete_my_commands"]] == [
+        tg.BotCommandScopeAllGroupChats().to_json()
+    ]
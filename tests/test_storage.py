@@ -1,8 +1,13 @@
+import asyncio
+import datetime
+import logging
 import time
 
 import pytest
+from telebot.test_util import MockedAsyncTeleBot
 from telebot_components.redis_utils.emulation import RedisEmulation
 
+from telebot_constructor.store.bot_users import BotUserCache
 from telebot_constructor.store.form_results import (
     TIMESTAMP_KEY,
     FormResult,
@@ -10,6 +15,7 @@ from telebot_constructor.store.form_results import (
     FormResultsStore,
     GlobalFormId,
 )
+from telebot_constructor.store.outbox import Outbox
 
 
 @pytest.mark.parametrize(
@@ -77,3 +83,145 @@ async def test_form_results_load_with_filter(load_page_size: int):
     assert await matching(FormResultsFilter(min_timestamp=now - 110, max_timestamp=now - 10)) == all_results[0:5]
     assert await matching(FormResultsFilter(min_timestamp=now - 110, max_timestamp=None)) == all_results[0:6]
     assert await matching(FormResultsFilter(min_timestamp=None, max_timestamp=now - 90)) == all_results[0:1]
+
+
+async def test_bot_user_cache() -> None:
+    cache = BotUserCache(RedisEmulation())
+    bot = MockedAsyncTeleBot("token")
+    bot_user = await cache.get_me(bot)
+    assert len(bot.method_calls["get_me"]) == 1
+
+    # the same token, even for another bot instance, is resolved from cache
+    other_bot_instance = MockedAsyncTeleBot("token")
+    assert (await cache.get_me(other_bot_instance)).to_dict() == bot_user.to_dict()
+    assert not other_bot_instance.method_calls
+
+    await cache.invalidate(bot)
+    await cache.get_me(other_bot_instance)
+    assert len(other_bot_instance.method_calls["get_me"]) == 1
+
+    # errors are not cached
+    failing_bot = MockedAsyncTeleBot("invalid-token")
+    failing_bot.add_return_values("get_me", ValueError("Unauthorized"), ValueError("Unauthorized"))
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            await cache.get_me(failing_bot)
+    assert len(failing_bot.method_calls["get_me"]) == 2
+
+
+async def test_outbox_retries() -> None:
+    outbox = Outbox[str](
+        name="test",
+        prefix="test-bot",
+        redis=RedisEmulation(),
+        dumper=str,
+        loader=str,
+        logger=logging.getLogger(__name__),
+        max_attempts=2,
+        retry_backoff=datetime.timedelta(seconds=0),
+    )
+    for job in ["first", "failing", "second"]:
+        await outbox.enqueue(job)
+    assert await outbox.pending_count() == 3
+
+    processed: list[str] = []
+
+    async def process_job(job: str) -> None:
+        if job == "failing":
+            raise RuntimeError("job failed")
+        processed.append(job)
+
+    assert await outbox.process_pending(process_job) == 2
+    assert processed == ["first", "second"]
+    assert await outbox.pending_count() == 1  # failed job is kept for a retry
+
+    # the second attempt is the last one
+    assert await outbox.process_pending(process_job) == 0
+    assert await outbox.pending_count() == 0
+
+
+async def test_outbox_jobs_are_processed_once_by_concurrent_workers() -> None:
+    redis = RedisEmulation()
+
+    def make_outbox() -> Outbox[str]:
+        return Outbox[str](
+            name="test",
+            prefix="test-bot",
+            redis=redis,
+            dumper=str,
+            loader=str,
+            logger=logging.getLogger(__name__),
+        )
+
+    old_outbox, new_outbox = make_outbox(), make_outbox()
+    for job in ["first", "second", "third"]:
+        await old_outbox.enqueue(job)
+
+    processed: list[str] = []
+
+    async def process_job(job: str) -> None:
+        await asyncio.sleep(0.01)
+        processed.append(job)
+
+    processed_counts = await asyncio.gather(
+        old_outbox.process_pending(process_job),
+        new_outbox.process_pending(process_job),
+    )
+    assert sum(processed_counts) == 3
+    assert sorted(processed) == ["first", "second", "third"]
+    assert await new_outbox.pending_count() == 0
+
+    # a job interrupted by the worker cancellation is returned to the pending ones
+    await old_outbox.enqueue("interrupted")
+    worker = asyncio.create_task(old_outbox.process_pending(process_job))
+    await asyncio.sleep(0.005)
+    assert await old_outbox.pending_count() == 0
+    worker.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await worker
+    assert await new_outbox.process_pending(process_job) == 1
+    assert processed[-1] == "interrupted"
+
+
+async def test_outbox_job_of_dead_worker_is_requeued_after_lease_expiration() -> None:
+    redis = RedisEmulation()
+
+    def make_outbox() -> Outbox[str]:
+        return Outbox[str](
+            name="test",
+            prefix="test-bot",
+            redis=redis,
+            dumper=str,
+            loader=str,
+            logger=logging.getLogger(__name__),
+            lease_duration=datetime.timedelta(seconds=0.05),
+        )
+
+    dead_outbox, new_outbox = make_outbox(), make_outbox()
+    await dead_outbox.enqueue("job")
+
+    processed: list[str] = []
+
+    async def hanging_process_job(job: str) -> None:
+        await asyncio.Event().wait()
+
+    async def process_job(job: str) -> None:
+        processed.append(job)
+
+    # the worker claims the job and hangs, as if the process was killed mid-send
+    dead_worker = asyncio.create_task(dead_outbox.process_pending(hanging_process_job))
+    await asyncio.sleep(0.01)
+    assert await new_outbox.pending_count() == 0
+    assert await new_outbox.process_pending(process_job) == 0  # the lease is still valid
+
+    await asyncio.sleep(0.05)
+    assert await new_outbox.process_pending(process_job) == 1
+    assert processed == ["job"]
+
+    # the job taken over from the worker is not returned to pending when it's finally stopped
+    dead_worker.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await dead_worker
+    assert await new_outbox.pending_count() == 0
+    assert await new_outbox.process_pending(process_job) == 0
+    assert processed == ["job"]
@@ -1,8 +1,24 @@
+import asyncio
+import datetime
+import time
+
 import pytest
+from telebot.test_util import MockedAsyncTeleBot
+from telebot_components.utils import TextMarkup
 
-from telebot_constructor.user_flow.blocks.form import join_localizable_texts
-from telebot_constructor.utils import page_params_to_redis_indices
-from telebot_constructor.utils.pydantic import Language, LocalizableText
+from telebot_constructor.outgoing_rate_limiter import OutgoingRateLimiter
+from telebot_constructor.utils import (
+    page_params_to_redis_indices,
+    preprocess_for_telegram,
+    preprocess_markdown_for_telegram,
+)
+from telebot_constructor.utils.pydantic import (
+    Language,
+    LocalizableText,
+    join_localizable_texts,
+)
+from telebot_constructor.utils.redis_lock import redis_lock
+from tests.utils import NxRedisEmulation
 
 
 @pytest.mark.parametrize(
@@ -45,3 +61,90 @@ def test_join_localizable_texts(texts: list[LocalizableText], expected_result: L
 )
 def test_page_params_to_redis_indices(params: tuple[int, int], expected_result: tuple[int, int]):
     assert page_params_to_redis_indices(*params) == expected_result
+
+
+def test_preprocess_for_telegram_is_memoized() -> None:
+    text = "**memoized** text with a [link](https://example.com)"
+    preprocess_markdown_for_telegram.cache_clear()
+    assert preprocess_for_telegram(text, TextMarkup.HTML) == text
+    assert preprocess_markdown_for_telegram.cache_info().currsize == 0
+
+    preprocessed = preprocess_for_telegram(text, TextMarkup.MARKDOWN)
+    assert preprocessed == "*memoized* text with a [link](https://example.com)\n"
+    assert preprocess_for_telegram({Language.lookup("en"): text}, TextMarkup.MARKDOWN) == {
+        Language.lookup("en"): preprocessed
+    }
+    cache_info = preprocess_markdown_for_telegram.cache_info()
+    assert cache_info.misses == 1
+    assert cache_info.hits == 1
+
+
+async def test_outgoing_rate_limiter_paces_sends_per_chat() -> None:
+    limiter = OutgoingRateLimiter(private_chat_rate=20, private_chat_burst=1)
+    bot = MockedAsyncTeleBot("token")
+    limiter.instrument(bot, owner_id="owner", bot_id="bot")
+
+    sent_at: dict[int, list[float]] = {1: [], 2: []}
+
+    async def send(chat_id: int) -> None:
+        await bot.send_message(chat_id, text="hello")
+        sent_at[chat_id].append(time.monotonic())
+
+    start = time.monotonic()
+    await asyncio.gather(*[send(1) for _ in range(4)], send(2))
+
+    # the flooded chat is paced, while the other one is not held back
+    assert sent_at[1][-1] - start >= 0.14
+    assert sent_at[2][0] - start < 0.05
+    assert len(bot.method_calls["send_message"]) == 5
+
+    metrics = limiter.render_prometheus()
+    assert 'telebot_constructor_outgoing_messages_total{owner_id="owner",bot_id="bot"} 5' in metrics
+    assert 'telebot_constructor_outgoing_throttled_seconds_count{owner_id="owner",bot_id="bot"} 3' in metrics
+
+
+async def test_outgoing_rate_limiter_refunds_chat_tokens_on_cancellation() -> None:
+    limiter = OutgoingRateLimiter(bot_rate=1, private_chat_rate=1, private_chat_burst=5)
+    limits = limiter.limits_for(owner_id="owner", bot_id="bot")
+    limits.bot_bucket.tokens = 0
+
+    # the chat token is available, but the request is cancelled while waiting for the bot-wide one
+    task = asyncio.create_task(limits.pace(chat_id=1))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert limits.chat_buckets[1].tokens == pytest.approx(5, abs=0.1)
+    assert limits.bot_bucket.tokens == pytest.approx(0, abs=0.1)
+
+
+async def test_outgoing_rate_limiter_charges_media_group_per_item() -> None:
+    limiter = OutgoingRateLimiter(private_chat_rate=1, private_chat_burst=5)
+    bot = MockedAsyncTeleBot("token")
+    limiter.instrument(bot, owner_id="owner", bot_id="bot")
+    limits = limiter.limits_for(owner_id="owner", bot_id="bot")
+
+    await bot.send_media_group(1, media=[object(), object(), object()])  # type: ignore
+    assert limits.chat_buckets[1].tokens == pytest.approx(2, abs=0.1)
+    await bot.send_message(1, text="hello")
+    assert limits.chat_buckets[1].tokens == pytest.approx(1, abs=0.1)
+
+
+async def test_redis_lock_acquire_timeout() -> None:
+    redis = NxRedisEmulation()
+    await redis.set("lock", b"other", nx=True)
+    with pytest.raises(TimeoutError):
+        async with redis_lock(
+            redis,
+            key="lock",
+            expiration=datetime.timedelta(seconds=30),
+            acquire_timeout=datetime.timedelta(seconds=0.1),
+        ):
+            pass
+    assert await redis.get("lock") == b"other"
+
+    await redis.delete("lock")
+    async with redis_lock(redis, key="lock", expiration=datetime.timedelta(seconds=30)):
+        assert await redis.exists("lock")
+    assert not await redis.exists("lock")
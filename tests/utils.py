@@ -19,6 +19,15 @@ from telebot_constructor.store.form_results import (
 )
 
 
+class NxRedisEmulation(RedisEmulation):
+    """Supports setting a value only if it doesn't exist, used for locks"""
+
+    async def set(self, name: str, value: bytes, *args: Any, nx: bool = False, **kwargs: Any) -> bool:
+        if nx and await self.get(name) is not None:
+            return False
+        return await super().set(name, value, *args, **kwargs)
+
+
 def dummy_secret_store(redis: RedisInterface) -> SecretStore:
     return RedisSecretStore(
         redis,
@@ -181,6 +190,17 @@ def mask_recursively(
 
 
 RECENT_TIMESTAMP = "<recent timestamp>"
+
+# BotInfo.update_metrics of a bot started, but not receiving updates yet
+EMPTY_UPDATE_METRICS = {
+    "updates": 0,
+    "unhandled_updates": 0,
+    "errors": 0,
+    "recent_updates_per_minute": 0.0,
+    "avg_processing_duration": None,
+    "p95_processing_duration": None,
+    "last_update_at": None,
+}
 SMALL_TIME_DURATION = "<small time duration>"
 
 